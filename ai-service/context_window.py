@@ -0,0 +1,141 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from conversation_store import ConversationStore
+from ollama_pool import OllamaPool
+
+logger = logging.getLogger(__name__)
+
+# Tokens of history (summary included) sent with each turn
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Fold older turns into the summary once this many tokens have fallen out of the window
+CONTEXT_SUMMARY_MIN_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MIN_TOKENS", "500"))
+CONTEXT_SUMMARY_MAX_WORDS = int(os.getenv("CONTEXT_SUMMARY_MAX_WORDS", "200"))
+CONTEXT_SUMMARY_WORKERS = int(os.getenv("CONTEXT_SUMMARY_WORKERS", "2"))
+CONTEXT_SUMMARY_MODEL = os.getenv("CONTEXT_SUMMARY_MODEL", "llama3")
+# How long one worker may hold a conversation's summary lock; outlives a slow summary
+CONTEXT_SUMMARY_LOCK_SECONDS = float(os.getenv("CONTEXT_SUMMARY_LOCK_SECONDS", "120"))
+
+MESSAGE_OVERHEAD_TOKENS = 4  # role + chat template framing
+
+SUMMARY_PROMPT = (
+    "Update the running summary of a conversation between a user and an assistant.\n"
+    "Keep facts, names, preferences, decisions and open questions; drop pleasantries.\n"
+    "Answer with the summary only, at most {words} words.\n\n"
+    "Current summary:\n{summary}\n\nNew messages:\n{transcript}\n"
+)
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English with llama-style BPE; no tokenizer round trip
+    return (len(text) + 3) // 4
+
+
+def message_tokens(message: dict) -> int:
+    return estimate_tokens(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+
+
+def summary_message(summary: str) -> dict:
+    return {"role": "system", "content": "Summary of the earlier conversation:\n" + summary}
+
+
+class ContextWindow:
+    """
+    Keeps each turn's prompt within a token budget: the newest messages that fit,
+    preceded by a running summary of everything older. Messages that fall out of
+    the window are folded into the summary by a background worker, so per-turn
+    prompt size stays flat however long the conversation gets.
+
+    One summary per conversation at a time, across workers (the store's lock),
+    and it only replaces the messages it was made from (the store's compact()
+    checks the history still starts with them).
+    """
+
+    def __init__(
+        self,
+        store: ConversationStore,
+        pool: OllamaPool,
+        budget: int = CONTEXT_TOKEN_BUDGET,
+        summary_min_tokens: int = CONTEXT_SUMMARY_MIN_TOKENS,
+    ):
+        self.store = store
+        self.pool = pool
+        self.budget = budget
+        self.summary_min_tokens = summary_min_tokens
+        self._executor = ThreadPoolExecutor(max_workers=CONTEXT_SUMMARY_WORKERS, thread_name_prefix="summarize")
+
+    def split(self, summary: str, history: List[dict]) -> Tuple[int, List[dict]]:
+        """(number of oldest messages left out, messages to send). The last message is always kept."""
+        remaining = self.budget - (message_tokens(summary_message(summary)) if summary else 0)
+        start = len(history)
+        while start > 0:
+            cost = message_tokens(history[start - 1])
+            if cost > remaining and start < len(history):
+                break
+            remaining -= cost
+            start -= 1
+        window = history[start:]
+        return start, ([summary_message(summary)] + window if summary else window)
+
+    def build(self, conversation_id: str, history: List[dict]) -> List[dict]:
+        """Messages to send for this turn; `history` already ends with the new user message."""
+        summary = self.store.get_summary(conversation_id)
+        _, messages = self.split(summary, history)
+        return messages
+
+    def _older(self, conversation_id: str) -> Tuple[str, List[dict]]:
+        """(summary, messages out of the window), the latter empty if too few to fold yet."""
+        history = self.store.get(conversation_id)
+        summary = self.store.get_summary(conversation_id)
+        dropped, _ = self.split(summary, history)
+        if sum(message_tokens(m) for m in history[:dropped]) < self.summary_min_tokens:
+            return summary, []
+        return summary, history[:dropped]
+
+    def maybe_summarize(self, conversation_id: str) -> None:
+        """After a turn is stored: schedule folding if enough history fell out of the window."""
+        if not self._older(conversation_id)[1]:
+            return
+        token = self.store.lock(conversation_id, CONTEXT_SUMMARY_LOCK_SECONDS)
+        if token is None:
+            return  # another worker is on it
+        submitted = False
+        try:
+            # Read again under the lock: another worker may have just compacted
+            summary, older = self._older(conversation_id)
+            if older:
+                self._executor.submit(self._summarize, conversation_id, token, summary, older)
+                submitted = True
+        finally:
+            if not submitted:
+                self.store.unlock(conversation_id, token)
+
+    def _summarize(self, conversation_id: str, token: str, summary: str, older: List[dict]) -> None:
+        try:
+            new_summary = self.summarize(summary, older)
+            if new_summary and not self.store.compact(conversation_id, older, new_summary):
+                logger.info("History of %s changed while summarizing, summary discarded", conversation_id)
+        except Exception as e:
+            # The turns stay in history and are retried after the next turn
+            logger.warning("Summarizing %s failed: %s", conversation_id, e)
+        finally:
+            try:
+                self.store.unlock(conversation_id, token)
+            except Exception as e:
+                # Expires on its own after CONTEXT_SUMMARY_LOCK_SECONDS
+                logger.warning("Releasing the summary lock of %s failed: %s", conversation_id, e)
+
+    def summarize(self, summary: str, older: List[dict]) -> Optional[str]:
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in older)
+        prompt = SUMMARY_PROMPT.format(words=CONTEXT_SUMMARY_MAX_WORDS, summary=summary or "(none)", transcript=transcript)
+        lines = self.pool.stream_lines(
+            "/api/generate", {"model": CONTEXT_SUMMARY_MODEL, "prompt": prompt, "stream": False}
+        )
+        try:
+            line = next(lines, None)
+        finally:
+            lines.close()
+        return (json.loads(line).get("response", "").strip() or None) if line else None
@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import uuid
+import zlib
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", "memory")  # memory | redis
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", "86400"))
+# Oldest messages are dropped past this many per conversation
+CONVERSATION_MAX_MESSAGES = int(os.getenv("CONVERSATION_MAX_MESSAGES", "200"))
+# Memory backend only: per-worker caps across all conversations
+CONVERSATION_MAX_CONVERSATIONS = int(os.getenv("CONVERSATION_MAX_CONVERSATIONS", "10000"))
+CONVERSATION_MAX_BYTES = int(os.getenv("CONVERSATION_MAX_BYTES", str(64 * 1024 * 1024)))
+
+KEY_PREFIX = "conv:"
+SUMMARY_PREFIX = "convsum:"
+LOCK_PREFIX = "convlock:"
+
+
+def message_size(message: dict) -> int:
+    return len(json.dumps(message, separators=(",", ":")).encode("utf-8"))
+
+
+def covered(history: list, older: list) -> Optional[int]:
+    """
+    How many messages at the head of `history` are the tail of `older` (the
+    messages a summary was made from), or None if they no longer line up.
+    `older` may have lost its first messages to the max_messages cap since, but
+    not all of them: then the history may as well have been cleared and restarted.
+    """
+    for shift in range(len(older)):
+        rest = older[shift:]
+        if history[:len(rest)] == rest:
+            return len(rest)
+    return None
+
+
+class ConversationStore(ABC):
+    """
+    History of chat messages ({"role", "content"}) per conversation id, plus a
+    running summary of older messages that were folded out of the history.
+    """
+
+    @abstractmethod
+    def get(self, conversation_id: str) -> List[dict]:
+        ...
+
+    @abstractmethod
+    def append(self, conversation_id: str, *messages: dict) -> None:
+        ...
+
+    @abstractmethod
+    def get_summary(self, conversation_id: str) -> str:
+        ...
+
+    @abstractmethod
+    def compact(self, conversation_id: str, older: List[dict], summary: str) -> bool:
+        """
+        Replace `older`, the oldest messages when the summary was made, by `summary`.
+        Does nothing and returns False if the history no longer starts with them.
+        """
+
+    @abstractmethod
+    def lock(self, conversation_id: str, ttl: float) -> Optional[str]:
+        """A token if this caller may compact the conversation for the next `ttl` seconds, else None."""
+
+    @abstractmethod
+    def unlock(self, conversation_id: str, token: str) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self, conversation_id: str) -> None:
+        ...
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryConversationStore(ConversationStore):
+    """
+    Per-worker store bounded by conversation count and total bytes (LRU eviction),
+    with idle conversations expiring after the TTL.
+    """
+
+    def __init__(
+        self,
+        ttl: float = CONVERSATION_TTL,
+        max_messages: int = CONVERSATION_MAX_MESSAGES,
+        max_conversations: int = CONVERSATION_MAX_CONVERSATIONS,
+        max_bytes: int = CONVERSATION_MAX_BYTES,
+    ):
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        # conversation id -> [expires_at, bytes, messages, summary]
+        self._items: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._compacting = set()  # the store is per worker, so are its compaction locks
+        self.bytes = 0
+        self.evictions = 0
+
+    def _live(self, conversation_id: str):
+        item = self._items.get(conversation_id)
+        if item is not None and item[0] <= time.monotonic():
+            self._drop(conversation_id)
+            return None
+        return item
+
+    def get(self, conversation_id: str) -> List[dict]:
+        with self._lock:
+            item = self._live(conversation_id)
+            if item is None:
+                return []
+            self._items.move_to_end(conversation_id)
+            return list(item[2])
+
+    def get_summary(self, conversation_id: str) -> str:
+        with self._lock:
+            item = self._live(conversation_id)
+            return item[3] if item is not None else ""
+
+    def append(self, conversation_id: str, *messages: dict) -> None:
+        with self._lock:
+            item = self._live(conversation_id)
+            if item is None:
+                item = self._items[conversation_id] = [0.0, 0, [], ""]
+            self._items.move_to_end(conversation_id)
+            item[0] = time.monotonic() + self.ttl
+            for message in messages:
+                item[2].append(message)
+                size = message_size(message)
+                item[1] += size
+                self.bytes += size
+            while len(item[2]) > self.max_messages:
+                size = message_size(item[2].pop(0))
+                item[1] -= size
+                self.bytes -= size
+            self._evict(conversation_id)
+
+    def compact(self, conversation_id: str, older: List[dict], summary: str) -> bool:
+        with self._lock:
+            item = self._live(conversation_id)
+            count = covered(item[2], older) if item is not None else None
+            if count is None:
+                return False
+            dropped = item[2][:count]
+            del item[2][:count]
+            delta = len(summary.encode("utf-8")) - len(item[3].encode("utf-8"))
+            delta -= sum(message_size(m) for m in dropped)
+            item[3] = summary
+            item[1] += delta
+            self.bytes += delta
+            return True
+
+    def lock(self, conversation_id: str, ttl: float) -> Optional[str]:
+        with self._lock:
+            if conversation_id in self._compacting:
+                return None
+            self._compacting.add(conversation_id)
+            return conversation_id
+
+    def unlock(self, conversation_id: str, token: str) -> None:
+        with self._lock:
+            self._compacting.discard(conversation_id)
+
+    def clear(self, conversation_id: str) -> None:
+        with self._lock:
+            self._drop(conversation_id)
+
+    def _drop(self, conversation_id: str) -> None:
+        item = self._items.pop(conversation_id, None)
+        if item is not None:
+            self.bytes -= item[1]
+
+    def _evict(self, keep: str) -> None:
+        while self._items and (len(self._items) > self.max_conversations or self.bytes > self.max_bytes):
+            oldest = next(iter(self._items))
+            if oldest == keep:
+                # A single conversation larger than the budget: keep it, it is capped by max_messages
+                break
+            self._drop(oldest)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "conversations": len(self._items), "bytes": self.bytes, "evictions": self.evictions}
+
+
+# KEYS: history, summary. ARGV: summary blob, ttl, then the encoded messages the summary
+# covers. Trims them off the head (minus any the max_messages cap already dropped) and
+# stores the summary, all or nothing; 0 if the head of the list is something else
+# or the conversation is gone (cleared or expired). Same rules as covered().
+COMPACT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local older = #ARGV - 2
+local head = redis.call('LRANGE', KEYS[1], 0, older - 1)
+for shift = 0, older - 1 do
+    local count = older - shift
+    local same = #head >= count
+    local i = 1
+    while same and i <= count do
+        same = head[i] == ARGV[2 + shift + i]
+        i = i + 1
+    end
+    if same then
+        redis.call('LTRIM', KEYS[1], count, -1)
+        redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+        return 1
+    end
+end
+return 0
+"""
+
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisConversationStore(ConversationStore):
+    """
+    Store shared by every worker: one capped Redis list per conversation,
+    each element a zlib-compressed JSON message, refreshed TTL on every write.
+    Compaction is serialized across workers by a SET NX lock per conversation.
+    """
+
+    def __init__(self, client, ttl: int = CONVERSATION_TTL, max_messages: int = CONVERSATION_MAX_MESSAGES):
+        self.r = client
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self._compact = client.register_script(COMPACT_SCRIPT)
+        self._unlock = client.register_script(UNLOCK_SCRIPT)
+
+    @staticmethod
+    def encode(message: dict) -> bytes:
+        return zlib.compress(json.dumps(message, separators=(",", ":")).encode("utf-8"))
+
+    @staticmethod
+    def decode(blob: bytes) -> dict:
+        return json.loads(zlib.decompress(blob))
+
+    def get(self, conversation_id: str) -> List[dict]:
+        return [self.decode(b) for b in self.r.lrange(KEY_PREFIX + conversation_id, 0, -1)]
+
+    def append(self, conversation_id: str, *messages: dict) -> None:
+        key = KEY_PREFIX + conversation_id
+        pipe = self.r.pipeline()
+        pipe.rpush(key, *(self.encode(m) for m in messages))
+        pipe.ltrim(key, -self.max_messages, -1)
+        pipe.expire(key, self.ttl)
+        pipe.expire(SUMMARY_PREFIX + conversation_id, self.ttl)
+        pipe.execute()
+
+    def get_summary(self, conversation_id: str) -> str:
+        blob = self.r.get(SUMMARY_PREFIX + conversation_id)
+        return zlib.decompress(blob).decode("utf-8") if blob else ""
+
+    def compact(self, conversation_id: str, older: List[dict], summary: str) -> bool:
+        # Checked against the list itself: append() may have pushed and trimmed since `older` was read
+        return bool(self._compact(
+            keys=[KEY_PREFIX + conversation_id, SUMMARY_PREFIX + conversation_id],
+            args=[zlib.compress(summary.encode("utf-8")), self.ttl, *(self.encode(m) for m in older)],
+        ))
+
+    def lock(self, conversation_id: str, ttl: float) -> Optional[str]:
+        token = uuid.uuid4().hex
+        if self.r.set(LOCK_PREFIX + conversation_id, token, nx=True, px=int(ttl * 1000)):
+            return token
+        return None
+
+    def unlock(self, conversation_id: str, token: str) -> None:
+        # Only our own lock: it may have expired and been taken by another worker
+        self._unlock(keys=[LOCK_PREFIX + conversation_id], args=[token])
+
+    def clear(self, conversation_id: str) -> None:
+        self.r.delete(KEY_PREFIX + conversation_id, SUMMARY_PREFIX + conversation_id)
+
+    def stats(self) -> dict:
+        return {"backend": "redis"}
+
+
+def build_store(backend: str = CONVERSATION_STORE) -> ConversationStore:
+    if backend == "redis":
+        import redis  # only needed for the shared backend
+
+        return RedisConversationStore(redis.Redis.from_url(REDIS_URL))
+    if backend != "memory":
+        logger.warning("Unknown CONVERSATION_STORE %r, using memory", backend)
+    return MemoryConversationStore()
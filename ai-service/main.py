@@ -1,9 +1,17 @@
 from fastapi import FastAPI, Body, Request,Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-import requests, json
-from fastapi.responses import JSONResponse
+import os, json
+from fastapi.responses import JSONResponse, Response
 import logging
+import time
+import requests
+
+from ollama_pool import OllamaPool, NodeUnavailable
+from conversation_store import build_store
+from context_window import ContextWindow
+from stream_format import coalesce, sse, usage, ClosingStreamingResponse
+from metering import build_meter
+import metrics
 
 app = FastAPI()
 
@@ -15,10 +23,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-OLLAMA_HOST = "http://ollama:11434"
-
-# In-memory store for demo (later → DB per user)
-conversations = {}
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://ollama:11434")
+# Comma-separated Ollama nodes; requests go to the one with the fewest open streams
+OLLAMA_HOSTS = [h.strip() for h in os.getenv("OLLAMA_HOSTS", OLLAMA_HOST).split(",") if h.strip()]
+ollama_pool = OllamaPool(OLLAMA_HOSTS)
+
+# Bounded per-worker memory, or Redis shared by all workers (CONVERSATION_STORE)
+conversations = build_store()
+# Newest turns within a token budget, older ones folded into a running summary
+context_window = ContextWindow(conversations, ollama_pool)
+# Token usage from each stream's final chunk, written to Redis in batches
+meter = build_meter()
+
+metrics.Gauge(
+    "ollama_outstanding_streams", "Streams open to each Ollama node", ("node",),
+    collect=lambda: {(node.url,): node.outstanding for node in ollama_pool.nodes},
+)
 
 
 logger = logging.getLogger(__name__)
@@ -34,42 +54,87 @@ async def global_exception_handler(request: Request, exc: Exception):
     )
 
 @app.post("/chat/{user_id}")
-def chat(user_id: str, prompt: str = Body(..., embed=True)):
+def chat(user_id: str, request: Request, prompt: str = Body(..., embed=True)):
+    started = time.perf_counter()
     # get previous messages
-    history = conversations.get(user_id, [])
+    history = conversations.get(user_id)
     # add new user message
-    history.append({"role": "user", "content": prompt})
-
-    def stream():
-        with requests.post(
-            f"{OLLAMA_HOST}/api/chat",
-            json={
+    user_message = {"role": "user", "content": prompt}
+    history.append(user_message)
+    messages = context_window.build(user_id, history)
+
+    # Plain text by default; SSE with a final usage event when the client asks for it
+    use_sse = "text/event-stream" in request.headers.get("accept", "")
+    final = {}
+
+    def tokens():
+        nonlocal final
+        assistant_reply = ""
+        pieces = 0
+        timer = metrics.StreamTimer("llama3", started)
+        lines = ollama_pool.stream_lines(
+            "/api/chat",
+            {
                 "model": "llama3",
-                "messages": history,
+                "messages": messages,
                 "stream": True
             },
-            stream=True,
-        ) as resp:
-            resp.raise_for_status()
-            assistant_reply = ""
-            for line in resp.iter_lines():
-                if line:
-                    try:
-                        chunk = json.loads(line.decode("utf-8"))
-                        if "message" in chunk and "content" in chunk["message"]:
-                            piece = chunk["message"]["content"]
-                            assistant_reply += piece
-                            yield piece
-                        if chunk.get("done", False):
-                            break
-                    except json.JSONDecodeError:
-                        continue
-
-        # store assistant reply in history
-        history.append({"role": "assistant", "content": assistant_reply})
-        conversations[user_id] = history
-
-    return StreamingResponse(stream(), media_type="text/plain")
+        )
+        try:
+            for line in lines:
+                try:
+                    chunk = json.loads(line.decode("utf-8"))
+                    if "message" in chunk and "content" in chunk["message"]:
+                        piece = chunk["message"]["content"]
+                        assistant_reply += piece
+                        pieces += 1
+                        timer.token()
+                        yield piece
+                    if chunk.get("done", False):
+                        final = chunk
+                        break
+                except json.JSONDecodeError:
+                    continue
+        except (NodeUnavailable, requests.RequestException):
+            metrics.upstream_errors.labels("llama3", "none").inc()
+            raise
+        finally:
+            # Closing the stream drops the Ollama connection, which stops the generation
+            lines.close()
+            timer.end(completed=bool(final))
+            prompt_tokens = final.get("prompt_eval_count") or 0
+            completion_tokens = final.get("eval_count") or pieces
+            if final:
+                logger.info("generation %s: %s prompt + %s completion tokens", user_id, prompt_tokens, completion_tokens)
+            else:
+                logger.info("generation %s aborted after %s tokens", user_id, pieces)
+            if meter is not None:
+                meter.record(user_id, "llama3", prompt_tokens, completion_tokens, aborted=not final)
+            # store this turn in history, cut short or not: it's what the user saw
+            if final or assistant_reply:
+                conversations.append(user_id, user_message, {"role": "assistant", "content": assistant_reply})
+                context_window.maybe_summarize(user_id)
+
+    async def stream():
+        # Several tokens per write instead of one chunk per token. The blocking reads
+        # run in the threadpool, so when the client goes away tokens() is closed
+        # (and the Ollama stream with it) as soon as the read in progress returns
+        frames = coalesce(tokens())
+        try:
+            async for frame in frames:
+                yield sse("token", {"t": frame}) if use_sse else frame
+        finally:
+            await frames.aclose()
+        if use_sse:
+            yield sse("done", {"done": True, "usage": usage(final)})
+
+    if use_sse:
+        return ClosingStreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    return ClosingStreamingResponse(stream(), media_type="text/plain")
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 import logging, sys
 
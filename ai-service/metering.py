@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import zlib
+import atexit
+import calendar
+import logging
+import threading
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+METERING_ENABLED = os.getenv("METERING_ENABLED", "true").lower() == "true"
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+METER_FLUSH_INTERVAL = float(os.getenv("METER_FLUSH_INTERVAL", "2"))
+METER_BATCH_SIZE = int(os.getenv("METER_BATCH_SIZE", "500"))
+METER_MAX_BUFFER = int(os.getenv("METER_MAX_BUFFER", "100000"))
+
+# Same layout as fastapi-app/metering.py and rate_limit.py: usage here counts
+# toward the token quotas the chat service enforces, and Django rolls up the events.
+EVENTS_KEY = "usage:events"
+TOKEN_PREFIX = "tokens"
+TOKEN_WINDOWS = ("day", "month")
+QUOTA_SHARD_SIZE = int(os.getenv("QUOTA_SHARD_SIZE", "100"))
+QUOTA_KEY_TTL_BUFFER = 60
+
+
+def token_key(window: str, user_id: str, now: float) -> Tuple[str, int]:
+    """(counter key, seconds until the window resets) for a UTC day or month."""
+    ts = int(now)
+    t = time.gmtime(ts)
+    if window == "day":
+        bucket, reset = time.strftime("%Y%m%d", t), 86400 - ts % 86400
+    else:
+        days = calendar.monthrange(t.tm_year, t.tm_mon)[1]
+        bucket, reset = time.strftime("%Y%m", t), days * 86400 - (t.tm_mday - 1) * 86400 - ts % 86400
+    shard = int(user_id) // QUOTA_SHARD_SIZE if user_id.isdigit() else zlib.crc32(user_id.encode("utf-8")) % 65536
+    return f"{TOKEN_PREFIX}:{window}:{bucket}:{shard}", reset
+
+
+class Meter:
+    """
+    Buffers token usage per generation and writes it to Redis from a background
+    thread, one pipeline per flush, so requests never wait on metering.
+    """
+
+    def __init__(self, client, service: str = "ai-service"):
+        self.r = client
+        self.service = service
+        self._lock = threading.Lock()
+        self._events: Deque[str] = deque()
+        self._charges: Dict[str, int] = {}
+        self._wake = threading.Event()
+        self.dropped = 0
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        atexit.register(self.flush)
+
+    def record(self, user_id: str, model: str, prompt_tokens: int, completion_tokens: int, aborted: bool) -> None:
+        event = json.dumps({
+            "user_id": user_id,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "aborted": aborted,
+            "service": self.service,
+            "ts": int(time.time()),
+        }, separators=(",", ":"))
+        with self._lock:
+            self._events.append(event)
+            while len(self._events) > METER_MAX_BUFFER:
+                self._events.popleft()
+                self.dropped += 1
+            if prompt_tokens + completion_tokens:
+                self._charges[user_id] = self._charges.get(user_id, 0) + prompt_tokens + completion_tokens
+            full = len(self._events) >= METER_BATCH_SIZE
+        if full:
+            self._wake.set()
+
+    def flush(self) -> None:
+        with self._lock:
+            events = list(self._events)
+            charges, self._charges = self._charges, {}
+            self._events.clear()
+        if not events and not charges:
+            return
+        now = time.time()
+        pipe = self.r.pipeline(transaction=False)
+        for i in range(0, len(events), METER_BATCH_SIZE):
+            pipe.rpush(EVENTS_KEY, *events[i:i + METER_BATCH_SIZE])
+        for user_id, tokens in charges.items():
+            for window in TOKEN_WINDOWS:
+                key, reset = token_key(window, user_id, now)
+                pipe.hincrby(key, user_id, tokens)
+                pipe.expire(key, reset + QUOTA_KEY_TTL_BUFFER)
+        try:
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Usage flush failed, %s events kept: %s", len(events), e)
+            with self._lock:
+                self._events.extendleft(reversed(events))
+                for user_id, tokens in charges.items():
+                    self._charges[user_id] = self._charges.get(user_id, 0) + tokens
+
+    def _flush_loop(self) -> None:
+        while True:
+            self._wake.wait(METER_FLUSH_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+
+def build_meter() -> Optional[Meter]:
+    if not METERING_ENABLED:
+        return None
+    import redis  # only needed when metering is on
+
+    return Meter(redis.Redis.from_url(REDIS_URL, socket_timeout=2))
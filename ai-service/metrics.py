@@ -0,0 +1,220 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+Labels = Tuple[str, ...]
+
+
+# Same recording model as fastapi-app/metrics.py, without the cross-process sharing:
+# generations run on threadpool threads here, so per-thread shards keep recording lock-free.
+class _Sharded:
+    """
+    A fixed-size list of numbers with one copy per thread. Only the owning thread
+    writes its copy, so += never races and recording takes no lock; readers sum.
+    """
+
+    __slots__ = ("size", "_local", "_shards")
+
+    def __init__(self, size: int):
+        self.size = size
+        self._local = threading.local()
+        self._shards: List[list] = []
+
+    def shard(self) -> list:
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = [0] * self.size
+            self._shards.append(values)
+            return values
+
+    def values(self) -> list:
+        total = [0] * self.size
+        for shard in list(self._shards):
+            for i, v in enumerate(shard):
+                total[i] += v
+        return total
+
+
+class _Value(_Sharded):
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount: float = 1) -> None:
+        self.shard()[0] += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.shard()[0] -= amount
+
+
+class _Buckets(_Sharded):
+    """Per-bucket counts (non-cumulative, +Inf last) followed by the sum."""
+
+    __slots__ = ("bounds",)
+
+    def __init__(self, bounds: Sequence[float]):
+        super().__init__(len(bounds) + 2)
+        self.bounds = bounds
+
+    def observe(self, value: float) -> None:
+        shard = self.shard()
+        shard[bisect_left(self.bounds, value)] += 1
+        shard[-1] += value
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Labels, _Sharded] = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values) -> _Sharded:
+        key = tuple("" if v is None else str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children.setdefault(key, self._child())
+        return child
+
+    def _child(self) -> _Sharded:
+        return _Value()
+
+    def series(self) -> Dict[Labels, list]:
+        return {key: child.values() for key, child in list(self._children.items())}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, collect: Optional[Callable[[], Dict[Labels, float]]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.collect = collect
+
+    def series(self) -> Dict[Labels, list]:
+        out = super().series()
+        if self.collect is not None:
+            for key, value in self.collect().items():
+                out[key] = [value]
+        return out
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self) -> _Buckets:
+        return _Buckets(self.buckets)
+
+
+REGISTRY: List[Metric] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _num(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def render() -> str:
+    """Prometheus text format of this process's series."""
+    lines = []
+    for m in REGISTRY:
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        for key, values in sorted(m.series().items()):
+            if isinstance(m, Histogram):
+                cumulative = 0
+                for bound, count in zip((*m.buckets, "+Inf"), values):
+                    cumulative += count
+                    le = 'le="%s"' % ("+Inf" if bound == "+Inf" else _num(bound))
+                    lines.append(f"{m.name}_bucket{_labels(m.labelnames, key, le)} {cumulative}")
+                lines.append(f"{m.name}_sum{_labels(m.labelnames, key)} {_num(values[-1])}")
+                lines.append(f"{m.name}_count{_labels(m.labelnames, key)} {cumulative}")
+            else:
+                lines.append(f"{m.name}{_labels(m.labelnames, key)} {_num(values[0])}")
+    return "\n".join(lines) + "\n"
+
+
+# Names and buckets match fastapi-app so both services share dashboards.
+# There are no plans here; the label is kept (always "none") for the same reason.
+time_to_first_token = Histogram(
+    "chat_time_to_first_token_seconds", "Request start to the first token read from Ollama",
+    ("model", "plan"), buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60),
+)
+inter_token = Histogram(
+    "chat_inter_token_seconds", "Gap between consecutive tokens read from Ollama",
+    ("model", "plan"), buckets=(0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1, 2.5),
+)
+tokens_per_second = Histogram(
+    "chat_tokens_per_second", "Tokens per second after the first token, per completed stream",
+    ("model", "plan"), buckets=(1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200),
+)
+stream_duration = Histogram(
+    "chat_stream_duration_seconds", "Request start to the end of the stream, however it ended",
+    ("model", "plan"), buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+upstream_connect = Histogram(
+    "ollama_connect_seconds", "Time until an Ollama node returned response headers",
+    ("model", "node"), buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+streams_in_flight = Gauge("chat_streams_in_flight", "Streams currently being generated", ("model", "plan"))
+upstream_errors = Counter("chat_upstream_errors_total", "Generations that failed because Ollama was unavailable", ("model", "plan"))
+
+
+class StreamTimer:
+    """Token timings of one stream: token() for every piece, end() once however it ends."""
+
+    def __init__(self, model: str, started: float, plan: str = "none"):
+        self.key = (model, plan)
+        self.started = started
+        self.first: Optional[float] = None
+        self.last = 0.0
+        self.tokens = 0
+        self._gap = inter_token.labels(*self.key)
+        if METRICS_ENABLED:
+            streams_in_flight.labels(*self.key).inc()
+
+    def token(self) -> None:
+        if not METRICS_ENABLED:
+            return
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+            time_to_first_token.labels(*self.key).observe(now - self.started)
+        else:
+            self._gap.observe(now - self.last)
+        self.last = now
+        self.tokens += 1
+
+    def end(self, completed: bool) -> None:
+        if not METRICS_ENABLED:
+            return
+        streams_in_flight.labels(*self.key).dec()
+        stream_duration.labels(*self.key).observe(time.perf_counter() - self.started)
+        if completed and self.tokens > 1 and self.last > self.first:
+            tokens_per_second.labels(*self.key).observe((self.tokens - 1) / (self.last - self.first))
@@ -0,0 +1,146 @@
+import os
+import time
+import logging
+import threading
+from typing import Iterator, List, Optional, Set
+
+import requests
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "5"))
+OLLAMA_BREAKER_FAILURES = int(os.getenv("OLLAMA_BREAKER_FAILURES", "3"))
+OLLAMA_BREAKER_LATENCY = float(os.getenv("OLLAMA_BREAKER_LATENCY", "30"))
+OLLAMA_BREAKER_COOLDOWN = float(os.getenv("OLLAMA_BREAKER_COOLDOWN", "10"))
+OLLAMA_MAX_ATTEMPTS = int(os.getenv("OLLAMA_MAX_ATTEMPTS", "3"))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "60"))
+
+
+class NodeUnavailable(Exception):
+    pass
+
+
+class Node:
+    """One Ollama server with its own breaker: consecutive failures or slow first lines open it."""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+        self.outstanding = 0
+        self.healthy = True
+        self.loaded_models: Set[str] = set()
+        self.failures = 0
+        self.latency: Optional[float] = None
+        self.open_until = 0.0
+
+    def routable(self, now: float) -> bool:
+        return self.healthy and now >= self.open_until
+
+    def success(self, latency: float) -> None:
+        self.failures = 0
+        self.latency = latency if self.latency is None else 0.3 * latency + 0.7 * self.latency
+        if self.latency > OLLAMA_BREAKER_LATENCY:
+            self.trip("latency %.2fs" % self.latency)
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.failures >= OLLAMA_BREAKER_FAILURES:
+            self.trip("%d consecutive failures" % self.failures)
+
+    def trip(self, reason: str) -> None:
+        # After the cooldown the node is routable again; one more failure re-opens it
+        self.open_until = time.monotonic() + OLLAMA_BREAKER_COOLDOWN
+        self.failures = OLLAMA_BREAKER_FAILURES - 1
+        self.latency = None
+        logger.warning("Circuit for %s opened: %s", self.url, reason)
+
+
+class OllamaPool:
+    """
+    Least-outstanding routing over the OLLAMA_HOSTS nodes, with a health-probe
+    thread and failover for requests that haven't produced output yet.
+    """
+
+    def __init__(self, urls: List[str], health_interval: float = OLLAMA_HEALTH_INTERVAL):
+        self.nodes = [Node(u) for u in urls]
+        self._lock = threading.Lock()
+        if health_interval > 0:
+            threading.Thread(target=self._probe_loop, args=(health_interval,), daemon=True).start()
+
+    def _acquire(self, model: str, tried: Set[Node]) -> Optional[Node]:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [n for n in self.nodes if n not in tried and n.routable(now)]
+            candidates = candidates or [n for n in self.nodes if n not in tried]
+            if not candidates:
+                return None
+            node = min(candidates, key=lambda n: (n.outstanding, model not in n.loaded_models))
+            node.outstanding += 1
+            return node
+
+    def _release(self, node: Node) -> None:
+        with self._lock:
+            node.outstanding -= 1
+
+    def stream_lines(self, path: str, payload: dict) -> Iterator[bytes]:
+        """
+        POST a streaming request and yield its non-empty lines. Connection errors,
+        5xx and streams that end before the first line are retried on another node.
+        """
+        model = payload.get("model", "")
+        model = model if ":" in model else model + ":latest"
+        tried: Set[Node] = set()
+        last = "no Ollama hosts configured"
+        for _ in range(min(OLLAMA_MAX_ATTEMPTS, len(self.nodes))):
+            node = self._acquire(model, tried)
+            if node is None:
+                break
+            tried.add(node)
+            started = time.monotonic()
+            first = True
+            try:
+                with node.session.post(
+                    node.url + path, json=payload, stream=True,
+                    timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT),
+                ) as resp:
+                    metrics.upstream_connect.labels(model, node.url).observe(time.monotonic() - started)
+                    if resp.status_code == 404 or resp.status_code >= 500:
+                        raise NodeUnavailable(f"Ollama error {resp.status_code}")
+                    resp.raise_for_status()
+                    for line in resp.iter_lines():
+                        if not line:
+                            continue
+                        if first:
+                            first = False
+                            node.success(time.monotonic() - started)
+                        yield line
+                    if first:
+                        raise NodeUnavailable("stream ended before any output")
+                    return
+            except (requests.ConnectionError, requests.Timeout, NodeUnavailable) as e:
+                if not first:
+                    # Output already went to the client; can't replay it elsewhere
+                    raise
+                node.failure()
+                last = str(e)
+                logger.warning("Ollama node %s failed: %s", node.url, last)
+            finally:
+                self._release(node)
+        raise NodeUnavailable(last)
+
+    def _probe_loop(self, interval: float) -> None:
+        while True:
+            for node in self.nodes:
+                try:
+                    resp = node.session.get(node.url + "/api/ps", timeout=OLLAMA_CONNECT_TIMEOUT)
+                    resp.raise_for_status()
+                    node.loaded_models = {m.get("name") for m in resp.json().get("models", [])}
+                    node.healthy = True
+                except (requests.RequestException, ValueError) as e:
+                    if node.healthy:
+                        logger.warning("Ollama node %s failed health check: %s", node.url, e)
+                    node.healthy = False
+            time.sleep(interval)
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import asyncio
+from typing import AsyncIterator, Iterator, List, Optional
+
+import anyio
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+# A frame is flushed once it holds this many bytes, or when its oldest token has
+# waited this long, whichever comes first; the rest is flushed when the stream ends.
+STREAM_FRAME_BYTES = int(os.getenv("STREAM_FRAME_BYTES", "512"))
+STREAM_FRAME_INTERVAL = float(os.getenv("STREAM_FRAME_INTERVAL", "0.05"))
+
+_END = object()
+
+
+async def coalesce(pieces: Iterator[str], max_bytes: int = STREAM_FRAME_BYTES, interval: float = STREAM_FRAME_INTERVAL) -> AsyncIterator[str]:
+    """
+    Join token fragments from a blocking iterator, read in the threadpool, into fewer,
+    larger frames. A buffered token goes out within `interval` even when the next
+    one is slow to come. Closing this generator closes `pieces`, once a read in
+    progress has returned.
+    """
+    buf: List[str] = []
+    size = 0
+    deadline = 0.0
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(run_in_threadpool(next, pieces, _END))
+            # Never cancelled: a blocking read can't be interrupted, only waited for
+            done, _ = await asyncio.wait({pending}, timeout=max(deadline - time.monotonic(), 0) if buf else None)
+            if not done:
+                yield "".join(buf)
+                buf, size = [], 0
+                continue
+            piece, pending = pending.result(), None
+            if piece is _END:
+                break
+            if not buf:
+                deadline = time.monotonic() + interval
+            buf.append(piece)
+            size += len(piece)
+            if size >= max_bytes:
+                yield "".join(buf)
+                buf, size = [], 0
+        if buf:
+            yield "".join(buf)
+    finally:
+        # Shielded: this also runs while the response is being cancelled
+        with anyio.CancelScope(shield=True):
+            if pending is not None:
+                await asyncio.wait({pending})
+            close = getattr(pieces, "close", None)
+            if close is not None:
+                await run_in_threadpool(close)
+
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def usage(final: dict) -> dict:
+    """Usage stats from Ollama's done frame."""
+    completion = final.get("eval_count") or 0
+    eval_ns = final.get("eval_duration") or 0
+    return {
+        "prompt_tokens": final.get("prompt_eval_count") or 0,
+        "completion_tokens": completion,
+        "total_ms": round((final.get("total_duration") or 0) / 1e6, 1),
+        "tokens_per_second": round(completion / (eval_ns / 1e9), 2) if eval_ns else None,
+    }
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse that stops as soon as the client disconnects and always
+    closes its body, so an abandoned generation is aborted right away.
+    """
+
+    async def __call__(self, scope, receive, send) -> None:
+        # Starlette only listens for http.disconnect below ASGI spec 2.4; on newer
+        # servers a gone client would go unnoticed until the next write fails.
+        if scope["type"] == "http":
+            scope = {**scope, "asgi": {**scope.get("asgi", {}), "spec_version": "2.3"}}
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
@@ -0,0 +1,82 @@
+import asyncio
+import importlib.util
+import threading
+import time
+from pathlib import Path
+
+# Loaded by path: fastapi-app has its own stream_format module
+_spec = importlib.util.spec_from_file_location(
+    "ai_service_stream_format", Path(__file__).resolve().parents[1] / "stream_format.py",
+)
+stream_format = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(stream_format)
+
+
+def _slow(pieces, delay):
+    for piece in pieces:
+        time.sleep(delay)
+        yield piece
+
+
+def _frames(pieces, **kwargs):
+    async def main():
+        return [frame async for frame in stream_format.coalesce(pieces, **kwargs)]
+    return asyncio.run(main())
+
+
+def test_token_after_a_slow_gap_is_sent_at_once():
+    # Each token lands more than `interval` after the previous one, so none waits for the next
+    assert _frames(_slow(["a", "b", "c"], 0.03), max_bytes=512, interval=0.02) == ["a", "b", "c"]
+
+
+def test_buffered_token_is_flushed_while_the_next_one_is_slow():
+    def stalls():
+        yield "a"
+        time.sleep(0.5)
+        yield "b"
+
+    async def main():
+        started = time.monotonic()
+        frames = stream_format.coalesce(stalls(), max_bytes=512, interval=0.05)
+        first = await frames.__anext__()
+        waited = time.monotonic() - started
+        rest = [frame async for frame in frames]
+        return first, waited, rest
+
+    first, waited, rest = asyncio.run(main())
+    assert first == "a" and waited < 0.3
+    assert rest == ["b"]
+
+
+def test_fast_tokens_are_joined_until_size_or_end():
+    assert _frames(iter(["ab", "cd", "e"]), max_bytes=4, interval=60) == ["abcd", "e"]
+
+
+def test_cancelled_mid_read_closes_the_source_once_the_read_returns():
+    reading = threading.Event()
+    closed = []
+
+    def pieces():
+        try:
+            yield "a"
+            reading.set()
+            time.sleep(0.1)
+            yield "b"
+            yield "never read"
+        finally:
+            closed.append(True)
+
+    async def main():
+        frames = stream_format.coalesce(pieces(), max_bytes=1, interval=60)
+        assert await frames.__anext__() == "a"
+        task = asyncio.ensure_future(frames.__anext__())
+        await asyncio.get_running_loop().run_in_executor(None, reading.wait)
+        task.cancel()  # the client went away while a token was being read
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return task.cancelled()
+
+    assert asyncio.run(main()) is True
+    assert closed == [True]
@@ -0,0 +1,113 @@
+import importlib
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+AI_SERVICE = str(Path(__file__).resolve().parents[1])
+_NAMES = ("metrics", "ollama_pool", "conversation_store", "context_window")
+
+
+def _load():
+    # fastapi-app has modules of the same names: import ours, then put theirs back
+    saved = {name: sys.modules.pop(name) for name in _NAMES if name in sys.modules}
+    sys.path.insert(0, AI_SERVICE)
+    try:
+        return [importlib.import_module(name) for name in ("conversation_store", "context_window")]
+    finally:
+        sys.path.remove(AI_SERVICE)
+        for name in _NAMES:
+            sys.modules.pop(name, None)
+        sys.modules.update(saved)
+
+
+conversation_store, context_window = _load()
+
+
+class SummaryPool:
+    """Answers summary requests with `text`, after `before()` (to interleave other writes)."""
+
+    def __init__(self, text, before=lambda: None):
+        self.text = text
+        self.before = before
+        self.calls = 0
+
+    def stream_lines(self, path, payload):
+        self.calls += 1
+        self.before()
+        yield json.dumps({"response": self.text}).encode()
+
+
+def _msg(i):
+    return {"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i} " + "x" * 40}
+
+
+def _store(backend):
+    if backend == "memory":
+        return conversation_store.MemoryConversationStore(max_messages=8)
+    fakeredis = pytest.importorskip("fakeredis")  # with lupa, for the Lua scripts
+    return conversation_store.RedisConversationStore(fakeredis.FakeRedis(), max_messages=8)
+
+
+@pytest.mark.parametrize("backend", ["memory", "redis"])
+def test_compact_drops_only_what_is_left_of_the_summarized_messages(backend):
+    store = _store(backend)
+    store.append("c", *(_msg(i) for i in range(8)))
+    # 0-4 fall out of the window; while they are summarized two new messages arrive
+    # and the cap pushes out 0 and 1, so a count-based trim would also drop 5 and 6
+    pool = SummaryPool("the summary", before=lambda: store.append("c", _msg(8), _msg(9)))
+    window = context_window.ContextWindow(store, pool, budget=60, summary_min_tokens=1)
+
+    window.maybe_summarize("c")
+    window._executor.shutdown(wait=True)
+
+    assert pool.calls == 1
+    assert store.get_summary("c") == "the summary"
+    assert store.get("c") == [_msg(i) for i in range(5, 10)]
+
+
+@pytest.mark.parametrize("backend", ["memory", "redis"])
+def test_summary_is_discarded_when_history_no_longer_lines_up(backend):
+    store = _store(backend)
+    store.append("c", *(_msg(i) for i in range(6)))
+
+    def cleared():
+        store.clear("c")
+        store.append("c", _msg(100))
+
+    window = context_window.ContextWindow(store, SummaryPool("stale", before=cleared), budget=30, summary_min_tokens=1)
+    window.maybe_summarize("c")
+    window._executor.shutdown(wait=True)
+
+    assert store.get_summary("c") == ""
+    assert store.get("c") == [_msg(100)]
+
+
+@pytest.mark.parametrize("backend", ["memory", "redis"])
+def test_one_summary_at_a_time_per_conversation(backend):
+    store = _store(backend)
+    store.append("c", *(_msg(i) for i in range(6)))
+    other = context_window.ContextWindow(store, SummaryPool("other"), budget=30, summary_min_tokens=1)
+    pool = SummaryPool("mine")
+    window = context_window.ContextWindow(store, pool, budget=30, summary_min_tokens=1)
+
+    token = store.lock("c", 60)
+    window.maybe_summarize("c")
+    window._executor.shutdown(wait=True)
+    assert pool.calls == 0
+
+    store.unlock("c", token)
+    other.maybe_summarize("c")
+    other._executor.shutdown(wait=True)
+    assert store.get_summary("c") == "other"
+    assert store.lock("c", 60) is not None
+
+
+def test_a_store_must_implement_every_operation():
+    class Partial(conversation_store.ConversationStore):
+        def get(self, conversation_id):
+            return []
+
+    with pytest.raises(TypeError, match="abstract"):
+        Partial()
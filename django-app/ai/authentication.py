@@ -0,0 +1,14 @@
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from . import tracing
+
+
+class TracedJWTAuthentication(JWTAuthentication):
+    """SimpleJWT authentication with an `auth` span around token validation and the user lookup."""
+
+    def authenticate(self, request):
+        with tracing.span("auth") as span:
+            result = super().authenticate(request)
+            if result is not None:
+                span.set("user_id", result[0].pk)
+            return result
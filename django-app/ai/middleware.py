@@ -1,5 +1,20 @@
+import json
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from . import profiler, request_stats, tracing
 from .logging_utils import set_request_id
 
+request_logger = logging.getLogger("ai.requests")
+slow_logger = logging.getLogger("ai.slow")
+
 class RequestIDMiddleware:
     """
     Each request gets a unique request_id (UUID).
@@ -12,4 +27,124 @@ class RequestIDMiddleware:
     def __call__(self, request):
         # Assign a unique request_id before processing the request
         request.id = set_request_id()
-        return self.get_response(request)
\ No newline at end of file
+        return self.get_response(request)
+
+class TracingMiddleware:
+    """
+    Root span of each request (first in MIDDLEWARE, so it covers the whole stack),
+    continuing the caller's `traceparent`. Every DB query in the request gets a
+    child span; the trace context goes back as `traceresponse`.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with tracing.span(request.method, tracing.SERVER, traceparent=request.headers.get("traceparent")) as root:
+            root.set("http.method", request.method)
+            root.set("http.target", request.path)
+            if root.sampled:
+                with connection.execute_wrapper(self._trace_query):
+                    response = self.get_response(request)
+            else:
+                response = self.get_response(request)
+            match = getattr(request, "resolver_match", None)
+            root.name = f"{request.method} /{match.route}" if match is not None and match.route else f"{request.method} {request.path}"
+            root.set("http.status_code", response.status_code)
+            root.set("request_id", getattr(request, "id", "-"))
+            response["traceresponse"] = root.traceparent
+            return response
+
+    @staticmethod
+    def _trace_query(execute, sql, params, many, context):
+        with tracing.span("db.query", tracing.CLIENT, **{"db.statement": sql[:1000], "db.many": many}):
+            return execute(sql, params, many, context)
+
+
+class RequestStatsMiddleware:
+    """
+    Per request: SQL query count and time, view time and total time, logged in one
+    request-ID-tagged line (and as a Server-Timing header if REQUEST_STATS_HEADER).
+    Requests over SLOW_REQUEST_MS or SLOW_REQUEST_QUERIES are sampled to the slow
+    log (`ai.slow`) with their slowest queries and where they were issued.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = request_stats.begin()
+        stats = request_stats.current()
+        try:
+            with connection.execute_wrapper(stats.execute_wrapper):
+                response = self.get_response(request)
+            total = stats.elapsed()
+            request_logger.info(
+                "%s %s %s %.1fms (view %.1fms, %s queries %.1fms)",
+                request.method, request.path, response.status_code,
+                total * 1000, stats.view_time * 1000, stats.queries, stats.db_time * 1000,
+            )
+            if settings.REQUEST_STATS_HEADER:
+                response["Server-Timing"] = stats.server_timing(total)
+            slow = total * 1000 >= settings.SLOW_REQUEST_MS or stats.queries >= settings.SLOW_REQUEST_QUERIES
+            if slow and random.random() < settings.SLOW_LOG_SAMPLE_RATE:
+                slow_logger.warning(json.dumps({
+                    "request_id": getattr(request, "id", "-"),
+                    "method": request.method,
+                    "path": request.path,
+                    "status": response.status_code,
+                    "total_ms": round(total * 1000, 1),
+                    "view_ms": round(stats.view_time * 1000, 1),
+                    "db_ms": round(stats.db_time * 1000, 1),
+                    "queries": stats.queries,
+                    "slowest": stats.slow_queries(),
+                }))
+            return response
+        finally:
+            request_stats.finish(token)
+
+
+class ProfilingMiddleware:
+    """
+    Samples one request's thread when it is sent with `X-Profile` by a staff user
+    (admin session or JWT, hence after AuthenticationMiddleware). The profile id
+    goes back as `X-Profile-Id`; other requests only pay the header lookup.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not (settings.PROFILING_ENABLED and request.headers.get("X-Profile")) or not self._is_staff(request):
+            return self.get_response(request)
+        profile = profiler.Profile(settings.PROFILE_MAX_SECONDS, thread_id=threading.get_ident()).start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profile.stop()
+            profiler.save(profile)
+        response["X-Profile-Id"] = profile.id
+        return response
+
+    @staticmethod
+    def _is_staff(request) -> bool:
+        if request.user.is_staff:
+            return True
+        try:
+            result = JWTAuthentication().authenticate(request)
+        except AuthenticationFailed:
+            return False
+        return result is not None and result[0].is_staff
+
+
+class ViewTimingMiddleware:
+    """Last in MIDDLEWARE: times the view alone (span and request stats), apart from the middleware stack."""
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        try:
+            with tracing.span("view"):
+                return self.get_response(request)
+        finally:
+            stats = request_stats.current()
+            if stats is not None:
+                stats.view_time = time.perf_counter() - start
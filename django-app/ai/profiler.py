@@ -0,0 +1,154 @@
+"""
+On-demand sampling profiler, the Django half of fastapi-app/profiler.py (keep the two in sync).
+
+Nothing runs until a profile is asked for. Then a daemon thread reads every
+thread's stack (sys._current_frames()) each PROFILE_INTERVAL and counts them
+as collapsed stacks, one "frame;frame;frame count" line per distinct stack:
+the input of flamegraph.pl, speedscope, inferno and friends. Results are kept
+in Redis for PROFILE_RESULT_TTL so any worker can serve them.
+
+Two ways in (staff only):
+- POST /debug/profile/ {"seconds": N}: everything this worker does for the next
+  N seconds (ai.views.ProfileView);
+- a request sent with `X-Profile: 1`: that request's thread while it is handled
+  (ai.middleware.ProfilingMiddleware).
+
+In-process (benchmarks, scripts): `with Profile(seconds) as p: ...`, then p.collapsed().
+"""
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from types import CodeType
+from typing import Dict, Optional
+
+from django.conf import settings
+
+from users.entitlements import get_redis
+
+logger = logging.getLogger(__name__)
+
+PROFILE_KEY = "profile:{id}"  # hash: status, pid, samples, seconds, stacks
+
+# Longest first, so frames are labelled relative to the most specific sys.path entry
+_ROOTS = sorted({p for p in sys.path if p}, key=len, reverse=True)
+_labels: Dict[CodeType, str] = {}
+
+
+def _label(code: CodeType) -> str:
+    label = _labels.get(code)
+    if label is None:
+        filename = code.co_filename
+        for root in _ROOTS:
+            if filename.startswith(root + os.sep):
+                filename = filename[len(root) + 1:]
+                break
+        label = _labels[code] = f"{code.co_name} ({filename}:{code.co_firstlineno})"
+    return label
+
+
+class Profile:
+    """One sampling run: start(), then stop() or let `seconds` run out."""
+
+    def __init__(self, seconds: float, interval: Optional[float] = None, thread_id: Optional[int] = None):
+        self.id = uuid.uuid4().hex
+        self.seconds = min(seconds, settings.PROFILE_MAX_SECONDS)
+        self.interval = interval or settings.PROFILE_INTERVAL
+        self.thread_id = thread_id  # only this thread's stacks, else every thread's
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.started = 0.0
+        self.elapsed = 0.0
+        self.save_when_done = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "Profile":
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def __enter__(self) -> "Profile":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def _run(self) -> None:
+        deadline = self.started + self.seconds
+        try:
+            while not self._stop.wait(self.interval):
+                self._sample()
+                if time.monotonic() >= deadline:
+                    break
+        finally:
+            self.elapsed = time.monotonic() - self.started
+        if self.save_when_done:
+            save(self)
+
+    def _sample(self) -> None:
+        frames = sys._current_frames()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        me = threading.get_ident()
+        for ident, frame in frames.items():
+            if ident == me or (self.thread_id is not None and ident != self.thread_id):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread"))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+
+_worker_profile: Optional[Profile] = None
+_worker_lock = threading.Lock()
+
+
+def start_worker_profile(seconds: float) -> Optional[Profile]:
+    """Sample the whole process for `seconds`, saved to Redis when done; None if one is already running."""
+    global _worker_profile
+    with _worker_lock:
+        if _worker_profile is not None and _worker_profile.running:
+            return None
+        profile = _worker_profile = Profile(seconds)
+    key = PROFILE_KEY.format(id=profile.id)
+    get_redis().pipeline().hset(key, mapping={"status": "running", "pid": os.getpid()}).expire(key, settings.PROFILE_RESULT_TTL).execute()
+    profile.save_when_done = True
+    return profile.start()
+
+
+def save(profile: Profile) -> None:
+    key = PROFILE_KEY.format(id=profile.id)
+    try:
+        get_redis().pipeline().hset(key, mapping={
+            "status": "done",
+            "pid": os.getpid(),
+            "samples": profile.samples,
+            "seconds": round(profile.elapsed, 3),
+            "stacks": profile.collapsed(),
+        }).expire(key, settings.PROFILE_RESULT_TTL).execute()
+    except Exception as e:
+        logger.warning("Could not save profile %s: %s", profile.id, e)
+
+
+def load(profile_id: str) -> Optional[dict]:
+    raw = get_redis().hgetall(PROFILE_KEY.format(id=profile_id))
+    return {k.decode(): v.decode() for k, v in raw.items()} or None
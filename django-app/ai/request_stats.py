@@ -0,0 +1,89 @@
+"""
+Per-request DB and latency numbers, collected by ai.middleware.RequestStatsMiddleware.
+
+Every query is timed through a connection execute wrapper (two clock reads and
+an add). Only queries that make it into the request's slowest few have their
+SQL and call site kept, so the stack walk is paid a handful of times per request.
+"""
+import contextvars
+import os
+import sys
+import sysconfig
+import time
+from typing import List, Optional
+
+from django.conf import settings
+
+TOP_QUERIES = 3
+SQL_MAX_CHARS = 500
+
+# Frames skipped when looking for the code that issued a query: the standard
+# library, installed packages (Django, DRF...) and the DB hooks themselves
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_SKIP_PREFIXES = tuple({sysconfig.get_paths()[k] + os.sep for k in ("stdlib", "purelib", "platlib")})
+_SKIP_FILES = {os.path.join(_HERE, name) for name in ("request_stats.py", "tracing.py", "middleware.py")}
+
+_current: contextvars.ContextVar[Optional["RequestStats"]] = contextvars.ContextVar("request_stats", default=None)
+
+
+def call_site() -> str:
+    """`path:line in function` of the innermost frame in our own code."""
+    frame = sys._getframe(1)
+    root = str(settings.BASE_DIR.parent) + os.sep
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not filename.startswith(_SKIP_PREFIXES) and filename not in _SKIP_FILES:
+            return f"{filename.removeprefix(root)}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "-"
+
+
+class RequestStats:
+    __slots__ = ("started", "queries", "db_time", "view_time", "slowest")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.view_time = 0.0
+        self.slowest: List[tuple] = []  # (seconds, sql, call site), slowest first
+
+    def record(self, sql: str, elapsed: float) -> None:
+        self.queries += 1
+        self.db_time += elapsed
+        if len(self.slowest) < TOP_QUERIES or elapsed > self.slowest[-1][0]:
+            self.slowest.append((elapsed, sql[:SQL_MAX_CHARS], call_site()))
+            self.slowest.sort(key=lambda q: q[0], reverse=True)
+            del self.slowest[TOP_QUERIES:]
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record(sql, time.perf_counter() - start)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self, total: float) -> str:
+        """Server-Timing header value (shown per request in browser devtools)."""
+        return (
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries", '
+            f"view;dur={self.view_time * 1000:.1f}, total;dur={total * 1000:.1f}"
+        )
+
+    def slow_queries(self) -> List[dict]:
+        return [{"ms": round(t * 1000, 2), "sql": sql, "at": site} for t, sql, site in self.slowest]
+
+
+def current() -> Optional[RequestStats]:
+    return _current.get()
+
+
+def begin() -> contextvars.Token:
+    return _current.set(RequestStats())
+
+
+def finish(token: contextvars.Token) -> None:
+    _current.reset(token)
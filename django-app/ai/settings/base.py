@@ -33,15 +33,19 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "ai.middleware.TracingMiddleware",
+    "ai.middleware.RequestStatsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "ai.middleware.ProfilingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 
      "ai.middleware.RequestIDMiddleware",
+    "ai.middleware.ViewTimingMiddleware",
 ]
 
 ROOT_URLCONF = "ai.urls"
@@ -66,7 +70,7 @@ WSGI_APPLICATION = "ai.wsgi.application"
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "ai.authentication.TracedJWTAuthentication",
     ),
     "EXCEPTION_HANDLER": "ai.utils.custom_exception_handler",  
      "DEFAULT_THROTTLE_CLASSES": [
@@ -82,6 +86,34 @@ REST_FRAMEWORK = {
     },
 }
 
+# Redis (shared with fastapi-app): plan entitlements are published here
+REDIS_URL = env("REDIS_URL", default="redis://redis:6379/0")
+ENTITLEMENTS_SYNC_ENABLED = env.bool("ENTITLEMENTS_SYNC_ENABLED", default=True)
+
+# Request tracing (ai/tracing.py): spans go to TRACE_OTLP_ENDPOINT if set, else to TRACE_FILE
+# if set, else nowhere. TRACE_FILE is rotated to TRACE_FILE.1 at TRACE_FILE_MAX_BYTES (0 = unbounded).
+TRACING_ENABLED = env.bool("TRACING_ENABLED", default=True)
+TRACE_SERVICE_NAME = "django"
+TRACE_SAMPLE_RATE = env.float("TRACE_SAMPLE_RATE", default=1.0)
+TRACE_OTLP_ENDPOINT = env("TRACE_OTLP_ENDPOINT", default="")
+TRACE_FILE = env("TRACE_FILE", default="")
+TRACE_FILE_MAX_BYTES = env.int("TRACE_FILE_MAX_BYTES", default=100 * 1024 * 1024)
+TRACE_EXPORT_INTERVAL = env.float("TRACE_EXPORT_INTERVAL", default=2.0)
+TRACE_BATCH_SIZE = env.int("TRACE_BATCH_SIZE", default=512)
+TRACE_MAX_BUFFER = env.int("TRACE_MAX_BUFFER", default=20000)
+
+# Per-request DB/latency stats (ai.middleware.RequestStatsMiddleware)
+REQUEST_STATS_HEADER = env.bool("REQUEST_STATS_HEADER", default=False)
+SLOW_REQUEST_MS = env.float("SLOW_REQUEST_MS", default=500.0)
+SLOW_REQUEST_QUERIES = env.int("SLOW_REQUEST_QUERIES", default=20)
+SLOW_LOG_SAMPLE_RATE = env.float("SLOW_LOG_SAMPLE_RATE", default=1.0)
+
+# On-demand sampling profiler (ai/profiler.py), staff only
+PROFILING_ENABLED = env.bool("PROFILING_ENABLED", default=True)
+PROFILE_INTERVAL = env.float("PROFILE_INTERVAL", default=0.005)  # 200 samples/s
+PROFILE_MAX_SECONDS = env.float("PROFILE_MAX_SECONDS", default=60.0)
+PROFILE_RESULT_TTL = env.int("PROFILE_RESULT_TTL", default=3600)
+
 AUTH_PASSWORD_VALIDATORS = [
     {"NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator"},
     {"NAME": "django.contrib.auth.password_validation.MinimumLengthValidator"},
@@ -99,28 +131,56 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Logging (ai/logging_utils.py): handlers write on background threads, never in the request
+LOG_FORMAT = env("LOG_FORMAT", default="json")  # or "text"
+LOG_QUEUE_MAX = env.int("LOG_QUEUE_MAX", default=0)  # > 0: bounded, drops the oldest records when full
+LOG_SAMPLE_RATES = env("LOG_SAMPLE_RATES", default="")  # e.g. "ai.requests=0.1"
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
+    "filters": {
+        "request_id": {"()": "ai.logging_utils.RequestIDFilter"},
+        "sampling": {"()": "ai.logging_utils.SamplingFilter", "rates": LOG_SAMPLE_RATES},
+    },
     "formatters": {
         "simple": {
-            "format": "[{asctime}] {levelname} {name}: {message}",
+            "format": "[{asctime}] {levelname} {name} [rid={request_id}]: {message}",
             "style": "{",
         },
+        "json": {"()": "ai.logging_utils.JSONFormatter"},
     },
     "handlers": {
         "console": {
-            "class": "logging.StreamHandler",
-            "formatter": "simple",
+            "()": "ai.logging_utils.queued",
+            "max_size": LOG_QUEUE_MAX,
+            "formatter": "json" if LOG_FORMAT == "json" else "simple",
+            "filters": ["sampling", "request_id"],
         },
         "error_console": {
-            "class": "logging.StreamHandler",
-            "formatter": "simple",
+            "()": "ai.logging_utils.queued",
+            "max_size": LOG_QUEUE_MAX,
+            "formatter": "json" if LOG_FORMAT == "json" else "simple",
+            "filters": ["request_id"],
             "level": "ERROR",
         },
+        "slow_file": {
+            "()": "ai.logging_utils.queued",
+            "target": "logging.handlers.RotatingFileHandler",
+            "max_size": LOG_QUEUE_MAX,
+            "filename": LOG_DIR / "slow.log",
+            "maxBytes": 10 * 1024 * 1024,
+            "backupCount": 3,
+            "formatter": "simple",
+            "filters": ["request_id"],
+        },
+    },
+    "loggers": {
+        # Slow requests also get their own file, easy to grep and ship
+        "ai.slow": {"handlers": ["slow_file"], "level": "WARNING"},
     },
     "root": {
         "handlers": ["console", "error_console"],
         "level": os.getenv("LOG_LEVEL", "INFO"),
     },
-}
\ No newline at end of file
+}
@@ -19,8 +19,10 @@ DATABASES = {
 
 # Add file logging in dev only
 LOGGING["handlers"]["file"] = {
-    "class": "logging.FileHandler",
+    "()": "ai.logging_utils.queued",
+    "target": "logging.FileHandler",
     "filename": BASE_DIR / "logs/django.log",
     "formatter": "simple",
+    "filters": ["request_id"],
 }
 LOGGING["root"]["handlers"].append("file")
\ No newline at end of file
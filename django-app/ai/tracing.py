@@ -0,0 +1,233 @@
+"""
+Lightweight request tracing, the Django half of fastapi-app/tracing.py (keep the two in sync).
+
+Trace context travels in W3C `traceparent` headers: continued from the client
+when it sends one and returned as `traceresponse`, so a client can carry it on
+to the chat service. Finished spans are buffered and exported in batches by a
+background thread as OTLP/JSON, either POSTed to a collector
+(TRACE_OTLP_ENDPOINT) or appended to TRACE_FILE, one batch per line. With
+neither set, trace context is still propagated but no spans are kept.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+import contextvars
+import urllib.request
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "sampled", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool, kind: int = INTERNAL):
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = {}
+        self.error = None
+
+    def set(self, key: str, value) -> None:
+        if self.sampled:
+            self.attributes[key] = value
+
+    def end(self, error: Optional[str] = None) -> None:
+        if self.end_ns:
+            return
+        self.end_ns = time.time_ns()
+        if error:
+            self.error = error
+        if self.sampled:
+            exporter.add(self)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[tuple]:
+    """(trace_id, parent span id, sampled) from a W3C traceparent, or None if invalid."""
+    parts = (value or "").strip().split("-")
+    if len(parts) < 4 or len(parts[0]) != 2 or parts[0] == "ff" or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        flags = int(parts[3][:2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1].lower(), parts[2].lower(), bool(flags & 1)
+
+
+def start_span(name: str, parent: Optional[Span] = None, traceparent: Optional[str] = None, kind: int = INTERNAL) -> Span:
+    """A span under `parent`, else under a remote `traceparent`, else the root of a new trace."""
+    if parent is not None:
+        return Span(name, parent.trace_id, parent.span_id, parent.sampled, kind)
+    remote = parse_traceparent(traceparent)
+    if remote is not None:
+        return Span(name, remote[0], remote[1], remote[2] and settings.TRACING_ENABLED, kind)
+    sampled = settings.TRACING_ENABLED and random.random() < settings.TRACE_SAMPLE_RATE
+    return Span(name, "%032x" % random.getrandbits(128), None, sampled, kind)
+
+
+def current() -> Optional[Span]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, kind: int = INTERNAL, parent: Optional[Span] = None, traceparent: Optional[str] = None, **attributes) -> Iterator[Span]:
+    """
+    A span for the duration of the block, made current; child of `parent`, else of
+    the current span unless a remote `traceparent` is given. Exceptions mark it failed.
+    """
+    if parent is None and traceparent is None:
+        parent = current()
+    s = start_span(name, parent, traceparent, kind)
+    for k, v in attributes.items():
+        s.set(k, v)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.end(error=f"{e.__class__.__name__}: {e}")
+        raise
+    finally:
+        _current.reset(token)
+        s.end()
+
+
+def _value(v) -> dict:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+
+def _otlp(span: Span) -> dict:
+    out = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": span.kind,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": [{"key": k, "value": _value(v)} for k, v in span.attributes.items()],
+        "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+    }
+    if span.parent_id:
+        out["parentSpanId"] = span.parent_id
+    return out
+
+
+def encode(spans) -> str:
+    """One OTLP/JSON ExportTraceServiceRequest."""
+    return json.dumps({
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": settings.TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [_otlp(s) for s in spans]}],
+        }]
+    }, separators=(",", ":"))
+
+
+class SpanExporter:
+    """
+    Finished spans, buffered in memory and shipped by a daemon thread in batches,
+    so requests never wait on the sink. The thread is started lazily per process
+    (gunicorn forks workers after import).
+    """
+
+    def __init__(self):
+        self._spans = deque()
+        self._wake = threading.Event()
+        self._pid = None
+        self._lock = threading.Lock()
+        self.exported = 0
+        self.dropped = 0
+
+    def add(self, span: Span) -> None:
+        if not exporting():
+            return
+        if self._pid != os.getpid():
+            self._start()
+        self._spans.append(span)
+        while len(self._spans) > settings.TRACE_MAX_BUFFER:
+            self._spans.popleft()
+            self.dropped += 1
+        if len(self._spans) >= settings.TRACE_BATCH_SIZE:
+            self._wake.set()
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="span-exporter", daemon=True).start()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(settings.TRACE_EXPORT_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        while self._spans:
+            batch = []
+            while self._spans and len(batch) < settings.TRACE_BATCH_SIZE:
+                batch.append(self._spans.popleft())
+            payload = encode(batch)
+            try:
+                if settings.TRACE_OTLP_ENDPOINT:
+                    req = urllib.request.Request(
+                        settings.TRACE_OTLP_ENDPOINT, data=payload.encode("utf-8"),
+                        headers={"Content-Type": "application/json"}, method="POST",
+                    )
+                    urllib.request.urlopen(req, timeout=5).close()
+                else:
+                    _append(settings.TRACE_FILE, payload, settings.TRACE_FILE_MAX_BYTES)
+            except Exception as e:
+                # Spans are diagnostics: drop the batch rather than pile up behind a dead sink
+                self.dropped += len(batch)
+                logger.warning("Span export failed, %s spans dropped: %s", len(batch), e)
+                return
+            self.exported += len(batch)
+
+
+def exporting() -> bool:
+    """Whether finished spans have somewhere to go."""
+    return bool(settings.TRACE_OTLP_ENDPOINT or settings.TRACE_FILE)
+
+
+def _append(path: str, line: str, max_bytes: int = 0) -> None:
+    if max_bytes > 0:
+        try:
+            if os.path.getsize(path) + len(line) + 1 > max_bytes:
+                os.replace(path, path + ".1")
+        except FileNotFoundError:
+            pass
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+exporter = SpanExporter()
@@ -17,7 +17,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from .views import ProfileView, ProfileResultView
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path("auth/", include("users.urls")),
+    path("debug/profile/", ProfileView.as_view(), name="profile"),
+    path("debug/profile/<str:profile_id>/", ProfileResultView.as_view(), name="profile-result"),
 ]
@@ -0,0 +1,50 @@
+import math
+import os
+
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework import permissions, status
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from . import profiler
+
+
+class ProfileView(APIView):
+    """
+    Staff only. POST {"seconds": N}: sample everything this worker does for the
+    next N seconds (capped at PROFILE_MAX_SECONDS); the result is then served by
+    ProfileResultView under the returned id.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def post(self, request):
+        if not settings.PROFILING_ENABLED:
+            raise NotFound("Profiling is disabled.")
+        try:
+            seconds = float(request.data.get("seconds", 10))
+        except (TypeError, ValueError):
+            raise ValidationError({"seconds": "Must be a number."})
+        if not math.isfinite(seconds) or seconds <= 0:
+            raise ValidationError({"seconds": "Must be a positive number."})
+        profile = profiler.start_worker_profile(seconds)
+        if profile is None:
+            return Response({"error": "A profile is already running in this worker."}, status=status.HTTP_409_CONFLICT)
+        return Response({"id": profile.id, "pid": os.getpid(), "seconds": profile.seconds}, status=status.HTTP_202_ACCEPTED)
+
+
+class ProfileResultView(APIView):
+    """Staff only. Collapsed stacks of a finished profile (text/plain), or 202 while it runs."""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, profile_id):
+        result = profiler.load(profile_id)
+        if result is None:
+            raise NotFound("Profile not found.")
+        if result["status"] != "done":
+            return Response({"status": result["status"], "pid": int(result["pid"])}, status=status.HTTP_202_ACCEPTED)
+        return HttpResponse(
+            result["stacks"], content_type="text/plain; charset=utf-8",
+            headers={"X-Profile-Samples": result["samples"], "X-Profile-Seconds": result["seconds"]},
+        )
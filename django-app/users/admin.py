@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import User, SubscriptionPlan, Subscription
+from .models import User, SubscriptionPlan, Subscription, TokenUsage
 
 
 @admin.register(User)
@@ -34,3 +34,11 @@ class SubscriptionAdmin(admin.ModelAdmin):
     list_display = ("id", "user", "plan", "is_active", "start_date", "end_date")
     list_filter = ("is_active", "plan")
     search_fields = ("user__email",)
+
+
+@admin.register(TokenUsage)
+class TokenUsageAdmin(admin.ModelAdmin):
+    list_display = ("id", "user", "period_start", "model", "service", "requests", "prompt_tokens", "completion_tokens")
+    list_filter = ("service", "model")
+    search_fields = ("user__email",)
+    date_hierarchy = "period_start"
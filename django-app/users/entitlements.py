@@ -0,0 +1,126 @@
+"""
+Publishes plan entitlements to Redis for the chat service (fastapi-app).
+
+Layout (shared with fastapi-app/entitlements.py):
+- ent:plan:<plan_id>      JSON {"id", "slug", "version", "features", "is_active"}
+- ent:users:<shard>       hash user_id -> plan_id ("0" = no active plan)
+- ent:invalidate          pub/sub channel, messages "user:<id>" / "plan:<id>"
+"""
+import json
+import logging
+from typing import Iterable, Optional
+
+import redis
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils.text import slugify
+
+from .models import Subscription, SubscriptionPlan
+
+logger = logging.getLogger(__name__)
+
+PLAN_KEY = "ent:plan:{plan_id}"
+USERS_KEY = "ent:users:{shard}"
+INVALIDATE_CHANNEL = "ent:invalidate"
+USER_SHARD_SIZE = 100
+
+_client: Optional[redis.Redis] = None
+
+
+def get_redis() -> redis.Redis:
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.REDIS_URL, socket_timeout=2)
+    return _client
+
+
+def users_key(user_id) -> str:
+    return USERS_KEY.format(shard=int(user_id) // USER_SHARD_SIZE)
+
+
+def plan_payload(plan: SubscriptionPlan) -> dict:
+    return {
+        "id": plan.id,
+        "slug": plan.slug or slugify(plan.name),
+        "version": plan.entitlements_version,
+        "features": plan.features or {},
+        "is_active": plan.is_active,
+    }
+
+
+def active_plan_id(user_id) -> int:
+    sub = (
+        Subscription.objects.filter(user_id=user_id, is_active=True)
+        .order_by("-start_date")
+        .values_list("plan_id", flat=True)
+        .first()
+    )
+    return sub or 0
+
+
+def publish_plan(plan: SubscriptionPlan) -> None:
+    """Write the plan's entitlements and tell chat workers to drop their copy."""
+    if not settings.ENTITLEMENTS_SYNC_ENABLED:
+        return
+    try:
+        pipe = get_redis().pipeline()
+        pipe.set(PLAN_KEY.format(plan_id=plan.id), json.dumps(plan_payload(plan)))
+        pipe.publish(INVALIDATE_CHANNEL, f"plan:{plan.id}")
+        pipe.execute()
+    except redis.RedisError as exc:
+        logger.warning("Entitlements publish failed for plan %s: %s", plan.id, str(exc))
+
+
+def publish_plan_deleted(plan_id: int) -> None:
+    if not settings.ENTITLEMENTS_SYNC_ENABLED:
+        return
+    try:
+        pipe = get_redis().pipeline()
+        pipe.delete(PLAN_KEY.format(plan_id=plan_id))
+        pipe.publish(INVALIDATE_CHANNEL, f"plan:{plan_id}")
+        pipe.execute()
+    except redis.RedisError as exc:
+        logger.warning("Entitlements delete failed for plan %s: %s", plan_id, str(exc))
+
+
+def publish_user(user_id) -> None:
+    """Point the user at their current active plan and invalidate chat-side caches."""
+    if not settings.ENTITLEMENTS_SYNC_ENABLED:
+        return
+    plan_id = active_plan_id(user_id)
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hset(users_key(user_id), str(user_id), plan_id)
+        pipe.publish(INVALIDATE_CHANNEL, f"user:{user_id}")
+        pipe.execute()
+    except redis.RedisError as exc:
+        logger.warning("Entitlements publish failed for user %s: %s", user_id, str(exc))
+
+
+def sync_all(batch_size: int = 1000) -> int:
+    """Backfill every plan and user mapping; returns the number of users written."""
+    r = get_redis()
+    pipe = r.pipeline(transaction=False)
+    for plan in SubscriptionPlan.objects.all():
+        pipe.set(PLAN_KEY.format(plan_id=plan.id), json.dumps(plan_payload(plan)))
+    pipe.execute()
+
+    # Latest active subscription wins, same as User.active_subscription
+    rows: Iterable = (
+        Subscription.objects.filter(is_active=True)
+        .order_by("user_id", "start_date")
+        .values_list("user_id", "plan_id")
+        .iterator(chunk_size=batch_size)
+    )
+    mapping = {}
+    for user_id, plan_id in rows:
+        mapping[user_id] = plan_id
+    count = 0
+    for user_id in get_user_model().objects.values_list("id", flat=True).iterator(chunk_size=batch_size):
+        pipe.hset(users_key(user_id), str(user_id), mapping.get(user_id, 0))
+        count += 1
+        if count % batch_size == 0:
+            pipe.execute()
+    pipe.execute()
+    r.publish(INVALIDATE_CHANNEL, "all")
+    return count
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from users.usage import rollup_usage
+
+
+class Command(BaseCommand):
+    help = "Roll up token usage events from Redis into the TokenUsage table."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--loop", action="store_true", help="Keep running, one rollup every --interval seconds")
+        parser.add_argument("--interval", type=float, default=60)
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                count = rollup_usage(batch_size=options["batch_size"])
+                self.stdout.write(self.style.SUCCESS(f"Rolled up {count} usage events"))
+            except Exception as e:
+                if not options["loop"]:
+                    raise
+                self.stderr.write(f"Usage rollup failed: {e}")
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from users.entitlements import sync_all
+
+
+class Command(BaseCommand):
+    help = "Backfill plan entitlements and user->plan mappings into Redis for the chat service."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = sync_all(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Synced entitlements for {count} users"))
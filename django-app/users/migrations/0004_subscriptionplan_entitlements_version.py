@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_remove_user_otp_secret_subscriptionplan_slug_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriptionplan',
+            name='entitlements_version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
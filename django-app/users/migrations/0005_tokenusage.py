@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 03:25
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_subscriptionplan_entitlements_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period_start', models.DateTimeField(help_text='Start of the UTC hour')),
+                ('model', models.CharField(max_length=100)),
+                ('service', models.CharField(max_length=32)),
+                ('requests', models.PositiveIntegerField(default=0)),
+                ('aborted', models.PositiveIntegerField(default=0, help_text='Generations the client abandoned')),
+                ('prompt_tokens', models.PositiveBigIntegerField(default=0)),
+                ('completion_tokens', models.PositiveBigIntegerField(default=0)),
+                ('rollup_id', models.UUIDField(editable=False)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='token_usage', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'period_start'], name='users_token_user_id_82cad8_idx')],
+                'constraints': [models.UniqueConstraint(fields=('rollup_id', 'user', 'period_start', 'model', 'service'), name='unique_usage_per_rollup')],
+            },
+        ),
+    ]
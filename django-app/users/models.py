@@ -50,9 +50,22 @@ class SubscriptionPlan(models.Model):
 
     is_active = models.BooleanField(default=True)
 
+    # Bumped whenever features/slug/is_active change; embedded in JWT entitlement claims
+    entitlements_version = models.PositiveIntegerField(default=1, editable=False)
+
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if self.pk:
+            old = SubscriptionPlan.objects.filter(pk=self.pk).values("features", "slug", "is_active").first()
+            if old and (old["features"], old["slug"], old["is_active"]) != (self.features, self.slug, self.is_active):
+                self.entitlements_version += 1
+                update_fields = kwargs.get("update_fields")
+                if update_fields is not None:
+                    kwargs["update_fields"] = {*update_fields, "entitlements_version"}
+        super().save(*args, **kwargs)
+
 
     
 # Custom User
@@ -169,3 +182,32 @@ class Subscription(models.Model):
         constraints = [
             models.UniqueConstraint(fields=["user", "plan"], condition=models.Q(is_active=True), name="unique_active_subscription")
         ]
+
+
+# Hourly token usage per user, rolled up from the chat services' metering events
+# (users/usage.py). Several rows can share a (user, hour, model, service): each
+# rollup run inserts its own totals, so reports sum them.
+class TokenUsage(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="token_usage")
+    period_start = models.DateTimeField(help_text="Start of the UTC hour")
+    model = models.CharField(max_length=100)
+    service = models.CharField(max_length=32)
+
+    requests = models.PositiveIntegerField(default=0)
+    aborted = models.PositiveIntegerField(default=0, help_text="Generations the client abandoned")
+    prompt_tokens = models.PositiveBigIntegerField(default=0)
+    completion_tokens = models.PositiveBigIntegerField(default=0)
+
+    # Identifies the rollup run; re-running an interrupted one inserts nothing twice
+    rollup_id = models.UUIDField(editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["rollup_id", "user", "period_start", "model", "service"], name="unique_usage_per_rollup")
+        ]
+        indexes = [
+            models.Index(fields=["user", "period_start"]),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} {self.period_start:%Y-%m-%d %H:00} {self.prompt_tokens}+{self.completion_tokens}"
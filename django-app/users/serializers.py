@@ -1,7 +1,8 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from .models import Subscription, SubscriptionPlan
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from .tokens import EntitlementsRefreshToken
 
 
 User = get_user_model()
@@ -34,10 +35,16 @@ class SignupSerializer(serializers.ModelSerializer):
 
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = EntitlementsRefreshToken
+
     def validate(self, attrs):
         data = super().validate(attrs)
 
         if not self.user.is_verified:
             raise serializers.ValidationError("Account not verified. Please complete OTP verification.")
 
-        return data
\ No newline at end of file
+        return data
+
+
+class EntitlementsTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = EntitlementsRefreshToken
@@ -0,0 +1,24 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Subscription, SubscriptionPlan
+from . import entitlements
+
+
+@receiver(post_save, sender=SubscriptionPlan)
+def plan_saved(sender, instance, **kwargs):
+    transaction.on_commit(lambda: entitlements.publish_plan(instance))
+
+
+@receiver(post_delete, sender=SubscriptionPlan)
+def plan_deleted(sender, instance, **kwargs):
+    plan_id = instance.id
+    transaction.on_commit(lambda: entitlements.publish_plan_deleted(plan_id))
+
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def subscription_changed(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: entitlements.publish_user(user_id))
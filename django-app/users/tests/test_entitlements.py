@@ -0,0 +1,82 @@
+import json
+import pytest
+from django.contrib.auth import get_user_model
+
+from users import entitlements
+from users.models import Subscription, SubscriptionPlan
+
+pytestmark = pytest.mark.django_db
+User = get_user_model()
+
+
+class FakePipeline:
+    def __init__(self, store):
+        self.store = store
+        self.ops = []
+
+    def set(self, key, value):
+        self.ops.append(("set", key, value))
+
+    def delete(self, key):
+        self.ops.append(("delete", key))
+
+    def hset(self, key, field, value):
+        self.ops.append(("hset", key, field, value))
+
+    def publish(self, channel, message):
+        self.ops.append(("publish", channel, message))
+
+    def execute(self):
+        for op, key, *rest in self.ops:
+            if op == "set":
+                self.store[key] = rest[0]
+            elif op == "delete":
+                self.store.pop(key, None)
+            elif op == "hset":
+                self.store.setdefault(key, {})[rest[0]] = rest[1]
+            else:
+                self.store.setdefault("__published__", []).append(rest[0])
+        self.ops = []
+
+
+class FakeRedis:
+    def __init__(self):
+        self.store = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self.store)
+
+    def publish(self, channel, message):
+        self.store.setdefault("__published__", []).append(message)
+
+
+@pytest.fixture
+def fake_redis(monkeypatch, settings):
+    settings.ENTITLEMENTS_SYNC_ENABLED = True
+    fake = FakeRedis()
+    monkeypatch.setattr(entitlements, "get_redis", lambda: fake)
+    return fake
+
+
+def test_plan_save_publishes_entitlements(fake_redis, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks(execute=True):
+        plan = SubscriptionPlan.objects.create(name="Pro", slug="pro", features={"max_messages": 500})
+
+    payload = json.loads(fake_redis.store[f"ent:plan:{plan.id}"])
+    assert payload["slug"] == "pro"
+    assert payload["features"]["max_messages"] == 500
+    assert f"plan:{plan.id}" in fake_redis.store["__published__"]
+
+
+def test_subscription_change_updates_user_mapping(fake_redis, django_capture_on_commit_callbacks):
+    user = User.objects.create_user(email="ent@example.com", password="testpass123")
+    plan = SubscriptionPlan.objects.create(name="Pro", features={"max_messages": 500})
+
+    with django_capture_on_commit_callbacks(execute=True):
+        sub = Subscription.objects.create(user=user, plan=plan, is_active=True)
+    assert fake_redis.store[entitlements.users_key(user.id)][str(user.id)] == plan.id
+
+    with django_capture_on_commit_callbacks(execute=True):
+        sub.cancel()
+    assert fake_redis.store[entitlements.users_key(user.id)][str(user.id)] == 0
+    assert fake_redis.store["__published__"].count(f"user:{user.id}") == 2
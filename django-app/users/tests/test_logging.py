@@ -0,0 +1,71 @@
+import io
+import json
+import logging
+import threading
+
+from ai.logging_utils import JSONFormatter, QueuedHandler, RequestIDFilter, SamplingFilter, set_request_id
+
+
+def _logger(name, handler):
+    logger = logging.getLogger(name)
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def test_queued_json_lines_stay_valid_with_quotes_newlines_and_tracebacks():
+    out = io.StringIO()
+    handler = QueuedHandler(logging.StreamHandler(out))
+    handler.setFormatter(JSONFormatter())
+    handler.addFilter(RequestIDFilter())
+    logger = _logger("test.json", handler)
+    rid = set_request_id()
+
+    logger.info('said "%s"\non two lines', "hi", extra={"user_id": 7})
+    try:
+        raise ValueError("bad")
+    except ValueError:
+        logger.exception("failed")
+    handler.close()
+
+    first, second = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert first["message"] == 'said "hi"\non two lines'
+    assert first["request_id"] == rid and first["user_id"] == 7
+    assert second["level"] == "ERROR" and "ValueError: bad" in second["exc"]
+
+
+def test_sampling_applies_to_child_loggers_and_never_to_warnings():
+    sampling = SamplingFilter("test.hot=0")
+    out = io.StringIO()
+    handler = QueuedHandler(logging.StreamHandler(out))
+    handler.addFilter(sampling)
+
+    _logger("test.hot.usage", handler).info("sampled out")
+    _logger("test.hot", handler).warning("kept warning")
+    _logger("test.cold", handler).info("kept info")
+    handler.close()
+
+    assert out.getvalue().splitlines() == ["kept warning", "kept info"]
+
+
+def test_bounded_queue_drops_oldest_and_says_so():
+    release = threading.Event()
+
+    class Stuck(logging.StreamHandler):
+        def emit(self, record):
+            release.wait()
+            super().emit(record)
+
+    out = io.StringIO()
+    handler = QueuedHandler(Stuck(out), max_size=3)
+    logger = _logger("test.bounded", handler)
+    for i in range(20):
+        logger.info("m%s", i)
+    assert handler.dropped >= 16
+    release.set()
+    handler.close()
+
+    lines = out.getvalue().splitlines()
+    assert any(line.startswith("Log queue full") for line in lines)
+    assert lines[-3:] == ["m17", "m18", "m19"]
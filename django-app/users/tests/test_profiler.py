@@ -0,0 +1,89 @@
+import pytest
+from django.contrib.auth import get_user_model
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from ai import profiler
+
+pytestmark = pytest.mark.django_db
+User = get_user_model()
+
+
+class FakeRedis:
+    def __init__(self):
+        self.store = {}
+
+    def pipeline(self):
+        return self
+
+    def hset(self, key, mapping):
+        self.store.setdefault(key, {}).update({k.encode(): str(v).encode() for k, v in mapping.items()})
+        return self
+
+    def expire(self, key, seconds):
+        return self
+
+    def execute(self):
+        pass
+
+    def hgetall(self, key):
+        return self.store.get(key, {})
+
+
+@pytest.fixture
+def fake_redis(monkeypatch, settings):
+    settings.ENTITLEMENTS_SYNC_ENABLED = False
+    settings.PROFILE_INTERVAL = 0.001
+    fake = FakeRedis()
+    monkeypatch.setattr(profiler, "get_redis", lambda: fake)
+    return fake
+
+
+def _client(user):
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}")
+    return client
+
+
+def test_staff_profiles_the_worker_and_reads_collapsed_stacks(fake_redis):
+    staff = User.objects.create_user(email="ops@example.com", password="testpass123", is_staff=True)
+    member = User.objects.create_user(email="member@example.com", password="testpass123")
+    assert _client(member).post("/debug/profile/", {"seconds": 0.05}, format="json").status_code == 403
+
+    resp = _client(staff).post("/debug/profile/", {"seconds": 0.05}, format="json")
+    assert resp.status_code == 202
+    profiler._worker_profile._thread.join()
+
+    result = _client(staff).get(f"/debug/profile/{resp.data['id']}/")
+    assert result.status_code == 200
+    assert int(result["X-Profile-Samples"]) > 0
+    stack, count = result.content.decode().splitlines()[0].rsplit(" ", 1)
+    assert ";" in stack and int(count) > 0
+
+
+def test_x_profile_header_profiles_one_staff_request(fake_redis):
+    staff = User.objects.create_user(email="ops@example.com", password="testpass123", is_staff=True)
+    member = User.objects.create_user(email="member@example.com", password="testpass123")
+
+    assert "X-Profile-Id" not in _client(member).get("/debug/profile/missing/", HTTP_X_PROFILE="1")
+    resp = _client(staff).get("/debug/profile/missing/", HTTP_X_PROFILE="1")
+    assert resp.status_code == 404
+    assert profiler.load(resp["X-Profile-Id"])["status"] == "done"
+
+
+def test_staff_claim_only_in_staff_tokens(fake_redis):
+    User.objects.create_user(email="ops@example.com", password="testpass123", is_staff=True, is_verified=True)
+    User.objects.create_user(email="member@example.com", password="testpass123", is_verified=True)
+    client = APIClient()
+    for email, staff in (("ops@example.com", True), ("member@example.com", None)):
+        data = client.post("/auth/login/", {"email": email, "password": "testpass123"}, format="json").data
+        assert AccessToken(data["access"]).get("staff") is staff
+
+
+@pytest.mark.parametrize("seconds", [0, -1, "nan", "inf", "-inf", "soon"])
+def test_profile_seconds_must_be_a_positive_number(fake_redis, seconds):
+    staff = User.objects.create_user(email="ops@example.com", password="testpass123", is_staff=True)
+    before = profiler._worker_profile
+    resp = _client(staff).post("/debug/profile/", {"seconds": seconds}, format="json")
+    assert resp.status_code == 400
+    assert profiler._worker_profile is before
@@ -0,0 +1,56 @@
+import json
+import logging
+
+import pytest
+from django.contrib.auth import get_user_model
+from rest_framework.test import APIClient
+
+pytestmark = pytest.mark.django_db
+User = get_user_model()
+
+
+@pytest.fixture
+def login_request(settings):
+    settings.ENTITLEMENTS_SYNC_ENABLED = False
+    User.objects.create_user(email="stats@example.com", password="testpass123")
+
+    def post():
+        return APIClient().post("/auth/login/", {"email": "stats@example.com", "password": "testpass123"}, format="json")
+    return post
+
+
+def test_request_line_and_server_timing_header(login_request, settings, caplog):
+    settings.REQUEST_STATS_HEADER = True
+    with caplog.at_level(logging.INFO, logger="ai.requests"):
+        resp = login_request()
+
+    assert 'queries"' in resp["Server-Timing"]
+    assert "view;dur=" in resp["Server-Timing"]
+    (record,) = [r for r in caplog.records if r.name == "ai.requests"]
+    assert record.getMessage().startswith(f"POST /auth/login/ {resp.status_code} ")
+    assert record.request_id != "-"
+
+
+def test_header_is_off_by_default(login_request):
+    assert "Server-Timing" not in login_request()
+
+
+def test_slow_requests_logged_with_query_call_sites(login_request, settings, caplog):
+    settings.SLOW_REQUEST_QUERIES = 1
+    with caplog.at_level(logging.WARNING, logger="ai.slow"):
+        login_request()
+
+    (record,) = [r for r in caplog.records if r.name == "ai.slow"]
+    entry = json.loads(record.getMessage())
+    assert entry["path"] == "/auth/login/"
+    assert entry["queries"] >= 1
+    assert all(q["sql"] and q["ms"] >= 0 for q in entry["slowest"])
+    # Attributed to our code, not to Django internals
+    assert all(q["at"].startswith(("users/", "ai/")) for q in entry["slowest"])
+
+
+def test_fast_requests_skip_the_slow_log(login_request, settings, caplog):
+    settings.SLOW_REQUEST_MS = 60_000
+    with caplog.at_level(logging.WARNING, logger="ai.slow"):
+        login_request()
+    assert not [r for r in caplog.records if r.name == "ai.slow"]
@@ -0,0 +1,40 @@
+import json
+
+from ai import tracing
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+
+
+def _span(name):
+    span = tracing.Span(name, TRACE_ID, None, True)
+    span.end_ns = span.start_ns + 1
+    return span
+
+
+def test_nothing_is_kept_without_a_sink(settings):
+    settings.TRACE_OTLP_ENDPOINT = ""
+    settings.TRACE_FILE = ""
+    exporter = tracing.SpanExporter()
+    exporter.add(_span("chat"))
+    assert not exporter._spans and exporter._pid is None
+
+
+def test_trace_file_is_rotated_at_its_size_cap(settings, tmp_path):
+    path = tmp_path / "traces.jsonl"
+    settings.TRACE_OTLP_ENDPOINT = ""
+    settings.TRACE_FILE = str(path)
+    settings.TRACE_FILE_MAX_BYTES = 0
+    exporter = tracing.SpanExporter()
+    for name in ("a", "b"):
+        exporter._spans.append(_span(name))
+        exporter.flush()
+    settings.TRACE_FILE_MAX_BYTES = path.stat().st_size + 1
+    exporter._spans.append(_span("c"))
+    exporter.flush()
+
+    def names(p):
+        return [json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"][0]["name"] for line in p.read_text().splitlines()]
+
+    assert names(tmp_path / "traces.jsonl.1") == ["a", "b"]
+    assert names(path) == ["c"]
+    assert exporter.exported == 3
@@ -0,0 +1,81 @@
+import pytest
+from django.contrib.auth import get_user_model
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users.models import Subscription, SubscriptionPlan
+
+pytestmark = pytest.mark.django_db
+User = get_user_model()
+
+
+@pytest.fixture
+def verified_user():
+    user = User.objects.create_user(email="claims@example.com", password="testpass123", is_verified=True)
+    plan = SubscriptionPlan.objects.create(
+        name="Pro", slug="pro", features={"max_messages": 500, "analytics": True, "export": False}
+    )
+    Subscription.objects.create(user=user, plan=plan, is_active=True)
+    return user, plan
+
+
+def _login(client):
+    resp = client.post("/auth/login/", {"email": "claims@example.com", "password": "testpass123"}, format="json")
+    assert resp.status_code == 200
+    return resp.data
+
+
+def test_login_embeds_entitlements_claim(verified_user):
+    _, plan = verified_user
+    data = _login(APIClient())
+
+    ent = AccessToken(data["access"])["ent"]
+    assert ent["plan"] == "pro"
+    assert ent["pid"] == plan.id
+    assert ent["v"] == plan.entitlements_version
+    assert ent["lim"] == {"max_messages": 500}
+    assert ent["flags"] == ["analytics"]
+
+
+def test_refresh_refetches_claim_after_plan_change(verified_user):
+    _, plan = verified_user
+    client = APIClient()
+    data = _login(client)
+
+    plan.features = {"max_messages": 1000}
+    plan.save()
+    assert plan.entitlements_version == 2
+
+    resp = client.post("/auth/refresh/", {"refresh": data["refresh"]}, format="json")
+    assert resp.status_code == 200
+    ent = AccessToken(resp.data["access"])["ent"]
+    assert ent["v"] == 2
+    assert ent["lim"] == {"max_messages": 1000}
+
+
+def test_plan_save_without_entitlement_change_keeps_version(verified_user):
+    _, plan = verified_user
+    plan.description = "Updated copy"
+    plan.save()
+    plan.refresh_from_db()
+    assert plan.entitlements_version == 1
+
+
+def test_refresh_rereads_staff_flag(verified_user):
+    user, _ = verified_user
+    user.is_staff = True
+    user.save()
+    client = APIClient()
+    data = _login(client)
+    assert AccessToken(data["access"]).get("staff") is True
+
+    user.is_staff = False
+    user.save()
+    resp = client.post("/auth/refresh/", {"refresh": data["refresh"]}, format="json")
+    assert resp.status_code == 200
+    assert AccessToken(resp.data["access"]).get("staff") is None
+
+    user.is_staff = True
+    user.save()
+    resp = client.post("/auth/refresh/", {"refresh": data["refresh"]}, format="json")
+    assert AccessToken(resp.data["access"]).get("staff") is True
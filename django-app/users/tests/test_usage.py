@@ -0,0 +1,89 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+import redis
+from django.contrib.auth import get_user_model
+
+from users import usage
+from users.models import TokenUsage
+
+pytestmark = pytest.mark.django_db
+User = get_user_model()
+
+HOUR = 1_760_000_400  # 2025-10-09 09:00 UTC
+
+
+class FakeRedis:
+    def __init__(self):
+        self.store = {}
+
+    def rpush(self, key, *values):
+        self.store.setdefault(key, []).extend(v.encode() for v in values)
+
+    def rename(self, src, dst):
+        if src not in self.store:
+            raise redis.ResponseError("no such key")
+        self.store[dst] = self.store.pop(src)
+
+    def scan_iter(self, match):
+        prefix = match.rstrip("*")
+        return [k.encode() for k in list(self.store) if k.startswith(prefix)]
+
+    def lrange(self, key, start, end):
+        return self.store.get(key, [])[start:end + 1]
+
+    def delete(self, key):
+        self.store.pop(key, None)
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    fake = FakeRedis()
+    monkeypatch.setattr(usage, "get_redis", lambda: fake)
+    return fake
+
+
+def event(user_id, ts, prompt=10, completion=20, aborted=False, model="llama3", service="chat"):
+    return json.dumps({
+        "user_id": str(user_id), "model": model, "prompt_tokens": prompt, "completion_tokens": completion,
+        "aborted": aborted, "service": service, "ts": ts,
+    })
+
+
+def test_rollup_aggregates_per_user_hour_model_and_service(fake_redis):
+    user = User.objects.create_user(email="usage@example.com", password="testpass123")
+    fake_redis.rpush(
+        usage.EVENTS_KEY,
+        event(user.id, HOUR + 5),
+        event(user.id, HOUR + 3599, prompt=5, completion=3, aborted=True),
+        event(user.id, HOUR + 3600),
+        event(user.id, HOUR + 10, service="ai-service"),
+        event(999999, HOUR),  # unknown user
+        "not json",
+    )
+
+    assert usage.rollup_usage(batch_size=2) == 6
+    assert fake_redis.store == {}
+
+    row = TokenUsage.objects.get(user=user, service="chat", period_start=datetime.fromtimestamp(HOUR, tz=timezone.utc))
+    assert (row.requests, row.aborted, row.prompt_tokens, row.completion_tokens) == (2, 1, 15, 23)
+    assert TokenUsage.objects.filter(user=user).count() == 3
+
+
+def test_interrupted_rollup_is_finished_once(fake_redis):
+    user = User.objects.create_user(email="usage2@example.com", password="testpass123")
+    claimed = [event(user.id, HOUR), event(user.id, HOUR)]
+    fake_redis.rpush(usage.EVENTS_KEY, *claimed)
+    usage.rollup_usage()
+
+    # The rows were committed but the process died before deleting the claimed list
+    rollup_id = TokenUsage.objects.get(user=user).rollup_id
+    fake_redis.rpush(usage.ROLLUP_KEY.format(rollup_id=rollup_id), *claimed)
+    fake_redis.rpush(usage.EVENTS_KEY, event(user.id, HOUR))
+
+    assert usage.rollup_usage() == 3
+    assert fake_redis.store == {}
+    rows = TokenUsage.objects.filter(user=user)
+    assert rows.count() == 2
+    assert sum(r.requests for r in rows) == 3
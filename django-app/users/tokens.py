@@ -0,0 +1,90 @@
+import logging
+from typing import Optional
+
+from django.contrib.auth import get_user_model
+from django.utils.text import slugify
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .models import Subscription
+
+logger = logging.getLogger(__name__)
+
+ENTITLEMENTS_CLAIM = "ent"
+STAFF_CLAIM = "staff"  # lets fastapi-app serve staff-only endpoints (profiler, stats) without a DB
+
+
+def _active_subscription(user_id) -> Optional[Subscription]:
+    return (
+        Subscription.objects.select_related("plan")
+        .filter(user_id=user_id, is_active=True)
+        .order_by("-start_date")
+        .first()
+    )
+
+
+def entitlements_claim(user_id) -> dict:
+    """
+    Compact entitlements for the access token (one query):
+    {"v": plan version, "pid": plan id, "plan": slug, "lim": {numeric features}, "flags": [enabled flags]}
+    """
+    sub = _active_subscription(user_id)
+    if sub is None:
+        return {"v": 0, "pid": 0, "plan": None, "lim": {}, "flags": []}
+    plan = sub.plan
+    features = plan.features or {}
+    return {
+        "v": plan.entitlements_version,
+        "pid": plan.id,
+        "plan": plan.slug or slugify(plan.name),
+        "lim": {k: v for k, v in features.items() if isinstance(v, int) and not isinstance(v, bool)},
+        "flags": sorted(k for k, v in features.items() if v is True),
+    }
+
+
+def current_entitlements_version(user_id) -> tuple:
+    row = (
+        Subscription.objects.filter(user_id=user_id, is_active=True)
+        .order_by("-start_date")
+        .values_list("plan_id", "plan__entitlements_version")
+        .first()
+    )
+    return tuple(row) if row else (0, 0)
+
+
+def is_staff(user_id) -> bool:
+    return bool(get_user_model().objects.filter(pk=user_id).values_list("is_staff", flat=True).first())
+
+
+class EntitlementsRefreshToken(RefreshToken):
+    """
+    RefreshToken that carries the entitlements and staff claims into every access
+    token. On refresh the embedded (plan id, version) is checked against the DB and
+    the entitlements are re-fetched only when the plan changed or was bumped; the
+    staff flag is always read again, so revoking staff takes effect on the next
+    refresh rather than when the refresh token expires.
+    """
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token[ENTITLEMENTS_CLAIM] = entitlements_claim(user.pk)
+        if user.is_staff:
+            token[STAFF_CLAIM] = True
+        token._entitlements_fresh = True
+        return token
+
+    @property
+    def access_token(self):
+        if not getattr(self, "_entitlements_fresh", False):
+            user_id = self.payload.get(api_settings.USER_ID_CLAIM)
+            claim = self.payload.get(ENTITLEMENTS_CLAIM) or {}
+            if user_id is not None and (claim.get("pid"), claim.get("v")) != current_entitlements_version(user_id):
+                logger.info("Entitlements changed for user %s; refreshing token claim", user_id)
+                self[ENTITLEMENTS_CLAIM] = entitlements_claim(user_id)
+            if user_id is not None and is_staff(user_id):
+                self[STAFF_CLAIM] = True
+            elif STAFF_CLAIM in self.payload:
+                del self[STAFF_CLAIM]
+            self._entitlements_fresh = True
+        return super().access_token
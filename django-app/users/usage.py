@@ -0,0 +1,113 @@
+"""
+Rolls up token usage events from the chat services into TokenUsage rows.
+
+fastapi-app/metering.py and ai-service/metering.py RPUSH one JSON event per
+generation to `usage:events`:
+    {"user_id", "model", "prompt_tokens", "completion_tokens", "aborted", "service", "ts"}
+
+A rollup renames the list to `usage:rollup:<uuid>` (atomic, so producers keep
+appending to a fresh list), aggregates it per (user, hour, model, service) and
+bulk inserts the totals tagged with that uuid. The key is deleted only after the
+insert commits; a run that dies in between is finished by the next one, and the
+unique constraint on rollup_id makes that re-insert a no-op.
+"""
+import json
+import logging
+import uuid
+from datetime import datetime, timezone
+
+import redis
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from .entitlements import get_redis
+from .models import TokenUsage
+
+logger = logging.getLogger(__name__)
+
+EVENTS_KEY = "usage:events"
+ROLLUP_KEY = "usage:rollup:{rollup_id}"
+
+
+def _decode(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def claim_events(r) -> list:
+    """Rollup keys to process: leftovers from interrupted runs, then the current events."""
+    keys = sorted(_decode(k) for k in r.scan_iter(match=ROLLUP_KEY.format(rollup_id="*")))
+    key = ROLLUP_KEY.format(rollup_id=uuid.uuid4())
+    try:
+        r.rename(EVENTS_KEY, key)
+        keys.append(key)
+    except redis.ResponseError:
+        pass  # no events since the last run
+    return keys
+
+
+def aggregate(events) -> dict:
+    """(user_id, hour, model, service) -> [requests, aborted, prompt_tokens, completion_tokens]"""
+    totals = {}
+    for raw in events:
+        try:
+            ev = json.loads(raw)
+            user_id = int(ev["user_id"])
+            ts = int(ev["ts"])
+            prompt_tokens = max(0, int(ev.get("prompt_tokens") or 0))
+            completion_tokens = max(0, int(ev.get("completion_tokens") or 0))
+        except (ValueError, TypeError, KeyError):
+            logger.warning("Skipping malformed usage event: %r", raw)
+            continue
+        hour = datetime.fromtimestamp(ts - ts % 3600, tz=timezone.utc)
+        row = totals.setdefault((user_id, hour, str(ev.get("model") or ""), str(ev.get("service") or "")), [0, 0, 0, 0])
+        row[0] += 1
+        row[1] += 1 if ev.get("aborted") else 0
+        row[2] += prompt_tokens
+        row[3] += completion_tokens
+    return totals
+
+
+def rollup_key(r, key: str, batch_size: int = 1000) -> int:
+    """Persist one claimed event list and delete it. Returns the number of events read."""
+    rollup_id = uuid.UUID(key.rsplit(":", 1)[1])
+    totals, count = {}, 0
+    while True:
+        events = r.lrange(key, count, count + batch_size - 1)
+        if not events:
+            break
+        count += len(events)
+        for k, row in aggregate(events).items():
+            acc = totals.setdefault(k, [0, 0, 0, 0])
+            for i, v in enumerate(row):
+                acc[i] += v
+
+    known = set(
+        get_user_model().objects.filter(id__in={user_id for user_id, *_ in totals}).values_list("id", flat=True)
+    )
+    rows = [
+        TokenUsage(
+            rollup_id=rollup_id,
+            user_id=user_id,
+            period_start=hour,
+            model=model[:100],
+            service=service[:32],
+            requests=requests,
+            aborted=aborted,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+        )
+        for (user_id, hour, model, service), (requests, aborted, prompt_tokens, completion_tokens) in totals.items()
+        if user_id in known
+    ]
+    if len(rows) < len(totals):
+        logger.warning("Dropped usage for %s unknown user rows in %s", len(totals) - len(rows), key)
+    with transaction.atomic():
+        TokenUsage.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+    r.delete(key)
+    return count
+
+
+def rollup_usage(batch_size: int = 1000) -> int:
+    """Move everything currently in `usage:events` into TokenUsage. Returns the number of events."""
+    r = get_redis()
+    return sum(rollup_key(r, key, batch_size) for key in claim_events(r))
@@ -8,10 +8,10 @@ from rest_framework.response import Response
 from rest_framework.exceptions import (
     ValidationError, NotFound, Throttled, PermissionDenied
 )
-from rest_framework_simplejwt.tokens import RefreshToken
-from rest_framework_simplejwt.views import TokenObtainPairView
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
-from .serializers import SignupSerializer, CustomTokenObtainPairSerializer
+from .serializers import SignupSerializer, CustomTokenObtainPairSerializer, EntitlementsTokenRefreshSerializer
+from .tokens import EntitlementsRefreshToken
 from .models import OTP
 from .utils import (
     create_otp, send_otp_email, can_resend,
@@ -167,7 +167,7 @@ class OTPVerifyView(APIView):
         user.is_verified = True
         user.save(update_fields=["is_verified"])
 
-        refresh = RefreshToken.for_user(user)
+        refresh = EntitlementsRefreshToken.for_user(user)
         logger.info("OTP verified successfully for %s", _mask_email(user.email))
 
         return Response(
@@ -185,3 +185,10 @@ class LoginView(TokenObtainPairView):
     JWT login (blocked for unverified users via CustomTokenObtainPairSerializer)
     """
     serializer_class = CustomTokenObtainPairSerializer
+
+
+class RefreshView(TokenRefreshView):
+    """
+    JWT refresh; re-fetches the entitlements claim when the user's plan version changed
+    """
+    serializer_class = EntitlementsTokenRefreshSerializer
@@ -0,0 +1,102 @@
+import os
+import json
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, List
+
+from exceptions import ExternalServiceError, CapacityExceeded
+from stream_format import ClosingIterator
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+# Upper bound on a batch's concurrent generations; requests may ask for fewer
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+
+
+def validate_items(items) -> List[dict]:
+    """Normalised [{"id", "prompt", "options"}]; raises ValueError with a client-facing message."""
+    if not isinstance(items, list) or not items:
+        raise ValueError("items must be a non-empty list")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise ValueError(f"At most {BATCH_MAX_ITEMS} items per batch")
+    out, seen = [], set()
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError(f"items[{i}] must be an object")
+        item_id = str(item.get("id", i))
+        if item_id in seen:
+            raise ValueError(f"Duplicate item id: {item_id}")
+        seen.add(item_id)
+        prompt = item.get("prompt")
+        prompt = prompt.strip() if isinstance(prompt, str) else ""
+        if not prompt:
+            raise ValueError(f"items[{i}]: prompt is required")
+        options = item.get("options") or {}
+        if not isinstance(options, dict):
+            raise ValueError(f"items[{i}]: options must be an object")
+        out.append({"id": item_id, "prompt": prompt, "options": options})
+    return out
+
+
+def _line(obj: dict) -> bytes:
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def run_batch(
+    items: List[dict],
+    generate: Callable[[dict], Awaitable[dict]],
+    concurrency: int,
+    on_finish: Callable[[int], Awaitable[None]],
+) -> AsyncIterator[bytes]:
+    """
+    Run `generate(item)` for every item with at most `concurrency` in flight and
+    yield one NDJSON line per item as it completes ({"id", ...result} or {"id", "error"}),
+    then a summary line. `on_finish(unserved)` runs once with the number of items that
+    failed or were never delivered.
+    A failing item never aborts the others; a client disconnect cancels what's left,
+    and a batch dropped before its first line refunds every item.
+    """
+    return ClosingIterator(_run_batch(items, generate, concurrency, on_finish), cleanup=lambda: on_finish(len(items)))
+
+
+async def _run_batch(
+    items: List[dict],
+    generate: Callable[[dict], Awaitable[dict]],
+    concurrency: int,
+    on_finish: Callable[[int], Awaitable[None]],
+) -> AsyncIterator[bytes]:
+    results: asyncio.Queue = asyncio.Queue()
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def one(item: dict) -> None:
+        async with sem:
+            try:
+                result = {"id": item["id"], **await generate(item)}
+            except ExternalServiceError as e:
+                logger.error("Batch item %s upstream error: %s", item["id"], str(e))
+                result = {"id": item["id"], "error": "Upstream unavailable"}
+            except CapacityExceeded as e:
+                result = {"id": item["id"], "error": str(e)}
+            except Exception as e:
+                logger.error("Batch item %s failed: %s", item["id"], str(e), exc_info=True)
+                result = {"id": item["id"], "error": "Internal server error"}
+        await results.put(result)
+
+    tasks = [asyncio.create_task(one(item)) for item in items]
+    succeeded = failed = 0
+    try:
+        for _ in range(len(items)):
+            result = await results.get()
+            if "error" in result:
+                failed += 1
+            else:
+                succeeded += 1
+            yield _line(result)
+        yield _line({"done": True, "total": len(items), "succeeded": succeeded, "failed": failed})
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Failed items, and any the client never received, are not charged
+        await on_finish(len(items) - succeeded)
@@ -0,0 +1,174 @@
+import os
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from stream_format import ClosingIterator
+
+logger = logging.getLogger(__name__)
+
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() == "true"
+# Past this many buffered bytes a flight stops accepting new subscribers
+COALESCE_MAX_REPLAY_BYTES = int(os.getenv("COALESCE_MAX_REPLAY_BYTES", str(1024 * 1024)))
+# How many chunks the upstream may run ahead of the fastest subscriber before reading pauses
+COALESCE_READ_AHEAD = int(os.getenv("COALESCE_READ_AHEAD", "64"))
+
+
+class _OpenerGone(Exception):
+    """The request opening a flight went away first; a waiting subscriber takes over."""
+
+
+class Flight:
+    """
+    One upstream generation shared by every subscriber with the same key.
+    Chunks go into a single append-only log; each subscriber reads it at its own
+    offset, so buffering is one copy per flight no matter how many subscribers
+    there are, and a slow reader only lags itself. Upstream is read at most
+    COALESCE_READ_AHEAD chunks ahead of the fastest reader, so when every client
+    stalls, reading from Ollama pauses too.
+    """
+
+    def __init__(self, key: str):
+        loop = asyncio.get_running_loop()
+        self.key = key
+        self.chunks: List[bytes] = []
+        self.nbytes = 0
+        self.done = False
+        self.subscribers = 0
+        self.read = 0  # furthest offset any subscriber has taken
+        self.opened: asyncio.Future = loop.create_future()
+        self.task: Optional[asyncio.Task] = None
+        self._changed: asyncio.Future = loop.create_future()
+        self._advanced: asyncio.Future = loop.create_future()
+
+    @property
+    def joinable(self) -> bool:
+        return not self.done and self.nbytes <= COALESCE_MAX_REPLAY_BYTES
+
+    def append(self, chunk: bytes) -> None:
+        self.chunks.append(chunk)
+        self.nbytes += len(chunk)
+        self._wake()
+
+    def finish(self) -> None:
+        self.done = True
+        self._wake()
+
+    def _wake(self) -> None:
+        changed, self._changed = self._changed, asyncio.get_running_loop().create_future()
+        changed.set_result(None)
+
+    async def wait(self) -> None:
+        # shield: a cancelled subscriber must not cancel the future the others wait on
+        await asyncio.shield(self._changed)
+
+    def advance(self, pos: int) -> None:
+        if pos > self.read:
+            self.read = pos
+            if not self._advanced.done():
+                self._advanced.set_result(None)
+
+    async def wait_for_readers(self) -> None:
+        while len(self.chunks) - self.read >= COALESCE_READ_AHEAD:
+            self._advanced = asyncio.get_running_loop().create_future()
+            await self._advanced
+
+
+class Coalescer:
+    """Single-flight for identical generations (same model, prompt and options)."""
+
+    def __init__(self, enabled: bool = COALESCE_ENABLED):
+        self.enabled = enabled
+        self._flights: Dict[str, Flight] = {}
+        self.started = 0
+        self.joined = 0
+
+    def has_flight(self, key: str) -> bool:
+        flight = self._flights.get(key)
+        return self.enabled and flight is not None and flight.joinable
+
+    async def stream(self, key: str, opener: Callable[[], Awaitable[AsyncIterator[bytes]]]) -> AsyncIterator[bytes]:
+        """
+        Return a chunk iterator for `key`, starting the upstream via `opener()` only if
+        no joinable flight exists. Errors from opening propagate to every waiter; if the
+        opening request is cancelled instead, the waiters open a new flight between them.
+        """
+        if not self.enabled:
+            return await opener()
+
+        flight = self._flights.get(key)
+        if flight is not None and flight.joinable:
+            self.joined += 1
+            try:
+                await asyncio.shield(flight.opened)
+            except _OpenerGone:
+                # The first waiter back opens a new flight with its own opener, the rest join it
+                return await self.stream(key, opener)
+            return self._subscribe(flight)
+
+        flight = Flight(key)
+        self._flights[key] = flight
+        self.started += 1
+        try:
+            upstream = await opener()
+        except BaseException as e:
+            self._drop(flight)
+            # Never cancel `opened`: waiters would get a CancelledError that isn't theirs
+            flight.opened.set_exception(_OpenerGone() if isinstance(e, asyncio.CancelledError) else e)
+            flight.opened.exception()  # mark retrieved when nobody else joined
+            raise
+        flight.opened.set_result(None)
+        flight.task = asyncio.create_task(self._pump(flight, upstream))
+        return self._subscribe(flight)
+
+    async def _pump(self, flight: Flight, upstream: AsyncIterator[bytes]) -> None:
+        try:
+            async for chunk in upstream:
+                flight.append(chunk)
+                if not flight.joinable:
+                    self._drop(flight)
+                await flight.wait_for_readers()
+        except Exception as e:
+            logger.error("Coalesced upstream failed: %s", str(e))
+        finally:
+            self._drop(flight)
+            flight.finish()
+            await upstream.aclose()
+
+    def _subscribe(self, flight: Flight) -> AsyncIterator[bytes]:
+        # Counted from now, not from the first read, and left on aclose() even if never read
+        flight.subscribers += 1
+        return ClosingIterator(self._read(flight), cleanup=lambda: self._leave(flight))
+
+    async def _read(self, flight: Flight) -> AsyncIterator[bytes]:
+        pos = 0
+        try:
+            while True:
+                if pos < len(flight.chunks):
+                    chunk = flight.chunks[pos]
+                    pos += 1
+                    flight.advance(pos)
+                    yield chunk
+                elif flight.done:
+                    return
+                else:
+                    await flight.wait()
+        finally:
+            self._leave(flight)
+
+    def _leave(self, flight: Flight) -> None:
+        flight.subscribers -= 1
+        if flight.subscribers == 0 and not flight.done and flight.task is not None:
+            # Everyone left: stop generating output nobody will read
+            self._drop(flight)
+            flight.task.cancel()
+
+    def _drop(self, flight: Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._flights), "started": self.started, "joined": self.joined}
+
+
+coalescer = Coalescer()
@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import redis.asyncio as redis
+
+logger = logging.getLogger(__name__)
+
+# Written by django-app (users/entitlements.py); keep the layout in sync.
+PLAN_KEY = "ent:plan:{plan_id}"
+USERS_KEY = "ent:users:{shard}"
+INVALIDATE_CHANNEL = "ent:invalidate"
+USER_SHARD_SIZE = 100
+
+ENTITLEMENTS_LOCAL_TTL = float(os.getenv("ENTITLEMENTS_LOCAL_TTL", "300"))
+ENTITLEMENTS_MAX_USERS = int(os.getenv("ENTITLEMENTS_MAX_USERS", "50000"))
+
+# SubscriptionPlan.features key -> quota window
+PLAN_LIMIT_FEATURES = {
+    "minute": "max_messages_per_minute",
+    "hour": "max_messages_per_hour",
+    "day": "max_messages",
+    "month": "max_messages_per_month",
+}
+
+
+# SubscriptionPlan.features key -> token quota window (prompt + completion tokens)
+PLAN_TOKEN_LIMIT_FEATURES = {
+    "day": "max_tokens_per_day",
+    "month": "max_tokens_per_month",
+}
+
+
+def plan_from_claim(claim: Optional[dict]) -> Optional[dict]:
+    """Plan dict from the "ent" access-token claim issued by django-app (users/tokens.py)."""
+    if not claim or not claim.get("pid"):
+        return None
+    features = dict(claim.get("lim") or {})
+    features.update({flag: True for flag in claim.get("flags") or []})
+    return {"id": claim["pid"], "slug": claim.get("plan"), "version": claim.get("v"), "features": features}
+
+
+def plan_limits(plan: dict) -> Dict[str, int]:
+    features = plan.get("features") or {}
+    return {w: int(features.get(key) or 0) for w, key in PLAN_LIMIT_FEATURES.items()}
+
+
+def plan_token_limits(plan: dict) -> Dict[str, int]:
+    features = plan.get("features") or {}
+    return {w: int(features.get(key) or 0) for w, key in PLAN_TOKEN_LIMIT_FEATURES.items()}
+
+
+class EntitlementCache:
+    """
+    Per-worker cache of user -> plan in front of the Redis copy Django maintains.
+    Entries are dropped on `ent:invalidate` pub/sub messages; the local TTL is only
+    a safety net for messages missed while the subscriber was reconnecting.
+    """
+
+    def __init__(self, client: redis.Redis, ttl: float = ENTITLEMENTS_LOCAL_TTL, max_users: int = ENTITLEMENTS_MAX_USERS):
+        self.r = client
+        self.ttl = ttl
+        self.max_users = max_users
+        self._users: "OrderedDict[str, tuple]" = OrderedDict()  # user_id -> (expires_at, plan_id)
+        self._plans: Dict[str, tuple] = {}  # plan_id -> (expires_at, plan dict or None)
+        self.hits = 0
+        self.misses = 0
+
+    async def get_plan(self, user_id: str) -> Optional[dict]:
+        """Return the user's active plan dict, or None if unknown / no active plan."""
+        return (await self.lookup(user_id))[1]
+
+    async def lookup(self, user_id: str) -> Tuple[bool, Optional[dict]]:
+        """
+        (known, plan): known is False when Django hasn't synced the user (or their
+        plan) yet; (True, None) means synced with no active plan, e.g. after a
+        cancellation or downgrade.
+        """
+        now = time.monotonic()
+        entry = self._users.get(user_id)
+        if entry is not None and entry[0] > now:
+            plan_id = entry[1]
+            self._users.move_to_end(user_id)
+        else:
+            plan_id = None
+            if user_id.isdigit():
+                key = USERS_KEY.format(shard=int(user_id) // USER_SHARD_SIZE)
+                plan_id = await self.r.hget(key, user_id)
+            if plan_id is None:
+                # Not synced yet: don't cache so the next request sees Django's write
+                self.misses += 1
+                return False, None
+            self._users[user_id] = (now + self.ttl, plan_id)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+        if plan_id in ("0", 0):
+            self.hits += 1
+            return True, None
+        cached = self._plans.get(plan_id)
+        if cached is not None and cached[0] > now:
+            self.hits += 1
+            return cached[1] is not None, cached[1]
+
+        self.misses += 1
+        raw = await self.r.get(PLAN_KEY.format(plan_id=plan_id))
+        plan = json.loads(raw) if raw else None
+        self._plans[plan_id] = (now + self.ttl, plan)
+        return plan is not None, plan
+
+    def invalidate(self, message: str) -> None:
+        kind, _, ident = message.partition(":")
+        if kind == "user":
+            self._users.pop(ident, None)
+        elif kind == "plan":
+            self._plans.pop(ident, None)
+        else:
+            self.clear()
+
+    def clear(self) -> None:
+        self._users.clear()
+        self._plans.clear()
+
+    async def listen(self) -> None:
+        """Consume invalidations forever; reconnects (and flushes) on Redis errors."""
+        while True:
+            pubsub = self.r.pubsub()
+            try:
+                await pubsub.subscribe(INVALIDATE_CHANNEL)
+                # Anything published while we were disconnected is lost
+                self.clear()
+                async for msg in pubsub.listen():
+                    if msg.get("type") == "message":
+                        self.invalidate(msg["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Entitlements subscriber error: %s", str(e))
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
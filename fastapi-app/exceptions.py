@@ -2,7 +2,12 @@ class SubscriptionLimitExceeded(Exception):
     pass
 
 class RateLimitExceeded(Exception):
-    pass
+    def __init__(self, message: str = "", headers: dict | None = None):
+        super().__init__(message)
+        self.headers = headers or {}
 
 class ExternalServiceError(Exception):
     pass
+
+class CapacityExceeded(Exception):
+    pass
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+import redis.asyncio as redis
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "86400"))
+JOB_MAX_QUEUE = int(os.getenv("JOB_MAX_QUEUE", "10000"))
+JOB_MAX_WAIT = float(os.getenv("JOB_MAX_WAIT", "30"))
+# A worker gives up on a job after this long; the reaper requeues a running job only
+# once the grace period has passed too, so it never races a worker still failing it
+JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT", "900"))
+JOB_REAP_GRACE = int(os.getenv("JOB_REAP_GRACE", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+QUEUE_KEY = "job:queue"            # list of pending ids (LPUSH / BLMOVE from the right)
+PROCESSING_KEY = "job:processing"  # ids claimed by a worker
+JOB_KEY = "job:{job_id}"           # hash: status, user_id, payload, result fields
+DONE_CHANNEL = "job:done"          # published job id when a job finishes
+
+FINAL_STATUSES = ("succeeded", "failed")
+
+# Enqueue unless the queue is full.
+#   KEYS = job, queue    ARGV = max_queue, ttl, job_id, field/value pairs...
+_SUBMIT_LUA = """
+if redis.call('LLEN', KEYS[2]) >= tonumber(ARGV[1]) then
+  return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 4))
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+redis.call('LPUSH', KEYS[2], ARGV[3])
+return 1
+"""
+
+# Store the outcome, release the claim and notify long-pollers.
+#   KEYS = job, processing    ARGV = job_id, ttl, channel, field/value pairs...
+_FINISH_LUA = """
+redis.call('HSET', KEYS[1], unpack(ARGV, 4))
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+redis.call('LREM', KEYS[2], 1, ARGV[1])
+redis.call('PUBLISH', ARGV[3], ARGV[1])
+return 1
+"""
+
+# Put a stale claimed job back on the queue, once, even with several reapers.
+#   KEYS = processing, queue    ARGV = job_id
+_REQUEUE_LUA = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 1 then
+  redis.call('RPUSH', KEYS[2], ARGV[1])
+  return 1
+end
+return 0
+"""
+
+
+def job_key(job_id: str) -> str:
+    return JOB_KEY.format(job_id=job_id)
+
+
+def public_view(job: Dict[str, str]) -> dict:
+    """What a client gets back for GET /jobs/{id}."""
+    out = {"job_id": job["id"], "status": job["status"], "created_at": float(job["created_at"])}
+    for field in ("started_at", "finished_at"):
+        if job.get(field):
+            out[field] = float(job[field])
+    if job["status"] == "succeeded":
+        out["response"] = job.get("response", "")
+        out["usage"] = json.loads(job.get("usage") or "{}")
+    elif job["status"] == "failed":
+        out["error"] = job.get("error", "")
+    return out
+
+
+class JobStore:
+    """
+    Redis-backed job queue and result store. Web workers submit and long-poll;
+    worker.py processes claim, run and finish jobs. Results expire after JOB_RESULT_TTL.
+    """
+
+    def __init__(self, client: redis.Redis):
+        self.r = client
+        self._submit = client.register_script(_SUBMIT_LUA)
+        self._finish = client.register_script(_FINISH_LUA)
+        self._requeue = client.register_script(_REQUEUE_LUA)
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+
+    # ---- web side ----
+    async def submit(self, user_id: str, model: str, prompt: str, options: dict) -> Optional[str]:
+        """Enqueue a generation; returns the job id, or None if the queue is full."""
+        job_id = uuid.uuid4().hex
+        fields = {
+            "id": job_id,
+            "status": "queued",
+            "user_id": user_id,
+            "model": model,
+            "prompt": prompt,
+            "options": json.dumps(options),
+            "created_at": time.time(),
+            "attempts": 0,
+            # The worker continues the submitting request's trace
+            "traceparent": tracing.inject().get("traceparent", ""),
+        }
+        flat = [x for kv in fields.items() for x in kv]
+        ok = await self._submit(keys=[job_key(job_id), QUEUE_KEY], args=[JOB_MAX_QUEUE, JOB_RESULT_TTL, job_id, *flat])
+        return job_id if ok else None
+
+    async def get(self, job_id: str) -> Optional[Dict[str, str]]:
+        job = await self.r.hgetall(job_key(job_id))
+        return job or None
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, str]]:
+        """Current job state, waiting up to `timeout` for it to finish."""
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(job_id, []).append(fut)
+        try:
+            job = await self.get(job_id)
+            if job is None or job["status"] in FINAL_STATUSES or timeout <= 0:
+                return job
+            try:
+                await asyncio.wait_for(fut, timeout)
+            except asyncio.TimeoutError:
+                pass
+            return await self.get(job_id)
+        finally:
+            waiters = self._waiters.get(job_id, [])
+            if fut in waiters:
+                waiters.remove(fut)
+            if not waiters:
+                self._waiters.pop(job_id, None)
+
+    async def listen(self) -> None:
+        """Wake local long-pollers on job:done; one subscription per web worker."""
+        while True:
+            pubsub = self.r.pubsub()
+            try:
+                await pubsub.subscribe(DONE_CHANNEL)
+                # Anything finished while we were disconnected: let every waiter re-check
+                self._wake_all()
+                async for msg in pubsub.listen():
+                    if msg.get("type") == "message":
+                        for fut in self._waiters.get(msg["data"], []):
+                            if not fut.done():
+                                fut.set_result(None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Job subscriber error: %s", str(e))
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def _wake_all(self) -> None:
+        for waiters in self._waiters.values():
+            for fut in waiters:
+                if not fut.done():
+                    fut.set_result(None)
+
+    async def queue_depth(self) -> int:
+        return await self.r.llen(QUEUE_KEY)
+
+    # ---- worker side ----
+    async def claim(self, timeout: float) -> Optional[Dict[str, str]]:
+        """Block up to `timeout` for the next job and mark it running."""
+        job_id = await self.r.blmove(QUEUE_KEY, PROCESSING_KEY, timeout, "RIGHT", "LEFT")
+        if job_id is None:
+            return None
+        job = await self.get(job_id)
+        if job is None:
+            # Expired before anyone got to it
+            await self.r.lrem(PROCESSING_KEY, 1, job_id)
+            return None
+        await self.r.hset(job_key(job_id), mapping={"status": "running", "started_at": time.time()})
+        await self.r.hincrby(job_key(job_id), "attempts", 1)
+        job["attempts"] = str(int(job.get("attempts") or 0) + 1)
+        return job
+
+    async def finish(self, job_id: str, **fields) -> None:
+        flat = [x for kv in fields.items() for x in kv]
+        await self._finish(keys=[job_key(job_id), PROCESSING_KEY], args=[job_id, JOB_RESULT_TTL, DONE_CHANNEL, *flat])
+
+    async def succeed(self, job_id: str, response: str, usage: dict) -> None:
+        await self.finish(job_id, status="succeeded", response=response, usage=json.dumps(usage), finished_at=time.time())
+
+    async def fail(self, job_id: str, error: str) -> None:
+        await self.finish(job_id, status="failed", error=error, finished_at=time.time())
+
+    async def reap(self) -> int:
+        """Requeue jobs whose worker died mid-run; fail them after JOB_MAX_ATTEMPTS."""
+        requeued = 0
+        now = time.time()
+        for job_id in await self.r.lrange(PROCESSING_KEY, 0, -1):
+            job = await self.get(job_id)
+            if job is None:
+                await self.r.lrem(PROCESSING_KEY, 1, job_id)
+                continue
+            started = float(job.get("started_at") or now)
+            if now - started < JOB_TIMEOUT + JOB_REAP_GRACE:
+                continue
+            if int(job.get("attempts") or 0) >= JOB_MAX_ATTEMPTS:
+                await self.fail(job_id, "Job timed out")
+            elif await self._requeue(keys=[PROCESSING_KEY, QUEUE_KEY], args=[job_id]):
+                await self.r.hset(job_key(job_id), "status", "queued")
+                requeued += 1
+        return requeued
+
+    async def close(self) -> None:
+        await self.r.aclose()
+
+
+job_store = JobStore(redis.Redis.from_url(REDIS_URL, decode_responses=True))
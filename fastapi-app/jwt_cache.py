@@ -0,0 +1,57 @@
+import os
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", "10000"))
+
+
+class VerifiedTokenCache:
+    """
+    Bounded LRU of already-verified tokens -> decoded principal.
+    Keyed by sha256(token) so raw tokens are never held in memory; entries are
+    only served while `exp` is in the future and are dropped on first expired read.
+    """
+
+    def __init__(self, maxsize: int = JWT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[bytes, Tuple[float, dict]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token: str, now: Optional[float] = None) -> Optional[dict]:
+        key = self._key(token)
+        entry = self._data.get(key)
+        if entry is not None:
+            exp, principal = entry
+            if exp > (time.time() if now is None else now):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return dict(principal)
+            del self._data[key]
+        self.misses += 1
+        return None
+
+    def put(self, token: str, principal: dict, exp) -> None:
+        # Tokens without a numeric exp are never cached
+        if self.maxsize <= 0 or not isinstance(exp, (int, float)):
+            return
+        key = self._key(token)
+        self._data[key] = (float(exp), dict(principal))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+
+token_cache = VerifiedTokenCache()
@@ -0,0 +1,187 @@
+"""
+Logging off the event loop.
+
+Records are filtered (sampling, request id) and have their message and any
+traceback rendered in the calling thread, then go through a queue to a
+background thread that formats and writes them, so a slow stdout never holds
+up a request. With LOG_QUEUE_MAX set the queue is bounded and the oldest
+records are dropped when it fills (a warning says how many); otherwise it
+grows until the writer catches up.
+
+LOG_FORMAT=json writes one JSON object per line (json.dumps, so quotes and
+newlines in messages stay valid JSON; `extra=` fields are included).
+LOG_SAMPLE_RATES keeps a share of the INFO/DEBUG records of hot loggers and
+their children, e.g. "main.usage=0.05,httpx=0.1"; warnings and errors always pass.
+
+django-app/ai/logging_utils.py is the same for Django; keep the two in sync.
+"""
+import os
+import sys
+import copy
+import json
+import queue
+import random
+import logging
+import logging.handlers
+from typing import Dict, Optional, Union
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "0"))  # 0: unbounded, never drops
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
+# LogRecord attributes; anything else on a record came in through `extra=`
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, request_id, message, exc, then extras."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name}
+        request_id = getattr(record, "request_id", None)
+        if request_id is not None:
+            out["request_id"] = request_id
+        out["message"] = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            out["exc"] = record.exc_text
+        if record.stack_info:
+            out["stack"] = self.formatStack(record.stack_info)
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED:
+                out[key] = value
+        return json.dumps(out, default=str, ensure_ascii=False)
+
+
+def parse_rates(spec: str) -> Dict[str, float]:
+    """"main.usage=0.05,httpx=0.1" -> {"main.usage": 0.05, "httpx": 0.1}"""
+    rates = {}
+    for item in spec.split(","):
+        name, sep, rate = item.partition("=")
+        if sep and name.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a share of the records below WARNING from the loggers in `rates` (and their children)."""
+
+    def __init__(self, rates: Union[str, Dict[str, float]] = ""):
+        super().__init__()
+        self.rates = parse_rates(rates) if isinstance(rates, str) else dict(rates)
+        self._resolved: Dict[str, float] = {}
+
+    def rate(self, name: str) -> float:
+        rate = self._resolved.get(name)
+        if rate is None:
+            logger_name = name
+            while logger_name not in self.rates and "." in logger_name:
+                logger_name = logger_name.rsplit(".", 1)[0]
+            rate = self._resolved[name] = self.rates.get(logger_name, 1.0)
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rate(record.name)
+        return rate >= 1 or random.random() < rate
+
+
+class _Writer(logging.handlers.QueueListener):
+    def __init__(self, owner: "QueuedHandler"):
+        super().__init__(owner.queue, owner.target)
+        self.owner = owner
+        self.reported = 0
+
+    def handle(self, record: logging.LogRecord) -> None:
+        dropped = self.owner.dropped
+        if dropped != self.reported:
+            notice = logging.LogRecord(
+                __name__, logging.WARNING, __file__, 0, "Log queue full, %s records dropped", (dropped - self.reported,), None,
+            )
+            notice.request_id = "-"
+            self.reported = dropped
+            super().handle(notice)
+        super().handle(record)
+
+    def enqueue_sentinel(self) -> None:
+        # Waits for room rather than dropping a record: only called on close
+        self.queue.put(self._sentinel)
+
+
+class QueuedHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to `target` on a background thread. max_size > 0 bounds the
+    queue and drops the oldest records when it is full.
+    """
+
+    def __init__(self, target: logging.Handler, max_size: int = 0):
+        self.target = target
+        self.max_size = max_size
+        self.dropped = 0
+        super().__init__(queue.Queue(max_size) if max_size > 0 else queue.SimpleQueue())
+        self._writer: Optional[_Writer] = None
+        self._start()
+        # Forked children (gunicorn workers) have the queue but not the thread
+        os.register_at_fork(after_in_child=self._restart)
+
+    def _start(self) -> None:
+        self._writer = _Writer(self)
+        self._writer.start()
+
+    def _restart(self) -> None:
+        self.queue = queue.Queue(self.max_size) if self.max_size > 0 else queue.SimpleQueue()
+        self.dropped = 0
+        self._start()
+
+    def setFormatter(self, fmt: Optional[logging.Formatter]) -> None:
+        # Formatting happens on the writer thread, by the target
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Render the message and traceback now, while args and exc_info are still live
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = (self.target.formatter or logging.Formatter()).formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def flush(self) -> None:
+        self.target.flush()
+
+    def close(self) -> None:
+        # Called by logging.shutdown() at exit: write out what is queued first
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer = None
+        self.target.close()
+        super().close()
+
+
+def install(text_format: str, *filters: logging.Filter) -> QueuedHandler:
+    """Send the root logger through a queued stdout handler, formatted per LOG_FORMAT."""
+    handler = QueuedHandler(logging.StreamHandler(sys.stdout), LOG_QUEUE_MAX)
+    handler.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else logging.Formatter(text_format))
+    handler.addFilter(SamplingFilter(LOG_SAMPLE_RATES))
+    for f in filters:
+        handler.addFilter(f)
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers = [handler]
+    return handler
@@ -1,18 +1,39 @@
 import os
-import sys
+import json
+import math
+import time
 import uuid
 import logging
+import asyncio
 import contextvars
-from typing import AsyncGenerator
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 
-import requests
-from fastapi import FastAPI, Request, Header, HTTPException, Depends
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import FastAPI, Request, Header, HTTPException, Depends, WebSocket
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from jose import jwt, JWTError
 
-from exceptions import SubscriptionLimitExceeded, RateLimitExceeded, ExternalServiceError
-from rate_limit import incr_usage
+from exceptions import SubscriptionLimitExceeded, RateLimitExceeded, ExternalServiceError, CapacityExceeded
+import rate_limit
+import ollama_client
+from quota_lease import leased_quota
+from jwt_cache import token_cache
+from entitlements import EntitlementCache, plan_from_claim, plan_limits, plan_token_limits
+from response_cache import response_cache
+from semantic_cache import semantic_cache
+from coalesce import coalescer
+from sessions import session_store
+from stream_format import FORMATS, negotiate, format_stream, usage, ClosingIterator, ClosingStreamingResponse
+from batch import BATCH_MAX_CONCURRENCY, validate_items, run_batch
+from jobs import job_store, public_view, JOB_MAX_WAIT
+from scheduler import scheduler, SCHEDULER_QUEUE_TIMEOUT
+from metering import meter
+import metrics
+import tracing
+import profiler
+import log_pipeline
+from ws import ChatConnection
 
 # --------- Logging config (structured + request id) ----------
 request_id_var = contextvars.ContextVar("request_id", default="-")
@@ -22,25 +43,42 @@ class RequestIDFilter(logging.Filter):
         record.request_id = request_id_var.get()
         return True
 
-LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
-LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
-
-formatter = logging.Formatter(
-    '{"time":"%(asctime)s","level":"%(levelname)s","logger":"%(name)s","request_id":"%(request_id)s","message":"%(message)s"}'
-    if LOG_FORMAT == "json"
-    else "[%(asctime)s] [%(levelname)s] [%(name)s] [rid=%(request_id)s] %(message)s"
-)
-handler = logging.StreamHandler(sys.stdout)
-handler.setFormatter(formatter)
-handler.addFilter(RequestIDFilter())
-root_logger = logging.getLogger()
-root_logger.setLevel(LOG_LEVEL)
-root_logger.handlers = [handler]
+# JSON or text per LOG_FORMAT, written off the event loop (see log_pipeline.py)
+log_pipeline.install("[%(asctime)s] [%(levelname)s] [%(name)s] [rid=%(request_id)s] %(message)s", RequestIDFilter())
 
 logger = logging.getLogger(__name__)
+usage_logger = logging.getLogger(f"{__name__}.usage")  # once per chat request; sample it with LOG_SAMPLE_RATES
 
 # --------- App ----------
-app = FastAPI()
+entitlement_cache = EntitlementCache(rate_limit.r)
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    await ollama_client.startup()
+    await semantic_cache.startup()
+    meter.start()
+    metrics.REGISTRY.start(rate_limit.r)
+    tracing.exporter.start()
+    ent_listener = asyncio.create_task(entitlement_cache.listen())
+    job_listener = asyncio.create_task(job_store.listen())
+    try:
+        yield
+    finally:
+        ent_listener.cancel()
+        job_listener.cancel()
+        await asyncio.gather(ent_listener, job_listener, return_exceptions=True)
+        await semantic_cache.shutdown()
+        await ollama_client.shutdown()
+        await leased_quota.release_all()
+        await response_cache.close()
+        await session_store.close()
+        await job_store.close()
+        await meter.close()
+        await metrics.REGISTRY.close()
+        await rate_limit.close()
+        await tracing.exporter.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS (adjust for your domain in prod)
 app.add_middleware(
@@ -48,15 +86,38 @@ app.add_middleware(
     allow_origins=os.getenv("CORS_ALLOW_ORIGINS", "http://localhost:8000,http://127.0.0.1:8000").split(","),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "traceresponse", "X-Profile-Id"],
 )
 
-# --------- Request ID middleware ----------
+# --------- Request ID + trace (+ profile on request) middleware ----------
 @app.middleware("http")
 async def add_request_id(request: Request, call_next):
     rid = request.headers.get("x-request-id") or str(uuid.uuid4())
     request_id_var.set(rid)
-    response = await call_next(request)
+    # Root span of this service's part of the trace; continues the caller's traceparent if any
+    root = tracing.start_span(request.method, traceparent=request.headers.get("traceparent"), kind=tracing.SERVER)
+    root.set("http.method", request.method)
+    root.set("http.target", request.url.path)
+    root.set("request_id", rid)
+    tracing.activate(root)
+    profile = profiler.start_request_profile() if staff_profile_requested(request) else None
+    try:
+        response = await call_next(request)
+    except BaseException as e:
+        root.end(error=f"{e.__class__.__name__}: {e}")
+        if profile is not None:
+            profiler.end_request_profile(profile, rate_limit.r)
+        raise
+    route = request.scope.get("route")
+    root.name = f"{request.method} {getattr(route, 'path', request.url.path)}"
+    root.set("http.status_code", response.status_code)
     response.headers["X-Request-ID"] = rid
+    response.headers["traceresponse"] = root.traceparent
+    # Streamed bodies outlive call_next; the span ends with the last byte
+    response.body_iterator = tracing.finish_with(response.body_iterator, root)
+    if profile is not None:
+        response.headers["X-Profile-Id"] = profile.id
+        response.body_iterator = profiler.finish_request(response.body_iterator, profile, rate_limit.r)
     return response
 
 # --------- JWT auth (Django SimpleJWT) ----------
@@ -64,16 +125,42 @@ JWT_AUDIENCE = os.getenv("JWT_AUD", None)  # optional
 JWT_ALG = os.getenv("JWT_ALG", "HS256")
 JWT_SECRET = os.getenv("JWT_SECRET", "change-me")  # set this to Django SIMPLE_JWT['SIGNING_KEY']
 
-def get_current_user(authorization: str = Header(None)):
-    if not authorization or not authorization.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = authorization.split(" ", 1)[1]
+def verify_token(token: str) -> dict | None:
+    """The user a token belongs to, or None if it doesn't verify."""
+    # Signature is verified once per token; cached until the token's exp
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG], audience=JWT_AUDIENCE)
-        return {"user_id": str(payload.get("user_id") or payload.get("user", "")), "email": payload.get("email")}
     except JWTError as e:
         logger.warning("Invalid JWT: %s", str(e))
-        raise HTTPException(status_code=401, detail="Invalid token")
+        return None
+    user = {
+        "user_id": str(payload.get("user_id") or payload.get("user", "")),
+        "email": payload.get("email"),
+        "ent": payload.get("ent"),  # entitlements claim (plan, limits, flags, version)
+        "exp": payload.get("exp"),
+        "staff": bool(payload.get("staff")),
+    }
+    token_cache.put(token, user, payload.get("exp"))
+    return user
+
+async def get_current_user(authorization: str = Header(None)):
+    if not authorization or not authorization.lower().startswith("bearer "):
+        raise HTTPException(status_code=401, detail="Missing bearer token")
+    with tracing.span("auth") as span:
+        user = verify_token(authorization.split(" ", 1)[1])
+        if user is None:
+            span.end(error="invalid token")
+            raise HTTPException(status_code=401, detail="Invalid token")
+        span.set("user_id", user["user_id"])
+    return user
+
+async def require_staff(user=Depends(get_current_user)):
+    if not user.get("staff"):
+        raise HTTPException(status_code=403, detail="Staff only")
+    return user
 
 # --------- Global exception handling ----------
 @app.exception_handler(SubscriptionLimitExceeded)
@@ -84,54 +171,377 @@ async def handle_sub_limit(_: Request, exc: SubscriptionLimitExceeded):
 @app.exception_handler(RateLimitExceeded)
 async def handle_rate_limit(_: Request, exc: RateLimitExceeded):
     logger.warning("Rate limited: %s", str(exc))
-    return JSONResponse(status_code=429, content={"error": str(exc), "request_id": request_id_var.get()})
+    return JSONResponse(
+        status_code=429,
+        content={"error": str(exc), "request_id": request_id_var.get()},
+        headers=exc.headers,
+    )
 
 @app.exception_handler(ExternalServiceError)
 async def handle_ext(_: Request, exc: ExternalServiceError):
     logger.error("Upstream error: %s", str(exc))
     return JSONResponse(status_code=502, content={"error": "Upstream unavailable", "request_id": request_id_var.get()})
 
+@app.exception_handler(CapacityExceeded)
+async def handle_capacity(_: Request, exc: CapacityExceeded):
+    logger.warning("Over capacity: %s", str(exc))
+    return JSONResponse(
+        status_code=503,
+        content={"error": str(exc), "request_id": request_id_var.get()},
+        headers={"Retry-After": str(int(SCHEDULER_QUEUE_TIMEOUT))},
+    )
+
 @app.exception_handler(Exception)
 async def handle_all(_: Request, exc: Exception):
     logger.error("Unhandled error: %s", str(exc), exc_info=True)
     return JSONResponse(status_code=500, content={"error": "Internal server error", "request_id": request_id_var.get()})
 
 # --------- AI chat endpoint (stream) ----------
-OLLAMA_URL = os.getenv("OLLAMA_URL", "http://ollama:11434")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3")
+
+# Used when a user has no plan synced from Django yet; a limit of 0 disables that window.
+DEFAULT_QUOTA_LIMITS = {
+    "minute": int(os.getenv("MINUTE_MESSAGE_LIMIT", "0")),
+    "hour": int(os.getenv("HOURLY_MESSAGE_LIMIT", "0")),
+    "day": int(os.getenv("DAILY_MESSAGE_LIMIT", "100")),
+    "month": int(os.getenv("MONTHLY_MESSAGE_LIMIT", "0")),
+}
 
-def enforce_plan_and_rate(user_id: str) -> None:
+# Prompt + completion tokens per window, charged from Ollama's reported counts
+DEFAULT_TOKEN_LIMITS = {
+    "day": int(os.getenv("DAILY_TOKEN_LIMIT", "0")),
+    "month": int(os.getenv("MONTHLY_TOKEN_LIMIT", "0")),
+}
+
+async def resolve_limits(user_id: str, claim: dict | None = None) -> tuple[dict | None, dict]:
     """
-    Example: pull a per-user quota from env or default (hook this to DB later).
-    For demo, Free = 100/day. Replace with a lookup via Django API/DB if needed.
+    (plan, quota limits) from the entitlement cache, then the token claim, then env defaults.
+    The claim is only used for users Django hasn't synced yet: a synced user without an
+    active plan gets the defaults even while their token still carries the old plan.
     """
-    per_day_limit = int(os.getenv("DAILY_MESSAGE_LIMIT", "100"))
-    current, limit = incr_usage(user_id, per_day_limit)
-    logger.info("usage %s: %s/%s", user_id, current, limit)
+    known, plan = await entitlement_cache.lookup(user_id)
+    if not known:
+        plan = plan_from_claim(claim)
+    return plan, (plan_limits(plan) if plan else DEFAULT_QUOTA_LIMITS)
+
+def token_limits(plan: dict | None) -> dict:
+    return plan_token_limits(plan) if plan else DEFAULT_TOKEN_LIMITS
+
+async def enforce_plan_and_rate(user_id: str, claim: dict | None = None) -> tuple[dict, str | None]:
+    """
+    Enforce the user's plan limits (SubscriptionPlan.features, synced by Django),
+    resolved from the per-worker entitlement cache, then the token's entitlements
+    claim, then env defaults.
+    Spends from this worker's local quota lease; Redis is only hit to refill it.
+    Returns the X-RateLimit-* headers to attach to the response and the plan slug.
+    """
+    with tracing.span("quota", user_id=user_id):
+        plan, limits = await resolve_limits(user_id, claim)
+        try:
+            # Token quotas are checked against metered usage; nothing is spent until tokens are reported
+            await meter.check(user_id, token_limits(plan))
+            headers = await leased_quota.consume(user_id, limits)
+        except RateLimitExceeded:
+            metrics.quota_rejections.labels(OLLAMA_MODEL, metrics.plan_label((plan or {}).get("slug"))).inc()
+            raise
+    day_limit = int(headers.get("X-RateLimit-Limit-Day", 0))
+    day_used = day_limit - int(headers.get("X-RateLimit-Remaining-Day", 0))
+    usage_logger.info("usage %s: %s/%s", user_id, day_used, day_limit)
+    return headers, (plan or {}).get("slug")
+
+def stream_response(body, fmt: str, headers: dict) -> ClosingStreamingResponse:
+    if fmt == "sse":
+        # Keep reverse proxies from buffering the event stream
+        headers = {**headers, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return ClosingStreamingResponse(format_stream(body, fmt), media_type=FORMATS[fmt], headers=headers)
 
 @app.post("/chat")
-async def chat(payload: dict, user=Depends(get_current_user)):
-    prompt = (payload or {}).get("prompt", "").strip()
+async def chat(payload: dict, request: Request, user=Depends(get_current_user)):
+    payload = payload or {}
+    # Output framing: raw Ollama lines (default), compact NDJSON, SSE or plain text
+    fmt = negotiate(payload.get("format"), request.headers.get("accept"))
+    if fmt is None:
+        return JSONResponse(status_code=400, content={"error": "format must be one of " + ", ".join(FORMATS)})
+    try:
+        quota_headers, body = await open_chat(user, payload)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return stream_response(body, fmt, quota_headers)
+
+async def open_chat(user: dict, payload: dict) -> tuple[dict, AsyncIterator[bytes]]:
+    """
+    Quota, caches, session and admission for one chat turn, shared by /chat and /ws.
+    Returns the quota headers and the upstream NDJSON lines (queue status lines first
+    when saturated). Raises ValueError for invalid input.
+    """
+    started, started_ns, trace = time.perf_counter(), time.time_ns(), tracing.current()
+    prompt = payload.get("prompt", "")
+    prompt = prompt.strip() if isinstance(prompt, str) else ""
     if not prompt:
-        return JSONResponse(status_code=400, content={"error": "Prompt is required"})
+        raise ValueError("Prompt is required")
+    options = payload.get("options") or {}
+    if not isinstance(options, dict):
+        raise ValueError("options must be an object")
+    session_id = payload.get("session_id")
+    if session_id is not None and not session_store.valid_id(session_id):
+        raise ValueError("session_id must be 1-64 of [A-Za-z0-9_-]")
 
     # Quota checks
-    enforce_plan_and_rate(user_id=user["user_id"])
+    quota_headers, plan_slug = await enforce_plan_and_rate(user_id=user["user_id"], claim=user.get("ent"))
+
+    # Opt-in caches: exact match first, then nearest past prompt by embedding.
+    # Hits replay a stored stream with identical framing.
+    gen_key = response_cache.key(OLLAMA_MODEL, prompt, options)
+    # Session turns depend on earlier turns, so they are never cached or shared
+    use_cache = payload.get("cache") is True and session_id is None
+    if use_cache and response_cache.enabled:
+        cached = await response_cache.get(gen_key)
+        if cached is not None:
+            return quota_headers, response_cache.replay(cached)
+    partition, prompt_vec = semantic_cache.partition_key(OLLAMA_MODEL, options), None
+    if use_cache and semantic_cache.enabled:
+        prompt_vec = await semantic_cache.embed(prompt)
+        cached = semantic_cache.search(partition, prompt_vec) if prompt_vec is not None else None
+        if cached is not None:
+            return quota_headers, response_cache.replay(cached)
+
+    # Continue from the stored Ollama context when possible, else replay the transcript
+    session = await session_store.load(user["user_id"], session_id) if session_id else None
+    prompt_fields = session_store.prompt_fields(session, OLLAMA_MODEL, prompt) if session_id else {"prompt": prompt}
 
-    # Stream from Ollama
+    # Requests joining an in-flight generation add no upstream load and skip the queue
+    joining = session_id is None and coalescer.has_flight(gen_key)
+    ticket = None if joining else scheduler.submit(user["user_id"], plan_slug)
+
+    async def start_generation():
+        opened = False
+
+        async def open_generation():
+            nonlocal opened, ticket
+            opened = True
+            if ticket is None:
+                # The flight we meant to join finished in between: count this one too
+                ticket = scheduler.submit(user["user_id"], plan_slug, force=True)
+            # Stream from the least loaded Ollama node; upstream errors raise before streaming starts
+            upstream = {"model": OLLAMA_MODEL, "stream": True, **prompt_fields}
+            if options:
+                upstream["options"] = options
+            body = await ollama_client.open_stream("/api/generate", upstream)
+            if use_cache and response_cache.enabled:
+                body = response_cache.record(gen_key, body)
+            if prompt_vec is not None:
+                body = semantic_cache.record(partition, prompt_vec, body)
+            if session_id:
+                body = session_store.record(user["user_id"], session_id, OLLAMA_MODEL, prompt, session, body)
+            # The slot is held for as long as the upstream stream is being pumped
+            return scheduler.hold(ticket, body)
+
+        # Identical in-flight generations share one upstream stream
+        try:
+            body = await (open_generation() if session_id else coalescer.stream(gen_key, open_generation))
+        except BaseException as e:
+            if ticket is not None:
+                scheduler.release(ticket)
+            if isinstance(e, ExternalServiceError):
+                metrics.upstream_errors.labels(OLLAMA_MODEL, metrics.plan_label(plan_slug)).inc()
+            elif isinstance(e, asyncio.CancelledError):
+                # Client left while waiting for the first token
+                meter.record(user["user_id"], OLLAMA_MODEL, 0, 0, aborted=True)
+            raise
+        if ticket is not None and not opened:
+            scheduler.release(ticket)
+        # Metered and timed per client: an abandoned stream is recorded with the tokens it got
+        body = metrics.track(meter.track(user["user_id"], OLLAMA_MODEL, body), OLLAMA_MODEL, plan_slug, started)
+        return tracing.trace_stream(body, trace, started_ns)
+
+    if ticket is None or ticket.admitted:
+        return quota_headers, await start_generation()
+
+    async def queued_body():
+        # Saturated: report queue position as NDJSON status lines until admitted.
+        # Errors after this point can only be reported in-band.
+        try:
+            async for position in scheduler.wait_with_feedback(ticket):
+                yield json.dumps({"status": "queued", "position": position}).encode() + b"\n"
+            body = await start_generation()
+        except CapacityExceeded as e:
+            logger.warning("Over capacity: %s", str(e))
+            yield json.dumps({"error": str(e), "done": True}).encode() + b"\n"
+            return
+        except ExternalServiceError as e:
+            logger.error("Upstream error: %s", str(e))
+            yield json.dumps({"error": "Upstream unavailable", "done": True}).encode() + b"\n"
+            return
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            await body.aclose()
+
+    # Dropped unread (client gone before the first status line): withdraw the ticket
+    return quota_headers, ClosingIterator(queued_body(), cleanup=lambda: scheduler.cancel(ticket))
+
+# --------- WebSocket chat (one auth per connection, multiplexed streams) ----------
+@app.websocket("/ws")
+async def chat_ws(websocket: WebSocket):
+    await websocket.accept()
+    request_id_var.set(websocket.headers.get("x-request-id") or str(uuid.uuid4()))
+    conn = ChatConnection(websocket)
+    user = await conn.authenticate(verify_token)
+    if user is None:
+        return
+    logger.info("ws open %s", user["user_id"])
+    await conn.serve(lambda payload: open_chat(user, payload))
+    logger.info("ws closed %s", user["user_id"])
+
+# --------- Batch chat (NDJSON, one line per item as it completes) ----------
+@app.post("/chat/batch")
+async def chat_batch(payload: dict, user=Depends(get_current_user)):
+    payload = payload or {}
     try:
-        def gen() -> AsyncGenerator[bytes, None]:
-            with requests.post(
-                f"{OLLAMA_URL}/api/generate",
-                json={"model": os.getenv("OLLAMA_MODEL", "llama3"), "prompt": prompt, "stream": True},
-                stream=True,
-                timeout=60,
-            ) as resp:
-                if resp.status_code >= 400:
-                    raise ExternalServiceError(f"Ollama error {resp.status_code}: {resp.text[:200]}")
-                for chunk in resp.iter_lines(decode_unicode=True):
-                    if chunk:
-                        # You can parse JSON chunks; here we just emit text content if present
-                        yield chunk.encode("utf-8") + b"\n"
-        return StreamingResponse(gen(), media_type="text/plain")
-    except requests.RequestException as e:
-        raise ExternalServiceError(str(e))
+        items = validate_items(payload.get("items"))
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    concurrency = payload.get("concurrency")
+    if concurrency is None:
+        concurrency = BATCH_MAX_CONCURRENCY
+    if isinstance(concurrency, bool) or not isinstance(concurrency, int) or concurrency < 1:
+        return JSONResponse(status_code=400, content={"error": "concurrency must be a positive integer"})
+    concurrency = min(concurrency, BATCH_MAX_CONCURRENCY)
+
+    # The whole batch is charged in one atomic step: all items fit the quota or none run
+    user_id = user["user_id"]
+    with tracing.span("quota", user_id=user_id, items=len(items)):
+        plan, limits = await resolve_limits(user_id, user.get("ent"))
+        plan_slug = (plan or {}).get("slug")
+        try:
+            await meter.check(user_id, token_limits(plan))
+            charge = await rate_limit.consume(user_id, limits, cost=len(items))
+        except RateLimitExceeded:
+            metrics.quota_rejections.labels(OLLAMA_MODEL, metrics.plan_label(plan_slug)).inc()
+            raise
+    logger.info("batch %s: %s items", user_id, len(items))
+
+    async def generate(item: dict) -> dict:
+        # Each item still goes through admission so batches can't starve interactive chat
+        ticket = scheduler.submit(user_id, plan_slug)
+        try:
+            async for _ in scheduler.wait_with_feedback(ticket):
+                pass
+            # Streamed upstream like worker.py: the read timeout then applies per chunk,
+            # not to the whole generation, and the breaker sees time to first output
+            upstream = {"model": OLLAMA_MODEL, "prompt": item["prompt"], "stream": True}
+            if item["options"]:
+                upstream["options"] = item["options"]
+            lines = await ollama_client.open_stream("/api/generate", upstream)
+            pieces, final = [], None
+            try:
+                async for line in lines:
+                    obj = json.loads(line)
+                    if obj.get("error"):
+                        raise ExternalServiceError(obj["error"])
+                    pieces.append(obj.get("response") or "")
+                    if obj.get("done") is True:
+                        final = obj
+            finally:
+                await lines.aclose()
+            if final is None:
+                raise ExternalServiceError("Upstream stream ended early")
+        except ExternalServiceError:
+            metrics.upstream_errors.labels(OLLAMA_MODEL, metrics.plan_label(plan_slug)).inc()
+            raise
+        finally:
+            scheduler.cancel(ticket)
+        meter.record(user_id, OLLAMA_MODEL, final.get("prompt_eval_count") or 0, final.get("eval_count") or 0, aborted=False)
+        return {"response": "".join(pieces), "usage": usage(final)}
+
+    async def refund_unserved(unserved: int) -> None:
+        if unserved and charge.keys:
+            await rate_limit.refund(user_id, charge.keys, unserved)
+
+    body = run_batch(items, generate, concurrency, refund_unserved)
+    return ClosingStreamingResponse(body, media_type="application/x-ndjson", headers=charge.headers())
+
+# --------- Async jobs (run by worker.py, results kept for JOB_RESULT_TTL) ----------
+@app.post("/jobs", status_code=202)
+async def create_job(payload: dict, user=Depends(get_current_user)):
+    payload = payload or {}
+    prompt = payload.get("prompt", "").strip()
+    if not prompt:
+        return JSONResponse(status_code=400, content={"error": "Prompt is required"})
+    options = payload.get("options") or {}
+    if not isinstance(options, dict):
+        return JSONResponse(status_code=400, content={"error": "options must be an object"})
+
+    quota_headers, _ = await enforce_plan_and_rate(user_id=user["user_id"], claim=user.get("ent"))
+    job_id = await job_store.submit(user["user_id"], OLLAMA_MODEL, prompt, options)
+    if job_id is None:
+        raise CapacityExceeded("Job queue is full, try again later")
+    return JSONResponse(status_code=202, content={"job_id": job_id, "status": "queued"}, headers=quota_headers)
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0, user=Depends(get_current_user)):
+    """Job status/result; with ?wait=N, long-polls up to N seconds for it to finish."""
+    job = await job_store.wait(job_id, min(max(wait, 0), JOB_MAX_WAIT))
+    if job is None or job.get("user_id") != user["user_id"]:
+        return JSONResponse(status_code=404, content={"error": "Job not found"})
+    return public_view(job)
+
+@app.get("/cache/stats")
+async def cache_stats(user=Depends(require_staff)):
+    return {"exact": await response_cache.stats(), "semantic": semantic_cache.stats(), "token": token_cache.stats()}
+
+@app.get("/scheduler/stats")
+async def scheduler_stats(user=Depends(require_staff)):
+    return {"scheduler": scheduler.stats(), "coalescer": coalescer.stats()}
+
+@app.get("/usage/stats")
+async def usage_stats(user=Depends(require_staff)):
+    return meter.stats()
+
+@app.get("/upstream/stats")
+async def upstream_stats(user=Depends(require_staff)):
+    return ollama_client.get_pool().stats()
+
+# --------- Prometheus metrics (every web and job worker process, labelled by proc) ----------
+metrics.Gauge(
+    "chat_queue_depth", "Requests waiting for a generation slot", ("plan",),
+    collect=lambda: {(metrics.plan_label(slug),): n for slug, n in scheduler.queue_depths().items()},
+)
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(await metrics.REGISTRY.scrape(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# --------- Sampling profiler (staff only, collapsed stacks; see profiler.py) ----------
+def staff_profile_requested(request: Request) -> bool:
+    """`X-Profile` sent with a staff token; anything else is served as usual."""
+    if not (profiler.PROFILING_ENABLED and request.headers.get("x-profile")):
+        return False
+    authorization = request.headers.get("authorization") or ""
+    user = verify_token(authorization.split(" ", 1)[1]) if authorization.lower().startswith("bearer ") else None
+    return user is not None and user["staff"]
+
+@app.post("/debug/profile", status_code=202)
+async def start_profile(seconds: float = 10, user=Depends(require_staff)):
+    """Sample everything this worker does for `seconds`; fetch the result from GET /debug/profile/{id}."""
+    if not profiler.PROFILING_ENABLED:
+        return JSONResponse(status_code=404, content={"error": "Profiling is disabled"})
+    if not math.isfinite(seconds) or seconds <= 0:
+        return JSONResponse(status_code=400, content={"error": "seconds must be a positive number"})
+    if profiler.worker_profile_running():
+        return JSONResponse(status_code=409, content={"error": "A profile is already running in this worker"})
+    profile = await profiler.start_worker_profile(rate_limit.r, seconds)
+    return {"id": profile.id, "pid": os.getpid(), "seconds": profile.seconds}
+
+@app.get("/debug/profile/{profile_id}")
+async def get_profile(profile_id: str, user=Depends(require_staff)):
+    result = await profiler.load(rate_limit.r, profile_id)
+    if result is None:
+        return JSONResponse(status_code=404, content={"error": "Profile not found"})
+    if result["status"] != "done":
+        return JSONResponse(status_code=202, content={"status": result["status"], "pid": int(result["pid"])})
+    return Response(
+        result["stacks"], media_type="text/plain; charset=utf-8",
+        headers={"X-Profile-Samples": result["samples"], "X-Profile-Seconds": result["seconds"]},
+    )
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+import redis.asyncio as redis
+
+import rate_limit
+from exceptions import RateLimitExceeded
+from stream_format import ClosingIterator, response_token
+
+logger = logging.getLogger(__name__)
+
+METER_FLUSH_INTERVAL = float(os.getenv("METER_FLUSH_INTERVAL", "2"))
+# Flush early once this many events are buffered
+METER_BATCH_SIZE = int(os.getenv("METER_BATCH_SIZE", "500"))
+# Events kept while Redis is unreachable; the oldest are dropped beyond this
+METER_MAX_BUFFER = int(os.getenv("METER_MAX_BUFFER", "100000"))
+# How long a user's token usage read from Redis is trusted for quota checks
+METER_QUOTA_TTL = float(os.getenv("METER_QUOTA_TTL", "5"))
+
+# Read by django-app (users/usage.py, `manage.py rollup_usage`); keep the layout in sync.
+EVENTS_KEY = "usage:events"
+TOKEN_PREFIX = "tokens"  # tokens:<window>:<bucket>:<shard> hash user_id -> tokens
+TOKEN_WINDOWS = ("day", "month")
+
+
+def usage_event(user_id: str, model: str, prompt_tokens: int, completion_tokens: int, aborted: bool, service: str) -> str:
+    return json.dumps({
+        "user_id": user_id,
+        "model": model,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "aborted": aborted,
+        "service": service,
+        "ts": int(time.time()),
+    }, separators=(",", ":"))
+
+
+class Meter:
+    """
+    Token usage from Ollama's final chunk (prompt_eval_count / eval_count), or the
+    tokens streamed so far when the client abandoned the generation.
+
+    Usage is buffered in memory and written by a background task in one pipelined
+    round trip per flush: the events go to a Redis list that Django rolls up into
+    Postgres, and the totals go to per-window token counters that token quotas are
+    checked against. Nothing is written per request.
+    """
+
+    def __init__(self, client: redis.Redis, service: str = "chat"):
+        self.r = client
+        self.service = service
+        self._events: Deque[str] = deque()
+        self._charges: Dict[str, int] = {}  # user_id -> tokens not yet added to the counters
+        self._used: Dict[str, Tuple[float, Dict[str, int]]] = {}  # user_id -> (expires, window -> tokens)
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.completed = 0
+        self.aborted = 0
+        self.completion_tokens = 0
+        self.aborted_tokens = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.flush_errors = 0
+
+    # ---- recording ----
+    def track(self, user_id: str, model: str, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """Pass a live stream through; record its usage when it ends, however it ends (read or not)."""
+        return ClosingIterator(
+            self._track(user_id, model, stream), stream, lambda: self.record(user_id, model, 0, 0, aborted=True),
+        )
+
+    async def _track(self, user_id: str, model: str, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        tokens = 0
+        final = None
+        try:
+            async for chunk in stream:
+                if final is None:
+                    if b'"done":true' in chunk or b'"done": true' in chunk:
+                        try:
+                            obj = json.loads(chunk)
+                        except ValueError:
+                            obj = None
+                        final = obj if isinstance(obj, dict) and obj.get("done") is True else None
+                    elif response_token(chunk):
+                        # Ollama streams one token per line
+                        tokens += 1
+                yield chunk
+        finally:
+            if final is not None:
+                self.record(user_id, model, final.get("prompt_eval_count") or 0, final.get("eval_count") or tokens, aborted=False)
+            else:
+                self.record(user_id, model, 0, tokens, aborted=True)
+            await stream.aclose()
+
+    def record(self, user_id: str, model: str, prompt_tokens: int, completion_tokens: int, aborted: bool) -> None:
+        if aborted:
+            self.aborted += 1
+            self.aborted_tokens += completion_tokens
+            logger.info("generation %s aborted after %s tokens", user_id, completion_tokens)
+        else:
+            self.completed += 1
+        self.completion_tokens += completion_tokens
+
+        self._events.append(usage_event(user_id, model, prompt_tokens, completion_tokens, aborted, self.service))
+        while len(self._events) > METER_MAX_BUFFER:
+            self._events.popleft()
+            self.dropped += 1
+        total = prompt_tokens + completion_tokens
+        if total:
+            self._charges[user_id] = self._charges.get(user_id, 0) + total
+        if len(self._events) >= METER_BATCH_SIZE:
+            self._wake.set()
+
+    # ---- token quotas ----
+    async def check(self, user_id: str, limits: Dict[str, int]) -> None:
+        """Raise RateLimitExceeded if the user has used up a token window (0 = no limit)."""
+        windows = [w for w in TOKEN_WINDOWS if limits.get(w)]
+        if not windows:
+            return
+        used = await self._usage(user_id)
+        pending = self._charges.get(user_id, 0)
+        for w in windows:
+            if used.get(w, 0) + pending >= limits[w]:
+                _, reset = rate_limit.window_bucket(w, time.time())
+                raise RateLimitExceeded(
+                    f"{'Daily' if w == 'day' else 'Monthly'} token quota exceeded: {used.get(w, 0) + pending}/{limits[w]}",
+                    headers={"Retry-After": str(reset)},
+                )
+
+    async def _usage(self, user_id: str) -> Dict[str, int]:
+        now = time.monotonic()
+        cached = self._used.get(user_id)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        wall = time.time()
+        pipe = self.r.pipeline(transaction=False)
+        for w in TOKEN_WINDOWS:
+            bucket, _ = rate_limit.window_bucket(w, wall)
+            pipe.hget(rate_limit.bucket_key(w, bucket, user_id, TOKEN_PREFIX), user_id)
+        used = {w: int(v or 0) for w, v in zip(TOKEN_WINDOWS, await pipe.execute())}
+        self._used[user_id] = (now + METER_QUOTA_TTL, used)
+        return used
+
+    # ---- persistence ----
+    async def flush(self) -> None:
+        if not self._events and not self._charges:
+            return
+        events = list(self._events)
+        charges, self._charges = self._charges, {}
+        self._events.clear()
+
+        now = time.time()
+        pipe = self.r.pipeline(transaction=False)
+        for i in range(0, len(events), METER_BATCH_SIZE):
+            pipe.rpush(EVENTS_KEY, *events[i:i + METER_BATCH_SIZE])
+        for w in TOKEN_WINDOWS:
+            bucket, reset = rate_limit.window_bucket(w, now)
+            for user_id, tokens in charges.items():
+                key = rate_limit.bucket_key(w, bucket, user_id, TOKEN_PREFIX)
+                pipe.hincrby(key, user_id, tokens)
+                pipe.expire(key, reset + rate_limit.QUOTA_KEY_TTL_BUFFER)
+        try:
+            await pipe.execute()
+        except redis.RedisError as e:
+            # Keep everything for the next attempt, oldest first
+            self.flush_errors += 1
+            logger.warning("Usage flush failed, %s events kept: %s", len(events), str(e))
+            self._events.extendleft(reversed(events))
+            for user_id, tokens in charges.items():
+                self._charges[user_id] = self._charges.get(user_id, 0) + tokens
+            return
+        self.flushed += len(events)
+        # The counters now include these charges; drop cached reads that don't
+        for user_id in charges:
+            self._used.pop(user_id, None)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), METER_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Usage flush failed: %s", str(e), exc_info=True)
+            now = time.monotonic()
+            self._used = {u: entry for u, entry in self._used.items() if entry[0] > now}
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "completed": self.completed,
+            "aborted": self.aborted,
+            "completion_tokens": self.completion_tokens,
+            "aborted_tokens": self.aborted_tokens,
+            "buffered": len(self._events),
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "flush_errors": self.flush_errors,
+        }
+
+
+meter = Meter(rate_limit.r)
@@ -0,0 +1,322 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+import threading
+from bisect import bisect_left
+from typing import AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+
+import redis.asyncio as redis
+
+from stream_format import ClosingIterator, response_token
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Each process (web and job workers) publishes its series this often; /metrics returns
+# them all, each labelled with its process
+METRICS_PUBLISH_INTERVAL = float(os.getenv("METRICS_PUBLISH_INTERVAL", "5"))
+
+PROCESS_KEY = "metrics:proc:{proc}"  # JSON snapshot, expires when its process stops publishing
+PROC_LABEL = "proc"
+
+Labels = Tuple[str, ...]
+
+
+class _Sharded:
+    """
+    A fixed-size list of numbers with one copy per thread. Only the owning thread
+    writes its copy, so += never races and recording takes no lock; readers sum.
+    """
+
+    __slots__ = ("size", "_local", "_shards")
+
+    def __init__(self, size: int):
+        self.size = size
+        self._local = threading.local()
+        self._shards: List[list] = []
+
+    def shard(self) -> list:
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = [0] * self.size
+            self._shards.append(values)
+            return values
+
+    def values(self) -> list:
+        total = [0] * self.size
+        for shard in list(self._shards):
+            for i, v in enumerate(shard):
+                total[i] += v
+        return total
+
+
+class _Value(_Sharded):
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount: float = 1) -> None:
+        self.shard()[0] += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.shard()[0] -= amount
+
+
+class _Buckets(_Sharded):
+    """Per-bucket counts (non-cumulative, +Inf last) followed by the sum."""
+
+    __slots__ = ("bounds",)
+
+    def __init__(self, bounds: Sequence[float]):
+        super().__init__(len(bounds) + 2)
+        self.bounds = bounds
+
+    def observe(self, value: float) -> None:
+        shard = self.shard()
+        # First bucket whose upper bound is >= value (Prometheus buckets are inclusive)
+        shard[bisect_left(self.bounds, value)] += 1
+        shard[-1] += value
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), registry: Optional["Registry"] = None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Labels, _Sharded] = {}
+        (registry or REGISTRY).metrics.append(self)
+
+    def labels(self, *values) -> _Sharded:
+        """The series for these label values. Look it up once per stream, not per token."""
+        key = tuple("" if v is None else str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children.setdefault(key, self._child())
+        return child
+
+    def _child(self) -> _Sharded:
+        return _Value()
+
+    def series(self) -> Dict[Labels, list]:
+        return {key: child.values() for key, child in list(self._children.items())}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+
+class Gauge(Metric):
+    """Tracked with inc()/dec(), or read at scrape time from `collect` ({label values: value})."""
+
+    kind = "gauge"
+
+    def __init__(self, *args, collect: Optional[Callable[[], Dict[Labels, float]]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.collect = collect
+
+    def series(self) -> Dict[Labels, list]:
+        out = super().series()
+        if self.collect is not None:
+            for key, value in self.collect().items():
+                out[key] = [value]
+        return out
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self) -> _Buckets:
+        return _Buckets(self.buckets)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], *extra: str) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _num(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Registry:
+    """
+    Process-local series, plus sharing through Redis: every process publishes a
+    snapshot every METRICS_PUBLISH_INTERVAL, and a scrape of any web worker
+    returns the series of all live processes, each with a `proc` label
+    (host:pid). Summing is left to PromQL, e.g. sum without (proc) (rate(...)):
+    a counter of a process that exits then ends as a series of its own rather
+    than dropping out of a total, which rate() would read as a reset.
+    """
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.r: Optional[redis.Redis] = None
+        self.proc = f"{socket.gethostname()}:{os.getpid()}"
+        self._task: Optional[asyncio.Task] = None
+
+    def snapshot(self) -> dict:
+        """{name: [[label values, values], ...]}, JSON serialisable."""
+        return {m.name: [[list(k), v] for k, v in m.series().items()] for m in self.metrics}
+
+    def render(self, snapshots: Dict[str, dict]) -> str:
+        """Prometheus text format of `snapshots` ({proc: snapshot}), every series labelled with its proc."""
+        lines = []
+        for m in self.metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            size = len(m.buckets) + 2 if isinstance(m, Histogram) else 1
+            for proc, snap in sorted(snapshots.items()):
+                p = f'{PROC_LABEL}="{_escape(proc)}"'
+                for key, values in sorted((tuple(k), v) for k, v in snap.get(m.name, [])):
+                    if len(values) != size:
+                        continue  # published by a process with other buckets (mid-deploy)
+                    if isinstance(m, Histogram):
+                        cumulative = 0
+                        for bound, count in zip((*m.buckets, "+Inf"), values):
+                            cumulative += count
+                            le = 'le="%s"' % ("+Inf" if bound == "+Inf" else _num(bound))
+                            lines.append(f"{m.name}_bucket{_labels(m.labelnames, key, p, le)} {cumulative}")
+                        lines.append(f"{m.name}_sum{_labels(m.labelnames, key, p)} {_num(values[-1])}")
+                        lines.append(f"{m.name}_count{_labels(m.labelnames, key, p)} {cumulative}")
+                    else:
+                        lines.append(f"{m.name}{_labels(m.labelnames, key, p)} {_num(values[0])}")
+        return "\n".join(lines) + "\n"
+
+    async def scrape(self) -> str:
+        """Text exposition for GET /metrics: this process live, the others as last published."""
+        snapshots = {self.proc: self.snapshot()}
+        if self.r is not None:
+            try:
+                own = PROCESS_KEY.format(proc=self.proc)
+                prefix = PROCESS_KEY.format(proc="")
+                keys = [k async for k in self.r.scan_iter(match=prefix + "*", count=100) if k != own]
+                for key, raw in zip(keys, (await self.r.mget(keys)) if keys else []):
+                    if raw:
+                        snapshots[key[len(prefix):]] = json.loads(raw)
+            except redis.RedisError as e:
+                logger.warning("Metrics from other processes unavailable: %s", str(e))
+        return self.render(snapshots)
+
+    # ---- sharing ----
+    async def publish(self) -> None:
+        await self.r.set(
+            PROCESS_KEY.format(proc=self.proc),
+            json.dumps(self.snapshot(), separators=(",", ":")),
+            ex=max(1, int(METRICS_PUBLISH_INTERVAL * 3)),
+        )
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.publish()
+            except Exception as e:
+                logger.warning("Metrics publish failed: %s", str(e))
+            await asyncio.sleep(METRICS_PUBLISH_INTERVAL)
+
+    def start(self, client: redis.Redis) -> None:
+        if METRICS_ENABLED and self._task is None:
+            self.r = client
+            self._task = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            try:
+                # Final counts, scraped until the key expires: nothing recorded since the last publish is lost
+                await self.publish()
+            except redis.RedisError as e:
+                logger.warning("Metrics publish failed: %s", str(e))
+
+
+REGISTRY = Registry()
+
+# ---- streaming latency, per client stream ----
+time_to_first_token = Histogram(
+    "chat_time_to_first_token_seconds", "Request start to the first token sent to the client, queueing included",
+    ("model", "plan"), buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60),
+)
+inter_token = Histogram(
+    "chat_inter_token_seconds", "Gap between consecutive tokens sent to the client",
+    ("model", "plan"), buckets=(0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1, 2.5),
+)
+tokens_per_second = Histogram(
+    "chat_tokens_per_second", "Tokens per second after the first token, per completed stream",
+    ("model", "plan"), buckets=(1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200),
+)
+stream_duration = Histogram(
+    "chat_stream_duration_seconds", "Request start to the end of the stream, however it ended",
+    ("model", "plan"), buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+upstream_connect = Histogram(
+    "ollama_connect_seconds", "Time until an Ollama node returned response headers",
+    ("model", "node"), buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+streams_in_flight = Gauge("chat_streams_in_flight", "Client streams currently being sent", ("model", "plan"))
+
+# ---- outcomes ----
+quota_rejections = Counter("chat_quota_rejections_total", "Requests refused by a rate or token quota", ("model", "plan"))
+upstream_errors = Counter("chat_upstream_errors_total", "Generations that failed because Ollama was unavailable", ("model", "plan"))
+
+
+def plan_label(plan: Optional[str]) -> str:
+    return plan or "none"
+
+
+def track(stream: AsyncIterator[bytes], model: str, plan: Optional[str], started: float) -> AsyncIterator[bytes]:
+    """
+    Pass a client's upstream NDJSON lines through, timing the tokens as they are
+    handed on. `started` is the request's time.perf_counter().
+    """
+    return ClosingIterator(_track(stream, model, plan, started), stream)
+
+
+async def _track(stream: AsyncIterator[bytes], model: str, plan: Optional[str], started: float) -> AsyncIterator[bytes]:
+    if not METRICS_ENABLED:
+        async for chunk in stream:
+            yield chunk
+        return
+    key = (model, plan_label(plan))
+    ttft, gap = time_to_first_token.labels(*key), inter_token.labels(*key)
+    in_flight = streams_in_flight.labels(*key)
+    in_flight.inc()
+    first = last = None
+    tokens = 0
+    done = False
+    try:
+        async for chunk in stream:
+            if response_token(chunk):
+                now = time.perf_counter()
+                if first is None:
+                    first = now
+                    ttft.observe(now - started)
+                else:
+                    gap.observe(now - last)
+                last = now
+                tokens += 1
+            yield chunk
+        done = True
+    finally:
+        in_flight.dec()
+        end = time.perf_counter()
+        stream_duration.labels(*key).observe(end - started)
+        if done and tokens > 1 and last > first:
+            tokens_per_second.labels(*key).observe((tokens - 1) / (last - first))
+        await stream.aclose()
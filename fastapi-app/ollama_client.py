@@ -0,0 +1,76 @@
+import os
+import logging
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from ollama_pool import OllamaPool
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://ollama:11434")
+# Comma-separated Ollama nodes to route over; defaults to the single OLLAMA_URL
+OLLAMA_URLS = [u.strip() for u in os.getenv("OLLAMA_URLS", OLLAMA_URL).split(",") if u.strip()]
+
+# Pool + timeouts (read timeout is per chunk, not per whole generation)
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "1000"))
+OLLAMA_MAX_KEEPALIVE = int(os.getenv("OLLAMA_MAX_KEEPALIVE", "100"))
+OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "30"))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "60"))
+OLLAMA_POOL_TIMEOUT = float(os.getenv("OLLAMA_POOL_TIMEOUT", "10"))
+
+_pool: Optional[OllamaPool] = None
+
+
+def build_client(base_url: str = OLLAMA_URL) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=base_url,
+        limits=httpx.Limits(
+            max_connections=OLLAMA_MAX_CONNECTIONS,
+            max_keepalive_connections=OLLAMA_MAX_KEEPALIVE,
+            keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            connect=OLLAMA_CONNECT_TIMEOUT,
+            read=OLLAMA_READ_TIMEOUT,
+            write=OLLAMA_CONNECT_TIMEOUT,
+            pool=OLLAMA_POOL_TIMEOUT,
+        ),
+    )
+
+
+async def startup() -> None:
+    global _pool
+    if _pool is None:
+        _pool = OllamaPool(OLLAMA_URLS, build_client)
+        await _pool.probe_all()
+        _pool.start()
+        logger.info("Ollama pool ready (%s, max_connections=%s per node)", ",".join(OLLAMA_URLS), OLLAMA_MAX_CONNECTIONS)
+
+
+async def shutdown() -> None:
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def get_pool() -> OllamaPool:
+    if _pool is None:
+        raise RuntimeError("Ollama client not started")
+    return _pool
+
+
+async def post(path: str, payload: dict) -> httpx.Response:
+    """Non-streaming POST routed over the pool (e.g. embeddings)."""
+    return await get_pool().post(path, payload)
+
+
+async def open_stream(path: str, payload: dict) -> AsyncIterator[bytes]:
+    """
+    Send a streaming POST and return its NDJSON line iterator once output starts.
+    Upstream/connect errors on every node are raised here (before the HTTP response
+    starts), so they still map to a clean 502. The iterator releases its connection.
+    """
+    return await get_pool().open_stream(path, payload)
@@ -0,0 +1,360 @@
+import os
+import time
+import asyncio
+import logging
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Set
+
+import httpx
+
+import metrics
+import tracing
+from exceptions import ExternalServiceError
+from stream_format import ClosingIterator
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_MAX_ATTEMPTS = int(os.getenv("OLLAMA_MAX_ATTEMPTS", "3"))
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "5"))
+OLLAMA_HEALTH_TIMEOUT = float(os.getenv("OLLAMA_HEALTH_TIMEOUT", "2"))
+# Breaker opens after this many consecutive failures, or when the smoothed
+# time to first line goes above the latency threshold; it half-opens after the cooldown.
+OLLAMA_BREAKER_FAILURES = int(os.getenv("OLLAMA_BREAKER_FAILURES", "3"))
+OLLAMA_BREAKER_LATENCY = float(os.getenv("OLLAMA_BREAKER_LATENCY", "30"))
+OLLAMA_BREAKER_COOLDOWN = float(os.getenv("OLLAMA_BREAKER_COOLDOWN", "10"))
+# Extra "outstanding streams" charged to a node that would have to load the model first
+OLLAMA_COLD_PENALTY = int(os.getenv("OLLAMA_COLD_PENALTY", "2"))
+
+LATENCY_EWMA_ALPHA = 0.3
+
+
+def model_name(model: str) -> str:
+    return model if ":" in model else model + ":latest"
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(
+        self,
+        name: str = "",
+        max_failures: int = OLLAMA_BREAKER_FAILURES,
+        latency_threshold: float = OLLAMA_BREAKER_LATENCY,
+        cooldown: float = OLLAMA_BREAKER_COOLDOWN,
+    ):
+        self.name = name
+        self.max_failures = max_failures
+        self.latency_threshold = latency_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.latency: Optional[float] = None
+        self.opened_at = 0.0
+        self.trips = 0
+        self._trial = False
+
+    def available(self, now: Optional[float] = None) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return (now or time.monotonic()) - self.opened_at >= self.cooldown
+        return not self._trial
+
+    def begin(self, now: Optional[float] = None) -> None:
+        """Called when a request is routed here; an expired open breaker lets one trial through."""
+        if self.state == self.OPEN and (now or time.monotonic()) - self.opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            self._trial = True
+
+    def success(self, latency: float) -> None:
+        self._trial = False
+        self.failures = 0
+        self.latency = latency if self.latency is None else (
+            LATENCY_EWMA_ALPHA * latency + (1 - LATENCY_EWMA_ALPHA) * self.latency
+        )
+        if self.latency > self.latency_threshold:
+            self.trip("latency %.2fs" % self.latency)
+        else:
+            self.state = self.CLOSED
+
+    def failure(self) -> None:
+        self._trial = False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.max_failures:
+            self.trip("%d consecutive failures" % self.failures)
+
+    def abandon(self) -> None:
+        """The routed request ended without a verdict (client went away)."""
+        self._trial = False
+
+    def trip(self, reason: str) -> None:
+        if self.state != self.OPEN:
+            self.trips += 1
+            logger.warning("Circuit for %s opened: %s", self.name, reason)
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.latency = None
+        self._trial = False
+
+
+class Node:
+    """One Ollama server: its own pooled client, load and what it has available/loaded."""
+
+    def __init__(self, url: str, client: httpx.AsyncClient, breaker: CircuitBreaker):
+        self.url = url
+        self.client = client
+        self.breaker = breaker
+        self.healthy = True
+        self.outstanding = 0
+        self.available_models: Optional[Set[str]] = None  # /api/tags; None until first probe
+        self.loaded_models: Set[str] = set()  # /api/ps
+        self.requests = 0
+        self.failures = 0
+
+    def routable(self, now: float) -> bool:
+        return self.healthy and self.breaker.available(now)
+
+    def has_model(self, model: str) -> bool:
+        return self.available_models is None or model in self.available_models
+
+    def cost(self, model: str) -> int:
+        return self.outstanding + (0 if model in self.loaded_models else OLLAMA_COLD_PENALTY)
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "breaker": self.breaker.state,
+            "outstanding": self.outstanding,
+            "latency": round(self.breaker.latency, 3) if self.breaker.latency is not None else None,
+            "loaded": sorted(self.loaded_models),
+            "requests": self.requests,
+            "failures": self.failures,
+            "trips": self.breaker.trips,
+        }
+
+
+class _Retry(Exception):
+    """Attempt failed on this node before any output; try another one."""
+
+    def __init__(self, message: str, node_fault: bool = True):
+        super().__init__(message)
+        self.node_fault = node_fault
+
+
+class OllamaPool:
+    """
+    Routes requests over several Ollama nodes: least outstanding streams first
+    (with a penalty for nodes that don't have the model loaded), skipping nodes
+    that failed their health probe or whose circuit breaker is open. Failures
+    before the first line of output are retried on another node.
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        client_factory: Callable[[str], httpx.AsyncClient],
+        max_attempts: int = OLLAMA_MAX_ATTEMPTS,
+        health_interval: float = OLLAMA_HEALTH_INTERVAL,
+    ):
+        self.nodes = [Node(url, client_factory(url), CircuitBreaker(url)) for url in urls]
+        self.max_attempts = max_attempts
+        self.health_interval = health_interval
+        self.retries = 0
+        self._prober: Optional[asyncio.Task] = None
+
+    # ---- routing ----
+    def pick(self, model: str, exclude: Set[Node]) -> Optional[Node]:
+        now = time.monotonic()
+        candidates = [n for n in self.nodes if n not in exclude and n.routable(now)]
+        if not candidates:
+            # Everything looks down: still try them rather than fail outright
+            candidates = [n for n in self.nodes if n not in exclude]
+        if not candidates:
+            return None
+        with_model = [n for n in candidates if n.has_model(model)] or candidates
+        return min(with_model, key=lambda n: n.cost(model))
+
+    def _attempts(self, model: str) -> Iterator[Node]:
+        """Yield up to max_attempts distinct nodes, best first at the time each is needed."""
+        tried: Set[Node] = set()
+        for attempt in range(min(self.max_attempts, len(self.nodes))):
+            node = self.pick(model, tried)
+            if node is None:
+                return
+            tried.add(node)
+            if attempt:
+                self.retries += 1
+            yield node
+
+    def _failed(self, node: Node, e: Exception) -> None:
+        node.failures += 1
+        if not isinstance(e, _Retry) or e.node_fault:
+            node.breaker.failure()
+        else:
+            node.breaker.abandon()
+        logger.warning("Ollama node %s failed: %s", node.url, str(e) or e.__class__.__name__)
+
+    async def _send(self, node: Node, method: str, path: str, payload: dict, stream: bool) -> httpx.Response:
+        try:
+            # Carries the trace on to Ollama (or a tracing proxy in front of it)
+            req = node.client.build_request(method, path, json=payload, headers=tracing.inject())
+            resp = await node.client.send(req, stream=stream)
+        except httpx.HTTPError as e:
+            raise _Retry(str(e) or e.__class__.__name__)
+        if resp.status_code < 400:
+            return resp
+        body = (await resp.aread())[:200].decode("utf-8", "replace")
+        await resp.aclose()
+        message = f"Ollama error {resp.status_code}: {body}"
+        if resp.status_code == 404:
+            # Model not pulled on this node; another one may have it
+            if node.available_models is not None:
+                node.available_models.discard(model_name(payload.get("model", "")))
+            raise _Retry(message, node_fault=False)
+        if resp.status_code >= 500:
+            raise _Retry(message)
+        raise ExternalServiceError(message)
+
+    async def post(self, path: str, payload: dict) -> httpx.Response:
+        """
+        Short POST with failover (embeddings); returns the read response. The
+        breaker sees the time to response headers, as open_stream sees the time
+        to first line; long generations belong in open_stream.
+        """
+        model = model_name(payload.get("model", ""))
+        last = "no Ollama nodes configured"
+        for node in self._attempts(model):
+            node.breaker.begin()
+            node.outstanding += 1
+            node.requests += 1
+            started = time.monotonic()
+            try:
+                with tracing.span("upstream.request", tracing.CLIENT, node=node.url, model=model):
+                    resp = await self._send(node, "POST", path, payload, stream=True)
+                    latency = time.monotonic() - started
+                    try:
+                        await resp.aread()
+                    except httpx.HTTPError as e:
+                        raise _Retry(str(e) or e.__class__.__name__)
+                    finally:
+                        await resp.aclose()
+            except _Retry as e:
+                self._failed(node, e)
+                last = str(e)
+                continue
+            except BaseException:
+                node.breaker.abandon()
+                raise
+            finally:
+                node.outstanding -= 1
+            node.breaker.success(latency)
+            return resp
+        raise ExternalServiceError(last)
+
+    async def open_stream(self, path: str, payload: dict) -> AsyncIterator[bytes]:
+        """
+        Start a streaming request and return its NDJSON line iterator once the
+        first line has arrived. Anything failing before that is retried on
+        another node; if every attempt fails, ExternalServiceError is raised
+        here, before the HTTP response to our client starts.
+        """
+        model = model_name(payload.get("model", ""))
+        last = "no Ollama nodes configured"
+        for node in self._attempts(model):
+            node.breaker.begin()
+            node.outstanding += 1
+            node.requests += 1
+            started = time.monotonic()
+            try:
+                with tracing.span("upstream.connect", tracing.CLIENT, node=node.url, model=model):
+                    resp = await self._send(node, "POST", path, payload, stream=True)
+                metrics.upstream_connect.labels(model, node.url).observe(time.monotonic() - started)
+                lines = resp.aiter_lines()
+                try:
+                    first = await self._first_line(lines)
+                except BaseException:
+                    await resp.aclose()
+                    raise
+            except _Retry as e:
+                node.outstanding -= 1
+                self._failed(node, e)
+                last = str(e)
+                continue
+            except BaseException:
+                node.outstanding -= 1
+                node.breaker.abandon()
+                raise
+            node.breaker.success(time.monotonic() - started)
+            return ClosingIterator(self._relay(node, resp, first, lines), resp, lambda: self._finished(node))
+        raise ExternalServiceError(last)
+
+    @staticmethod
+    async def _first_line(lines: AsyncIterator[str]) -> str:
+        try:
+            async for line in lines:
+                if line:
+                    return line
+        except httpx.HTTPError as e:
+            raise _Retry(str(e) or e.__class__.__name__)
+        raise _Retry("stream ended before any output")
+
+    @staticmethod
+    async def _relay(node: Node, resp: httpx.Response, first: str, lines: AsyncIterator[str]) -> AsyncIterator[bytes]:
+        """Yield non-empty NDJSON lines (newline terminated) and always release the connection."""
+        try:
+            yield first.encode("utf-8") + b"\n"
+            async for line in lines:
+                if line:
+                    yield line.encode("utf-8") + b"\n"
+        except httpx.HTTPError as e:
+            # Output already reached the client, so this can't be retried elsewhere
+            node.failures += 1
+            logger.error("Ollama stream from %s interrupted: %s", node.url, str(e) or e.__class__.__name__)
+        finally:
+            OllamaPool._finished(node)
+            await resp.aclose()
+
+    @staticmethod
+    def _finished(node: Node) -> None:
+        node.outstanding -= 1
+
+    # ---- health ----
+    async def probe(self, node: Node) -> None:
+        try:
+            tags = await node.client.get("/api/tags", timeout=OLLAMA_HEALTH_TIMEOUT)
+            ps = await node.client.get("/api/ps", timeout=OLLAMA_HEALTH_TIMEOUT)
+            tags.raise_for_status()
+            ps.raise_for_status()
+            node.available_models = {m.get("name") for m in tags.json().get("models", [])}
+            node.loaded_models = {m.get("name") for m in ps.json().get("models", [])}
+        except (httpx.HTTPError, ValueError) as e:
+            if node.healthy:
+                logger.warning("Ollama node %s failed health check: %s", node.url, str(e) or e.__class__.__name__)
+            node.healthy = False
+            return
+        if not node.healthy:
+            logger.info("Ollama node %s is healthy again", node.url)
+        node.healthy = True
+
+    async def probe_all(self) -> None:
+        await asyncio.gather(*(self.probe(n) for n in self.nodes))
+
+    async def _probe_loop(self) -> None:
+        while True:
+            await self.probe_all()
+            await asyncio.sleep(self.health_interval)
+
+    def start(self) -> None:
+        if self._prober is None and self.health_interval > 0:
+            self._prober = asyncio.create_task(self._probe_loop())
+
+    async def close(self) -> None:
+        if self._prober is not None:
+            self._prober.cancel()
+            await asyncio.gather(self._prober, return_exceptions=True)
+            self._prober = None
+        await asyncio.gather(*(n.client.aclose() for n in self.nodes))
+
+    def stats(self) -> dict:
+        return {"retries": self.retries, "nodes": [n.stats() for n in self.nodes]}
@@ -0,0 +1,233 @@
+"""
+On-demand sampling profiler.
+
+Nothing runs until a profile is asked for. Then a daemon thread reads every
+thread's stack (sys._current_frames()) each PROFILE_INTERVAL and counts them
+as collapsed stacks, one "frame;frame;frame count" line per distinct stack:
+the input of flamegraph.pl, speedscope, inferno and friends. Results are kept
+in Redis for PROFILE_RESULT_TTL so any worker can serve them.
+
+Two ways in (main.py, staff tokens only):
+- POST /debug/profile?seconds=N: everything this worker does for N seconds;
+- a request sent with `X-Profile: 1`: that request alone. Its tasks (the handler
+  and the streamed body run in separate ones) are tagged by a task factory that
+  is only installed while such a profile runs, and only samples taken while one
+  of them is running on the loop are kept. Time spent awaiting Ollama or Redis
+  is on no stack and so not counted: this is the request's on-CPU profile.
+
+In-process (benchmarks, scripts): `with Profile(seconds) as p: ...`, then p.collapsed().
+
+django-app/ai/profiler.py is the same for Django; keep the two in sync.
+"""
+import os
+import sys
+import time
+import uuid
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import Counter
+from types import CodeType
+from typing import AsyncIterator, Dict, Optional, Set
+
+import redis.asyncio as redis
+
+logger = logging.getLogger(__name__)
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "true").lower() == "true"
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # 200 samples/s
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_RESULT_TTL = int(os.getenv("PROFILE_RESULT_TTL", "3600"))
+
+PROFILE_KEY = "profile:{id}"  # hash: status, pid, samples, seconds, stacks
+
+# Longest first, so frames are labelled relative to the most specific sys.path entry
+_ROOTS = sorted({p for p in sys.path if p}, key=len, reverse=True)
+_labels: Dict[CodeType, str] = {}
+
+
+def _label(code: CodeType) -> str:
+    label = _labels.get(code)
+    if label is None:
+        filename = code.co_filename
+        for root in _ROOTS:
+            if filename.startswith(root + os.sep):
+                filename = filename[len(root) + 1:]
+                break
+        label = _labels[code] = f"{code.co_name} ({filename}:{code.co_firstlineno})"
+    return label
+
+
+class Profile:
+    """One sampling run: start(), then stop() or let `seconds` run out."""
+
+    def __init__(self, seconds: float, interval: float = PROFILE_INTERVAL):
+        self.id = uuid.uuid4().hex
+        self.seconds = min(seconds, PROFILE_MAX_SECONDS)
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.started = 0.0
+        self.elapsed = 0.0
+        # Set for request profiles: only samples with one of these tasks running on `loop` count
+        self.tasks: Optional[Set[asyncio.Task]] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "Profile":
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def __enter__(self) -> "Profile":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def _run(self) -> None:
+        deadline = self.started + self.seconds
+        try:
+            while not self._stop.wait(self.interval):
+                self._sample()
+                if time.monotonic() >= deadline:
+                    break
+        finally:
+            self.elapsed = time.monotonic() - self.started
+            if self.tasks is not None:
+                self.tasks.clear()
+
+    def _sample(self) -> None:
+        frames = sys._current_frames()
+        # Private, but the only way to see from another thread which task the loop is running
+        if self.tasks is not None and asyncio.tasks._current_tasks.get(self.loop) not in self.tasks:
+            return
+        names = {t.ident: t.name for t in threading.enumerate()}
+        me = threading.get_ident()
+        for ident, frame in frames.items():
+            if ident == me or (self.loop_thread is not None and ident != self.loop_thread):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread"))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+
+# --------- Request profiles: tasks are tagged through the loop's task factory ----------
+_request_profile: contextvars.ContextVar[Optional[Profile]] = contextvars.ContextVar("request_profile", default=None)
+_active_requests = 0
+_previous_factory = None
+_pending: Set[asyncio.Task] = set()  # saves in flight
+
+
+def _task_factory(loop, coro, context=None):
+    if _previous_factory is not None:
+        task = _previous_factory(loop, coro) if context is None else _previous_factory(loop, coro, context=context)
+    else:
+        task = asyncio.Task(coro, loop=loop, context=context)
+    profile = _request_profile.get() if context is None else context.get(_request_profile)
+    if profile is not None and profile.tasks is not None:
+        profile.tasks.add(task)
+    return task
+
+
+def start_request_profile() -> Profile:
+    """Profile the current request: this task and every task it starts from here on."""
+    global _active_requests, _previous_factory
+    loop = asyncio.get_running_loop()
+    profile = Profile(PROFILE_MAX_SECONDS)
+    profile.loop = loop
+    profile.loop_thread = threading.get_ident()
+    profile.tasks = {asyncio.current_task()}
+    if _active_requests == 0:
+        _previous_factory = loop.get_task_factory()
+        loop.set_task_factory(_task_factory)
+    _active_requests += 1
+    _request_profile.set(profile)
+    return profile.start()
+
+
+def end_request_profile(profile: Profile, r: redis.Redis) -> None:
+    global _active_requests, _previous_factory
+    profile.stop()
+    _active_requests -= 1
+    if _active_requests == 0:
+        profile.loop.set_task_factory(_previous_factory)
+        _previous_factory = None
+    # Not awaited: this also runs in a response body's finally when the client disconnects
+    task = profile.loop.create_task(save(r, profile))
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+
+async def finish_request(body: AsyncIterator[bytes], profile: Profile, r: redis.Redis) -> AsyncIterator[bytes]:
+    """Relay a response body, then stop the request's profile and save it."""
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        end_request_profile(profile, r)
+
+
+# --------- Worker profiles: one at a time per process ----------
+_worker_profile: Optional[Profile] = None
+
+
+def worker_profile_running() -> bool:
+    return _worker_profile is not None and _worker_profile.running
+
+
+async def start_worker_profile(r: redis.Redis, seconds: float) -> Profile:
+    """Sample the whole process for `seconds`; saved to Redis when done."""
+    global _worker_profile
+    profile = _worker_profile = Profile(seconds).start()
+    await r.hset(PROFILE_KEY.format(id=profile.id), mapping={"status": "running", "pid": os.getpid()})
+    await r.expire(PROFILE_KEY.format(id=profile.id), PROFILE_RESULT_TTL)
+
+    async def finish():
+        await asyncio.sleep(profile.seconds)
+        profile.stop()
+        await save(r, profile)
+
+    task = asyncio.create_task(finish())
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+    return profile
+
+
+async def save(r: redis.Redis, profile: Profile) -> None:
+    key = PROFILE_KEY.format(id=profile.id)
+    try:
+        await r.hset(key, mapping={
+            "status": "done",
+            "pid": os.getpid(),
+            "samples": profile.samples,
+            "seconds": round(profile.elapsed, 3),
+            "stacks": profile.collapsed(),
+        })
+        await r.expire(key, PROFILE_RESULT_TTL)
+    except Exception as e:
+        logger.warning("Could not save profile %s: %s", profile.id, str(e))
+
+
+async def load(r: redis.Redis, profile_id: str) -> Optional[dict]:
+    return await r.hgetall(PROFILE_KEY.format(id=profile_id)) or None
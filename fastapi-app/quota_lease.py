@@ -0,0 +1,154 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import rate_limit
+from exceptions import RateLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+# Each worker reserves blocks of quota in Redis and spends them locally.
+# Leased-but-unspent units are already counted in Redis, so per user the Redis
+# counters can run ahead of real usage by at most QUOTA_LEASE_MAX_OVERSHOOT
+# across all workers; the lease size is derived from that bound.
+QUOTA_LEASE_SIZE = int(os.getenv("QUOTA_LEASE_SIZE", "10"))
+QUOTA_LEASE_TTL = float(os.getenv("QUOTA_LEASE_TTL", "10"))
+QUOTA_LEASE_MAX_OVERSHOOT = int(os.getenv("QUOTA_LEASE_MAX_OVERSHOOT", "20"))
+QUOTA_LEASE_WORKERS = int(os.getenv("QUOTA_LEASE_WORKERS", os.getenv("WEB_CONCURRENCY", "2")))
+QUOTA_LEASE_MAX_USERS = int(os.getenv("QUOTA_LEASE_MAX_USERS", "50000"))
+
+
+@dataclass
+class Lease:
+    tokens: int
+    expires_at: float
+    limits: Dict[str, int]
+    keys: List[str] = field(default_factory=list)
+    remaining: Dict[str, int] = field(default_factory=dict)
+    resets_at: Dict[str, float] = field(default_factory=dict)
+    denied: Optional[RateLimitExceeded] = None
+
+    def headers(self, now: float) -> Dict[str, str]:
+        out = {}
+        for w in self.resets_at:
+            suffix = w.capitalize()
+            out[f"X-RateLimit-Limit-{suffix}"] = str(self.limits[w])
+            out[f"X-RateLimit-Remaining-{suffix}"] = str(self.remaining.get(w, 0) + self.tokens)
+            out[f"X-RateLimit-Reset-{suffix}"] = str(max(int(self.resets_at[w] - now), 0))
+        return out
+
+
+class LeasedQuota:
+    """
+    In-process token bucket in front of rate_limit.consume().
+    Goes to Redis only when the local lease is empty, expired or for new limits;
+    refusals are cached locally until the lease TTL (or window reset) passes.
+    """
+
+    def __init__(
+        self,
+        lease_size: int = QUOTA_LEASE_SIZE,
+        lease_ttl: float = QUOTA_LEASE_TTL,
+        max_overshoot: int = QUOTA_LEASE_MAX_OVERSHOOT,
+        workers: int = QUOTA_LEASE_WORKERS,
+        max_users: int = QUOTA_LEASE_MAX_USERS,
+    ):
+        self.workers = max(workers, 1)
+        self.lease_size = max(1, min(lease_size, max_overshoot // self.workers))
+        self.lease_ttl = lease_ttl
+        self.max_users = max_users
+        self._leases: "OrderedDict[str, Lease]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _block_size(self, limits: Dict[str, int]) -> int:
+        # Small limits get small leases so one worker can't hoard a user's whole window
+        smallest = min((v for v in limits.values() if v), default=0)
+        if not smallest:
+            return self.lease_size
+        return max(1, min(self.lease_size, smallest // self.workers))
+
+    async def consume(self, user_id: str, limits: Dict[str, int]) -> Dict[str, str]:
+        """Spend one unit for user_id; returns X-RateLimit-* headers or raises RateLimitExceeded."""
+        while True:
+            now = time.monotonic()
+            lease = self._leases.get(user_id)
+            if lease is not None and lease.expires_at > now and lease.limits == limits:
+                if lease.denied is not None:
+                    self.hits += 1
+                    raise RateLimitExceeded(str(lease.denied), headers=lease.denied.headers)
+                if lease.tokens > 0:
+                    lease.tokens -= 1
+                    self._leases.move_to_end(user_id)
+                    self.hits += 1
+                    return lease.headers(now)
+
+            pending = self._pending.get(user_id)
+            if pending is None:
+                break
+            # Another request on this worker is already refilling; wait and retry locally
+            await asyncio.shield(pending)
+
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[user_id] = fut
+        try:
+            return await self._refill(user_id, limits)
+        finally:
+            self._pending.pop(user_id, None)
+            fut.set_result(None)
+
+    async def _refill(self, user_id: str, limits: Dict[str, int]) -> Dict[str, str]:
+        old = self._leases.pop(user_id, None)
+        if old is not None and old.tokens > 0:
+            await rate_limit.refund(user_id, old.keys, old.tokens)
+
+        now = time.monotonic()
+        try:
+            result = await rate_limit.consume(user_id, limits, cost=self._block_size(limits), min_cost=1)
+        except RateLimitExceeded as exc:
+            retry_after = float(exc.headers.get("Retry-After", self.lease_ttl))
+            self._store(user_id, Lease(
+                tokens=0,
+                expires_at=now + min(self.lease_ttl, retry_after),
+                limits=dict(limits),
+                denied=exc,
+            ))
+            raise
+
+        lease = Lease(
+            tokens=result.granted - 1,
+            expires_at=now + min([self.lease_ttl, *result.resets.values()]),
+            limits=dict(limits),
+            keys=result.keys,
+            remaining=result.remaining,
+            resets_at={w: now + s for w, s in result.resets.items()},
+        )
+        self._store(user_id, lease)
+        return lease.headers(now)
+
+    def _store(self, user_id: str, lease: Lease) -> None:
+        self._leases[user_id] = lease
+        self._leases.move_to_end(user_id)
+        while len(self._leases) > self.max_users:
+            # Dropping a lease only strands its unspent units until the window resets
+            self._leases.popitem(last=False)
+
+    async def release_all(self) -> None:
+        """Refund unspent leased units (called on shutdown)."""
+        leases, self._leases = self._leases, OrderedDict()
+        for user_id, lease in leases.items():
+            if lease.tokens > 0:
+                try:
+                    await rate_limit.refund(user_id, lease.keys, lease.tokens)
+                except Exception as e:
+                    # The others may still go through; this one's units wait for the window reset
+                    logger.warning("Quota lease refund failed for %s: %s", user_id, str(e))
+
+
+leased_quota = LeasedQuota()
@@ -1,26 +1,181 @@
 import os
 import time
-from typing import Tuple
-import redis
+import zlib
+import calendar
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+from exceptions import RateLimitExceeded
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
 r = redis.Redis.from_url(REDIS_URL, decode_responses=True)
 
-def daily_counter_key(user_id: str) -> str:
-    # resets every UTC day
-    day = time.strftime("%Y-%m-%d", time.gmtime())
-    return f"usage:{user_id}:{day}"
+# Users are grouped into small hashes per window bucket (quota:<window>:<bucket>:<shard>)
+# so each hash stays under hash-max-listpack-entries and is stored compactly by Redis.
+QUOTA_SHARD_SIZE = int(os.getenv("QUOTA_SHARD_SIZE", "100"))
+QUOTA_KEY_TTL_BUFFER = 60
+
+WINDOWS = ("minute", "hour", "day", "month")
+
+# Check every window first and only increment when all of them have room,
+# so rejected requests never count toward the quota. One round trip.
+# With min_cost < cost the script grants as much as fits (>= min_cost), which
+# is how local leases (quota_lease) reserve blocks of quota.
+#   KEYS[i] = bucket hash for window i
+#   ARGV    = field, cost, min_cost, then (limit_i, ttl_i) for each window
+# Returns {granted, blocked_window_index, count_1, ..., count_n}
+_CONSUME_LUA = """
+local field = ARGV[1]
+local grant = tonumber(ARGV[2])
+local min_cost = tonumber(ARGV[3])
+local n = #KEYS
+local counts = {}
+local blocked = 0
+for i = 1, n do
+  local current = tonumber(redis.call('HGET', KEYS[i], field) or '0')
+  local limit = tonumber(ARGV[2 + 2 * i])
+  counts[i] = current
+  if limit > 0 then
+    local room = limit - current
+    if blocked == 0 and room < min_cost then
+      blocked = i
+    end
+    if room < grant then
+      grant = room
+    end
+  end
+end
+if blocked > 0 then
+  return {0, blocked, unpack(counts)}
+end
+for i = 1, n do
+  counts[i] = redis.call('HINCRBY', KEYS[i], field, grant)
+  if redis.call('TTL', KEYS[i]) < 0 then
+    redis.call('EXPIRE', KEYS[i], tonumber(ARGV[3 + 2 * i]))
+  end
+end
+return {grant, 0, unpack(counts)}
+"""
+
+# Give back unused quota; never recreates a bucket that already expired.
+_REFUND_LUA = """
+for i = 1, #KEYS do
+  if redis.call('HEXISTS', KEYS[i], ARGV[1]) == 1 then
+    redis.call('HINCRBY', KEYS[i], ARGV[1], -tonumber(ARGV[2]))
+  end
+end
+return 1
+"""
+_consume_script = r.register_script(_CONSUME_LUA)
+_refund_script = r.register_script(_REFUND_LUA)
+
+
+@dataclass
+class QuotaResult:
+    allowed: bool
+    limits: Dict[str, int]
+    counts: Dict[str, int]
+    resets: Dict[str, int]
+    exceeded: Optional[str] = None
+    granted: int = 0
+    keys: List[str] = field(default_factory=list)
+    remaining: Dict[str, int] = field(init=False)
+
+    def __post_init__(self):
+        self.remaining = {w: max(self.limits[w] - self.counts[w], 0) for w in self.limits}
+
+    def headers(self) -> Dict[str, str]:
+        """X-RateLimit-* headers for every enforced window (+ Retry-After when refused)."""
+        out = {}
+        for w, limit in self.limits.items():
+            suffix = w.capitalize()
+            out[f"X-RateLimit-Limit-{suffix}"] = str(limit)
+            out[f"X-RateLimit-Remaining-{suffix}"] = str(self.remaining[w])
+            out[f"X-RateLimit-Reset-{suffix}"] = str(self.resets[w])
+        if self.exceeded:
+            out["Retry-After"] = str(self.resets[self.exceeded])
+        return out
+
+
+def _shard(user_id: str) -> int:
+    if user_id.isdigit():
+        return int(user_id) // QUOTA_SHARD_SIZE
+    return zlib.crc32(user_id.encode("utf-8")) % 65536
 
-def incr_usage(user_id: str, limit: int) -> Tuple[int, int]:
+
+def window_bucket(window: str, now: float) -> Tuple[str, int]:
+    """Return (bucket id, seconds until the bucket resets) for a UTC window."""
+    ts = int(now)
+    if window == "minute":
+        return str(ts // 60), 60 - ts % 60
+    if window == "hour":
+        return str(ts // 3600), 3600 - ts % 3600
+    t = time.gmtime(ts)
+    if window == "day":
+        return time.strftime("%Y%m%d", t), 86400 - ts % 86400
+    if window == "month":
+        days = calendar.monthrange(t.tm_year, t.tm_mon)[1]
+        elapsed = (t.tm_mday - 1) * 86400 + ts % 86400
+        return time.strftime("%Y%m", t), days * 86400 - elapsed
+    raise ValueError(f"Unknown quota window: {window}")
+
+
+def bucket_key(window: str, bucket: str, user_id: str, prefix: str = "quota") -> str:
+    return f"{prefix}:{window}:{bucket}:{_shard(user_id)}"
+
+
+async def consume(
+    user_id: str,
+    limits: Dict[str, int],
+    cost: int = 1,
+    min_cost: Optional[int] = None,
+    now: Optional[float] = None,
+) -> QuotaResult:
     """
-    Increment today's usage for user; return (current, limit).
-    Raises RateLimitExceeded if over limit.
+    Atomically check-and-increment every window with a non-zero limit.
+    Charges `cost`, or with `min_cost` set, as much as fits but at least `min_cost`
+    (the amount actually charged is `result.granted`).
+    Raises RateLimitExceeded (nothing is counted) if any window would overflow.
     """
-    key = daily_counter_key(user_id)
-    pipe = r.pipeline()
-    pipe.incr(key)
-    pipe.expire(key, 60 * 60 * 24 + 60)  # 24h + small buffer
-    current, _ = pipe.execute()
-    if limit and current > limit:
-        raise RateLimitExceeded(f"Daily quota exceeded: {current}/{limit}")
-    return current, limit
+    now = time.time() if now is None else now
+    min_cost = cost if min_cost is None else min_cost
+    windows = [w for w in WINDOWS if limits.get(w)]
+    if not windows:
+        return QuotaResult(True, {}, {}, {}, granted=cost)
+
+    keys, argv, resets = [], [user_id, cost, min_cost], {}
+    for w in windows:
+        bucket, reset = window_bucket(w, now)
+        keys.append(bucket_key(w, bucket, user_id))
+        argv += [int(limits[w]), reset + QUOTA_KEY_TTL_BUFFER]
+        resets[w] = reset
+
+    granted, blocked, *counts = await _consume_script(keys=keys, args=argv)
+    result = QuotaResult(
+        allowed=not blocked,
+        limits={w: int(limits[w]) for w in windows},
+        counts={w: int(c) for w, c in zip(windows, counts)},
+        resets=resets,
+        exceeded=windows[blocked - 1] if blocked else None,
+        granted=int(granted),
+        keys=keys,
+    )
+    if not result.allowed:
+        w = result.exceeded
+        raise RateLimitExceeded(
+            f"{w.capitalize()} quota exceeded: {result.counts[w]}/{result.limits[w]}",
+            headers=result.headers(),
+        )
+    return result
+
+
+async def refund(user_id: str, keys: List[str], amount: int) -> None:
+    """Return `amount` unused units to the buckets a previous consume() charged."""
+    if keys and amount > 0:
+        await _refund_script(keys=keys, args=[user_id, amount])
+
+
+async def close() -> None:
+    await r.aclose()
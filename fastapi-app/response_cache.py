@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import hashlib
+import logging
+import unicodedata
+from typing import AsyncIterator, List, Optional
+
+import redis.asyncio as redis
+
+from stream_format import ClosingIterator
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "100000"))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRY_BYTES", str(256 * 1024)))
+
+ENTRY_PREFIX = "rc:e:"
+LRU_KEY = "rc:lru"      # zset entry -> last access time
+SIZES_KEY = "rc:sizes"  # hash entry -> stored bytes
+STATS_KEY = "rc:stats"  # hash hits/misses/stores/bytes/evictions
+
+# GET + LRU touch + hit/miss counter in one round trip
+_GET_LUA = """
+local v = redis.call('GET', KEYS[1])
+if v then
+  redis.call('ZADD', KEYS[2], 'XX', ARGV[1], KEYS[1])
+  redis.call('HINCRBY', KEYS[3], 'hits', 1)
+else
+  redis.call('HINCRBY', KEYS[3], 'misses', 1)
+end
+return v
+"""
+
+# Store with TTL, account bytes, then evict least-recently-used entries
+# until both the byte budget and the entry cap are respected.
+#   KEYS = entry, lru, sizes, stats
+#   ARGV = blob, ttl, now, max_bytes, max_entries
+_STORE_LUA = """
+local size = string.len(ARGV[1])
+redis.call('SET', KEYS[1], ARGV[1], 'EX', tonumber(ARGV[2]))
+local old = redis.call('HGET', KEYS[3], KEYS[1])
+if old then
+  redis.call('HINCRBY', KEYS[4], 'bytes', -tonumber(old))
+end
+redis.call('HSET', KEYS[3], KEYS[1], size)
+redis.call('HINCRBY', KEYS[4], 'bytes', size)
+redis.call('HINCRBY', KEYS[4], 'stores', 1)
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+local max_bytes = tonumber(ARGV[4])
+local max_entries = tonumber(ARGV[5])
+while tonumber(redis.call('HGET', KEYS[4], 'bytes') or '0') > max_bytes
+      or redis.call('ZCARD', KEYS[2]) > max_entries do
+  local victim = redis.call('ZPOPMIN', KEYS[2], 1)[1]
+  if not victim then break end
+  local vsize = redis.call('HGET', KEYS[3], victim)
+  redis.call('HDEL', KEYS[3], victim)
+  if vsize then
+    redis.call('HINCRBY', KEYS[4], 'bytes', -tonumber(vsize))
+  end
+  -- entries that already hit their TTL are cleaned up here too, but aren't evictions
+  if redis.call('DEL', victim) == 1 then
+    redis.call('HINCRBY', KEYS[4], 'evictions', 1)
+  end
+end
+return size
+"""
+
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", prompt).split())
+
+
+class ResponseCache:
+    """
+    Exact-match cache of complete upstream NDJSON streams in Redis.
+    Entries are zlib-compressed line lists; replay yields the same lines as
+    separate chunks so a cached answer is framed exactly like a live one.
+    """
+
+    def __init__(self, client: redis.Redis, enabled: bool = RESPONSE_CACHE_ENABLED):
+        self.r = client
+        self.enabled = enabled
+        self._get = client.register_script(_GET_LUA)
+        self._store = client.register_script(_STORE_LUA)
+        self._pending: set = set()
+
+    @staticmethod
+    def key(model: str, prompt: str, options: Optional[dict] = None) -> str:
+        raw = json.dumps([model, normalize_prompt(prompt), options or {}], sort_keys=True, separators=(",", ":"))
+        return ENTRY_PREFIX + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[List[bytes]]:
+        try:
+            blob = await self._get(keys=[key, LRU_KEY, STATS_KEY], args=[time.time()])
+        except redis.RedisError as e:
+            logger.warning("Response cache lookup failed: %s", str(e))
+            return None
+        if blob is None:
+            return None
+        return zlib.decompress(blob).split(b"\n")
+
+    async def put(self, key: str, lines: List[bytes]) -> None:
+        blob = zlib.compress(b"\n".join(lines), 6)
+        if len(blob) > RESPONSE_CACHE_MAX_ENTRY_BYTES:
+            return
+        try:
+            await self._store(
+                keys=[key, LRU_KEY, SIZES_KEY, STATS_KEY],
+                args=[blob, RESPONSE_CACHE_TTL, time.time(), RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MAX_ENTRIES],
+            )
+        except redis.RedisError as e:
+            logger.warning("Response cache store failed: %s", str(e))
+
+    @staticmethod
+    async def replay(lines: List[bytes]) -> AsyncIterator[bytes]:
+        for line in lines:
+            yield line + b"\n"
+
+    def record(self, key: str, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """Pass a live stream through; store it only if it completed with done=true."""
+        return ClosingIterator(self._record(key, stream), stream)
+
+    async def _record(self, key: str, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        lines: List[bytes] = []
+        try:
+            async for chunk in stream:
+                lines.append(chunk.rstrip(b"\n"))
+                yield chunk
+        finally:
+            await stream.aclose()
+        if not lines:
+            return
+        try:
+            done = json.loads(lines[-1]).get("done") is True
+        except ValueError:
+            done = False
+        if done:
+            # Don't hold the finished response open for the Redis write
+            task = asyncio.create_task(self.put(key, lines))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    async def stats(self) -> dict:
+        try:
+            raw = await self.r.hgetall(STATS_KEY)
+            entries = await self.r.zcard(LRU_KEY)
+        except redis.RedisError as e:
+            logger.warning("Response cache stats failed: %s", str(e))
+            return {"available": False}
+        out = {k.decode(): int(v) for k, v in raw.items()}
+        lookups = out.get("hits", 0) + out.get("misses", 0)
+        out["entries"] = entries
+        out["hit_rate"] = round(out.get("hits", 0) / lookups, 4) if lookups else 0.0
+        out["available"] = True
+        return out
+
+    async def close(self) -> None:
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        await self.r.aclose()
+
+
+response_cache = ResponseCache(redis.Redis.from_url(REDIS_URL))
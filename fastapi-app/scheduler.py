@@ -0,0 +1,234 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Deque, Dict, Optional
+
+from exceptions import CapacityExceeded
+from stream_format import ClosingIterator
+
+logger = logging.getLogger(__name__)
+
+# Per uvicorn worker: total upstream concurrency is this times --workers
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "4"))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "500"))
+SCHEDULER_QUEUE_TIMEOUT = float(os.getenv("SCHEDULER_QUEUE_TIMEOUT", "30"))
+SCHEDULER_FEEDBACK_INTERVAL = float(os.getenv("SCHEDULER_FEEDBACK_INTERVAL", "1"))
+# "slug:weight,..." - a plan with weight 4 is admitted 4x as often as weight 1 under contention
+SCHEDULER_PLAN_WEIGHTS = os.getenv("SCHEDULER_PLAN_WEIGHTS", "free:1,pro:4,premium:8")
+DEFAULT_PLAN = "free"
+
+STRIDE = 1_000_000
+
+
+def parse_weights(spec: str) -> Dict[str, int]:
+    weights = {}
+    for item in spec.split(","):
+        slug, _, weight = item.strip().partition(":")
+        if slug and weight:
+            weights[slug] = max(int(weight), 1)
+    return weights
+
+
+class Ticket:
+    __slots__ = ("user_id", "plan", "enqueued_at", "admitted", "released", "_future")
+
+    def __init__(self, user_id: str, plan: str):
+        self.user_id = user_id
+        self.plan = plan
+        self.enqueued_at = time.monotonic()
+        self.admitted = False
+        self.released = False
+        self._future: Optional[asyncio.Future] = None
+
+
+class PlanQueue:
+    """Per-plan round robin over users, each user with their own FIFO."""
+
+    def __init__(self, weight: int):
+        self.stride = STRIDE // weight
+        self.pass_ = 0
+        self.users: "OrderedDict[str, Deque[Ticket]]" = OrderedDict()
+        self.size = 0
+
+    def push(self, ticket: Ticket) -> None:
+        self.users.setdefault(ticket.user_id, deque()).append(ticket)
+        self.size += 1
+
+    def pop(self) -> Ticket:
+        user_id, tickets = next(iter(self.users.items()))
+        ticket = tickets.popleft()
+        del self.users[user_id]
+        if tickets:
+            # Back of the rotation: one admission per user per turn
+            self.users[user_id] = tickets
+        self.size -= 1
+        return ticket
+
+    def remove(self, ticket: Ticket) -> bool:
+        tickets = self.users.get(ticket.user_id)
+        if not tickets or ticket not in tickets:
+            return False
+        tickets.remove(ticket)
+        if not tickets:
+            del self.users[ticket.user_id]
+        self.size -= 1
+        return True
+
+    def position(self, ticket: Ticket) -> int:
+        """Rounds of this plan's rotation before the ticket is served."""
+        tickets = self.users.get(ticket.user_id) or deque()
+        try:
+            depth = tickets.index(ticket)
+        except ValueError:
+            return 0
+        order = list(self.users).index(ticket.user_id)
+        return depth * len(self.users) + order
+
+
+class AdmissionScheduler:
+    """
+    Caps concurrent upstream generations and orders waiters by weighted fair
+    queueing across plans (stride scheduling on SubscriptionPlan slugs), with
+    round robin between users inside a plan.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+        weights: Optional[Dict[str, int]] = None,
+        max_queue: int = SCHEDULER_MAX_QUEUE,
+        queue_timeout: float = SCHEDULER_QUEUE_TIMEOUT,
+    ):
+        self.max_concurrency = max_concurrency
+        self.weights = weights if weights is not None else parse_weights(SCHEDULER_PLAN_WEIGHTS)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self.timeouts = 0
+        self._plans: Dict[str, PlanQueue] = {}
+
+    def _plan_queue(self, plan: str) -> PlanQueue:
+        q = self._plans.get(plan)
+        if q is None:
+            q = self._plans[plan] = PlanQueue(self.weights.get(plan, 1))
+        return q
+
+    def submit(self, user_id: str, plan: Optional[str], force: bool = False) -> Ticket:
+        """
+        Admit immediately if there is capacity and nobody is waiting, else enqueue.
+        `force` admits regardless (still counted), for callers that can no longer wait.
+        """
+        ticket = Ticket(user_id, plan or DEFAULT_PLAN)
+        if force or (self.active < self.max_concurrency and self.queued == 0):
+            self.active += 1
+            ticket.admitted = True
+            return ticket
+        if self.queued >= self.max_queue:
+            raise CapacityExceeded("Too many queued generations, try again shortly")
+
+        q = self._plan_queue(ticket.plan)
+        if q.size == 0:
+            # An idle plan re-enters at the current virtual time instead of banking credit
+            busy = [p.pass_ for p in self._plans.values() if p.size]
+            q.pass_ = max(q.pass_, min(busy, default=0))
+        q.push(ticket)
+        ticket._future = asyncio.get_running_loop().create_future()
+        self.queued += 1
+        return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        """Approximate number of generations that will be admitted before this ticket."""
+        if ticket.admitted:
+            return 0
+        q = self._plans.get(ticket.plan)
+        if q is None:
+            return 0
+        rounds = q.position(ticket)
+        ahead = rounds
+        for other in self._plans.values():
+            if other is not q and other.size:
+                ahead += min(other.size, (rounds + 1) * q.stride // other.stride)
+        return ahead + 1
+
+    async def wait_with_feedback(self, ticket: Ticket, interval: float = SCHEDULER_FEEDBACK_INTERVAL) -> AsyncIterator[int]:
+        """
+        Yield the ticket's queue position whenever it changes until it is admitted.
+        Raises CapacityExceeded after the queue timeout; an abandoned wait withdraws the ticket.
+        """
+        deadline = ticket.enqueued_at + self.queue_timeout
+        last = None
+        try:
+            while not ticket.admitted:
+                pos = self.position(ticket)
+                if pos != last:
+                    last = pos
+                    yield pos
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise CapacityExceeded("Timed out waiting for a generation slot")
+                try:
+                    await asyncio.wait_for(asyncio.shield(ticket._future), min(interval, remaining))
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self.cancel(ticket)
+            raise
+
+    def cancel(self, ticket: Ticket) -> None:
+        """Withdraw a waiting ticket, or release an admitted one."""
+        if ticket.admitted:
+            self.release(ticket)
+            return
+        q = self._plans.get(ticket.plan)
+        if q is not None and q.remove(ticket):
+            self.queued -= 1
+
+    def release(self, ticket: Ticket) -> None:
+        if not ticket.admitted or ticket.released:
+            return
+        ticket.released = True
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self.active < self.max_concurrency and self.queued:
+            q = min((p for p in self._plans.values() if p.size), key=lambda p: p.pass_)
+            ticket = q.pop()
+            q.pass_ += q.stride
+            self.queued -= 1
+            self.active += 1
+            ticket.admitted = True
+            if not ticket._future.done():
+                ticket._future.set_result(None)
+
+    def hold(self, ticket: Ticket, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """Relay `stream`, releasing the ticket's slot when it ends or is abandoned, read or not."""
+        return ClosingIterator(self._hold(ticket, stream), stream, lambda: self.release(ticket))
+
+    async def _hold(self, ticket: Ticket, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            self.release(ticket)
+            await stream.aclose()
+
+    def queue_depths(self) -> Dict[str, int]:
+        """Waiting tickets per plan, including plans whose queue is empty."""
+        return {slug: q.size for slug, q in self._plans.items()}
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max_concurrency": self.max_concurrency,
+            "timeouts": self.timeouts,
+            "queued_by_plan": {slug: q.size for slug, q in self._plans.items() if q.size},
+        }
+
+
+scheduler = AdmissionScheduler()
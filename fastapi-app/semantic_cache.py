@@ -0,0 +1,298 @@
+import os
+import re
+import json
+import time
+import zlib
+import asyncio
+import socket
+import hashlib
+import logging
+import tempfile
+from typing import AsyncIterator, Dict, List, Optional
+
+import numpy as np
+
+import ollama_client
+from exceptions import ExternalServiceError
+from stream_format import ClosingIterator
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_EMBED_MODEL = os.getenv("SEMANTIC_CACHE_EMBED_MODEL", "nomic-embed-text")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", "/tmp/11ai-semantic-cache")
+SEMANTIC_CACHE_SAVE_INTERVAL = float(os.getenv("SEMANTIC_CACHE_SAVE_INTERVAL", "60"))
+# Another process's file untouched this long is deleted once merged (its process is likely gone)
+SEMANTIC_CACHE_FILE_TTL = float(os.getenv("SEMANTIC_CACHE_FILE_TTL", str(7 * 86400)))
+
+
+class VectorPartition:
+    """
+    Fixed-capacity cosine index for one (model, options) partition.
+    Vectors are stored L2-normalised in a contiguous float32 matrix so a lookup
+    is a single mat-vec product; the least recently used slot is overwritten when full.
+    """
+
+    def __init__(self, capacity: int, dim: int):
+        self.capacity = capacity
+        self.dim = dim
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.answers: List[Optional[bytes]] = [None] * capacity
+        self.size = 0
+
+    def search(self, q: np.ndarray, threshold: float) -> Optional[bytes]:
+        if self.size == 0:
+            return None
+        sims = self.vectors[: self.size] @ q
+        best = int(np.argmax(sims))
+        if sims[best] < threshold:
+            return None
+        self.last_used[best] = time.time()
+        return self.answers[best]
+
+    def add(self, q: np.ndarray, answer: bytes) -> bool:
+        """Insert; returns True if an older entry was evicted to make room."""
+        if self.size < self.capacity:
+            slot, evicted = self.size, False
+            self.size += 1
+        else:
+            slot, evicted = int(np.argmin(self.last_used)), True
+        self.vectors[slot] = q
+        self.answers[slot] = answer
+        self.last_used[slot] = time.time()
+        return evicted
+
+    def snapshot(self, name: str) -> dict:
+        """Copy of the live entries, safe to write from another thread."""
+        n = self.size
+        blobs = [a or b"" for a in self.answers[:n]]
+        return {
+            "name": np.array(name),
+            "vectors": self.vectors[:n].copy(),
+            "last_used": self.last_used[:n].copy(),
+            "offsets": np.cumsum([0] + [len(b) for b in blobs], dtype=np.int64),
+            "blob": np.frombuffer(b"".join(blobs), dtype=np.uint8),
+        }
+
+    @staticmethod
+    def write(path: str, snapshot: dict) -> None:
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp.npz", delete=False,
+        ) as f:
+            tmp = f.name
+        try:
+            np.savez(tmp, **snapshot)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path: str, capacity: int) -> "VectorPartition":
+        with np.load(path, allow_pickle=False) as data:
+            vectors = data["vectors"]
+            n = min(len(vectors), capacity)
+            part = cls(capacity, vectors.shape[1])
+            part.vectors[:n] = vectors[:n]
+            part.last_used[:n] = data["last_used"][:n]
+            offsets, blob = data["offsets"], data["blob"].tobytes()
+            part.answers[:n] = [blob[offsets[i]:offsets[i + 1]] for i in range(n)]
+            part.size = n
+        return part
+
+    @classmethod
+    def merge(cls, parts: List["VectorPartition"], capacity: int) -> "VectorPartition":
+        """The most recently used entries of `parts`, one per distinct vector, up to `capacity`."""
+        entries = sorted(
+            ((p.last_used[i], p.vectors[i], p.answers[i]) for p in parts for i in range(p.size)),
+            key=lambda e: e[0], reverse=True,
+        )
+        merged = cls(capacity, entries[0][1].shape[0] if entries else parts[0].dim)
+        seen = set()
+        for used, vector, answer in entries:
+            key = vector.tobytes()
+            if merged.size == capacity or vector.shape[0] != merged.dim or key in seen:
+                continue
+            seen.add(key)
+            merged.vectors[merged.size] = vector
+            merged.last_used[merged.size] = used
+            merged.answers[merged.size] = answer
+            merged.size += 1
+        return merged
+
+
+class SemanticCache:
+    """
+    Near-duplicate prompt cache: embeds prompts through Ollama and returns the stored
+    answer of the most similar past prompt above SEMANTIC_CACHE_THRESHOLD.
+    Partitions are per (model, options) and persisted to SEMANTIC_CACHE_DIR, one
+    file per partition and process so workers never overwrite each other; on
+    startup every process merges all the files of a partition.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = SEMANTIC_CACHE_ENABLED,
+        embed_model: str = SEMANTIC_CACHE_EMBED_MODEL,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+        directory: str = SEMANTIC_CACHE_DIR,
+    ):
+        self.enabled = enabled
+        self.embed_model = embed_model
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.directory = directory
+        self.partitions: Dict[str, VectorPartition] = {}
+        self._dirty = False
+        self._saver: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def partition_key(model: str, options: Optional[dict] = None) -> str:
+        if not options:
+            return model
+        digest = hashlib.sha1(json.dumps(options, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+        return f"{model}@{digest}"
+
+    @staticmethod
+    def owner() -> str:
+        """This process, as it appears in the names of the files it saves."""
+        return f"{socket.gethostname()}-{os.getpid()}"
+
+    def _path(self, partition: str) -> str:
+        name = re.sub(r"[^A-Za-z0-9_.@-]", "_", f"{partition}.{self.owner()}")
+        return os.path.join(self.directory, name + ".npz")
+
+    async def embed(self, prompt: str) -> Optional[np.ndarray]:
+        try:
+            resp = await ollama_client.post("/api/embeddings", {"model": self.embed_model, "prompt": prompt})
+            vec = np.asarray(resp.json()["embedding"], dtype=np.float32)
+        except (ExternalServiceError, KeyError, ValueError) as e:
+            logger.warning("Semantic cache embedding failed: %s", str(e) or e.__class__.__name__)
+            return None
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else None
+
+    def search(self, partition: str, q: np.ndarray) -> Optional[List[bytes]]:
+        part = self.partitions.get(partition)
+        answer = part.search(q, self.threshold) if part is not None and part.dim == q.shape[0] else None
+        if answer is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return zlib.decompress(answer).split(b"\n")
+
+    def add(self, partition: str, q: np.ndarray, lines: List[bytes]) -> None:
+        part = self.partitions.get(partition)
+        if part is None or part.dim != q.shape[0]:
+            # New partition, or the embedding model changed dimension: start over
+            part = self.partitions[partition] = VectorPartition(self.max_entries, q.shape[0])
+        if part.add(q, zlib.compress(b"\n".join(lines), 6)):
+            self.evictions += 1
+        self._dirty = True
+
+    def record(self, partition: str, q: np.ndarray, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """Pass a live stream through and index it if it completed with done=true."""
+        return ClosingIterator(self._record(partition, q, stream), stream)
+
+    async def _record(self, partition: str, q: np.ndarray, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        lines: List[bytes] = []
+        try:
+            async for chunk in stream:
+                lines.append(chunk.rstrip(b"\n"))
+                yield chunk
+        finally:
+            await stream.aclose()
+        try:
+            done = bool(lines) and json.loads(lines[-1]).get("done") is True
+        except ValueError:
+            done = False
+        if done:
+            self.add(partition, q, lines)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": sum(p.size for p in self.partitions.values()),
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def load(self) -> None:
+        """Merge every process's saved files into this process's partitions."""
+        if not os.path.isdir(self.directory):
+            return
+        loaded: Dict[str, List[VectorPartition]] = {}
+        stale = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz") or name.endswith(".tmp.npz"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with np.load(path, allow_pickle=False) as data:
+                    partition = str(data["name"])
+                loaded.setdefault(partition, []).append(VectorPartition.load(path, self.max_entries))
+                if path != self._path(partition):
+                    # Entries from other processes are only on disk in their files until we save
+                    self._dirty = True
+                    if time.time() - os.path.getmtime(path) > SEMANTIC_CACHE_FILE_TTL:
+                        stale.append(path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Semantic cache: skipping %s: %s", name, str(e))
+        for partition, parts in loaded.items():
+            self.partitions[partition] = VectorPartition.merge(parts, self.max_entries)
+        if stale:
+            # Merged above: persist them in our own files before deleting theirs
+            self.write(self.snapshot())
+            for path in stale:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def snapshot(self) -> List[tuple]:
+        """(path, arrays) for every partition changed since the last save."""
+        if not self._dirty:
+            return []
+        self._dirty = False
+        return [(self._path(name), part.snapshot(name)) for name, part in self.partitions.items()]
+
+    def write(self, snapshots: List[tuple]) -> None:
+        if snapshots:
+            os.makedirs(self.directory, exist_ok=True)
+        for path, arrays in snapshots:
+            VectorPartition.write(path, arrays)
+
+    async def save(self) -> None:
+        try:
+            await asyncio.to_thread(self.write, self.snapshot())
+        except OSError as e:
+            logger.warning("Semantic cache save failed: %s", str(e))
+
+    async def _autosave(self) -> None:
+        while True:
+            await asyncio.sleep(SEMANTIC_CACHE_SAVE_INTERVAL)
+            await self.save()
+
+    async def startup(self) -> None:
+        if self.enabled:
+            await asyncio.to_thread(self.load)
+            self._saver = asyncio.create_task(self._autosave())
+
+    async def shutdown(self) -> None:
+        if self._saver is not None:
+            self._saver.cancel()
+            await asyncio.gather(self._saver, return_exceptions=True)
+        if self.enabled:
+            await self.save()
+
+
+semantic_cache = SemanticCache()
@@ -0,0 +1,175 @@
+import os
+import re
+import json
+import time
+import zlib
+import array
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import AsyncIterator, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+from stream_format import ClosingIterator
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+# A longer context is not stored; the next turn falls back to replaying the transcript
+SESSION_MAX_CONTEXT_TOKENS = int(os.getenv("SESSION_MAX_CONTEXT_TOKENS", "8192"))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "20"))
+SESSION_MAX_REPLAY_CHARS = int(os.getenv("SESSION_MAX_REPLAY_CHARS", "16000"))
+SESSION_MAX_PER_USER = int(os.getenv("SESSION_MAX_PER_USER", "20"))
+
+SESSION_KEY = "sess:{user_id}:{session_id}"
+INDEX_KEY = "sess:idx:{user_id}"  # zset session key -> last used
+SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# Save + touch the user's index, evicting their least recently used sessions.
+#   KEYS = session, index
+#   ARGV = model, context, turns, ttl, now, max_sessions
+_SAVE_LUA = """
+redis.call('HSET', KEYS[1], 'model', ARGV[1], 'context', ARGV[2], 'turns', ARGV[3])
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[4]))
+redis.call('ZADD', KEYS[2], ARGV[5], KEYS[1])
+redis.call('EXPIRE', KEYS[2], tonumber(ARGV[4]))
+local extra = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[6])
+if extra > 0 then
+  for _, victim in ipairs(redis.call('ZRANGE', KEYS[2], 0, extra - 1)) do
+    redis.call('DEL', victim)
+  end
+  redis.call('ZREMRANGEBYRANK', KEYS[2], 0, extra - 1)
+end
+return extra
+"""
+
+
+@dataclass
+class Session:
+    model: str
+    context: Optional[List[int]] = None
+    turns: List[Tuple[str, str]] = field(default_factory=list)  # (prompt, response)
+
+
+def pack_context(context: List[int]) -> bytes:
+    return zlib.compress(array.array("i", context).tobytes())
+
+
+def unpack_context(blob: bytes) -> Optional[List[int]]:
+    if not blob:
+        return None
+    ctx = array.array("i")
+    ctx.frombytes(zlib.decompress(blob))
+    return ctx.tolist()
+
+
+class SessionStore:
+    """
+    Multi-turn sessions for /api/generate. After each turn the `context` Ollama
+    returns is kept, so the next turn sends only the new prompt instead of the
+    whole transcript. Without a usable context (missing, too large, evicted or
+    from another model) the recent transcript is replayed as the prompt.
+    """
+
+    def __init__(self, client: redis.Redis):
+        self.r = client
+        self._save = client.register_script(_SAVE_LUA)
+        self._pending: set = set()
+        self.continued = 0
+        self.replayed = 0
+
+    @staticmethod
+    def valid_id(session_id) -> bool:
+        return isinstance(session_id, str) and bool(SESSION_ID_RE.match(session_id))
+
+    async def load(self, user_id: str, session_id: str) -> Optional[Session]:
+        try:
+            raw = await self.r.hgetall(SESSION_KEY.format(user_id=user_id, session_id=session_id))
+        except redis.RedisError as e:
+            logger.warning("Session load failed: %s", str(e))
+            return None
+        if not raw:
+            return None
+        turns = [tuple(t) for t in json.loads(zlib.decompress(raw[b"turns"]))] if raw.get(b"turns") else []
+        return Session(raw[b"model"].decode(), unpack_context(raw.get(b"context", b"")), turns)
+
+    def prompt_fields(self, session: Optional[Session], model: str, prompt: str) -> dict:
+        """`prompt` (+ `context`) for the upstream request."""
+        if session is not None and session.context and session.model == model:
+            self.continued += 1
+            return {"prompt": prompt, "context": session.context}
+        if session is None or not session.turns:
+            return {"prompt": prompt}
+        self.replayed += 1
+        # Newest turns that fit, oldest first
+        lines, size = [], 0
+        for past_prompt, response in reversed(session.turns):
+            turn = f"User: {past_prompt}\nAssistant: {response}"
+            if size + len(turn) > SESSION_MAX_REPLAY_CHARS:
+                break
+            lines.append(turn)
+            size += len(turn)
+        history = "\n\n".join(reversed(lines))
+        return {"prompt": f"Conversation so far:\n\n{history}\n\nUser: {prompt}"}
+
+    async def save(self, user_id: str, session_id: str, session: Session) -> None:
+        context = session.context if session.context and len(session.context) <= SESSION_MAX_CONTEXT_TOKENS else []
+        turns = zlib.compress(json.dumps(session.turns[-SESSION_MAX_TURNS:]).encode("utf-8"))
+        try:
+            await self._save(
+                keys=[SESSION_KEY.format(user_id=user_id, session_id=session_id), INDEX_KEY.format(user_id=user_id)],
+                args=[session.model, pack_context(context) if context else b"", turns, SESSION_TTL, time.time(), SESSION_MAX_PER_USER],
+            )
+        except redis.RedisError as e:
+            logger.warning("Session save failed: %s", str(e))
+
+    def record(
+        self, user_id: str, session_id: str, model: str, prompt: str,
+        session: Optional[Session], stream: AsyncIterator[bytes],
+    ) -> AsyncIterator[bytes]:
+        """
+        Pass a live stream through; on done=true store the turn and its context.
+        A turn cut off by the client is stored with the partial response and no
+        context, so the next turn replays the transcript the user actually saw.
+        """
+        return ClosingIterator(self._record(user_id, session_id, model, prompt, session, stream), stream)
+
+    async def _record(
+        self, user_id: str, session_id: str, model: str, prompt: str,
+        session: Optional[Session], stream: AsyncIterator[bytes],
+    ) -> AsyncIterator[bytes]:
+        pieces: List[str] = []
+        final = None
+        try:
+            async for chunk in stream:
+                try:
+                    obj = json.loads(chunk)
+                except ValueError:
+                    obj = None
+                if isinstance(obj, dict):
+                    pieces.append(obj.get("response") or "")
+                    if obj.get("done") is True:
+                        final = obj
+                yield chunk
+        finally:
+            await stream.aclose()
+            if final is not None or any(pieces):
+                turns = list(session.turns) if session is not None else []
+                turns.append((prompt, "".join(pieces)))
+                updated = Session(model, final.get("context") if final is not None else None, turns)
+                task = asyncio.create_task(self.save(user_id, session_id, updated))
+                self._pending.add(task)
+                task.add_done_callback(self._pending.discard)
+
+    def stats(self) -> dict:
+        return {"continued": self.continued, "replayed": self.replayed}
+
+    async def close(self) -> None:
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        await self.r.aclose()
+
+
+session_store = SessionStore(redis.Redis.from_url(REDIS_URL))
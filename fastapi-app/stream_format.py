@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import asyncio
+import inspect
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, List, Optional
+
+from fastapi.responses import StreamingResponse
+
+# A frame is flushed once it holds this many bytes of tokens, or when its oldest
+# token has waited this long, whichever comes first.
+STREAM_FRAME_BYTES = int(os.getenv("STREAM_FRAME_BYTES", "512"))
+STREAM_FRAME_INTERVAL = float(os.getenv("STREAM_FRAME_INTERVAL", "0.05"))
+
+FORMATS = {
+    "ollama": "text/plain",  # upstream NDJSON lines as-is (default)
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+    "text": "text/plain; charset=utf-8",
+}
+ACCEPT_FORMATS = {"text/event-stream": "sse", "application/x-ndjson": "ndjson"}
+
+_RESPONSE_FIELD = b'"response":'
+
+
+class ClosingIterator:
+    """
+    An async generator that relays `upstream`, made safe to drop unread: aclose()
+    closes `upstream` and runs `cleanup` when the generator was never iterated.
+    Starlette drops the body of a client that disconnects before the first chunk,
+    and an async generator that never started does not run its `finally` on
+    aclose(), so the slot, connection or subscription it stood for would never be
+    given back. Once iteration has started, the generator's own `finally` does that.
+    """
+
+    def __init__(
+        self,
+        gen: AsyncGenerator[bytes, None],
+        upstream: Optional[AsyncIterator[bytes]] = None,
+        cleanup: Optional[Callable[[], Any]] = None,
+    ):
+        self._gen = gen
+        self._upstream = upstream
+        self._cleanup = cleanup
+        self._started = False
+
+    def __aiter__(self) -> "ClosingIterator":
+        return self
+
+    def __anext__(self) -> Awaitable[bytes]:
+        self._started = True
+        return self._gen.__anext__()
+
+    async def aclose(self) -> None:
+        started, self._started = self._started, True
+        await self._gen.aclose()
+        if started:
+            return
+        try:
+            if self._cleanup is not None:
+                result = self._cleanup()
+                if inspect.isawaitable(result):
+                    await result
+        finally:
+            if self._upstream is not None:
+                await self._upstream.aclose()
+
+
+def negotiate(requested: Optional[str], accept: Optional[str]) -> Optional[str]:
+    """Output format from the body's `format`, else the Accept header. None if unsupported."""
+    if requested is not None:
+        return requested if requested in FORMATS else None
+    for part in (accept or "").split(","):
+        fmt = ACCEPT_FORMATS.get(part.split(";")[0].strip().lower())
+        if fmt:
+            return fmt
+    return "ollama"
+
+
+def response_token(line: bytes) -> Optional[bytes]:
+    """
+    The still JSON-escaped contents of `"response":"..."` in an upstream line, found
+    by scanning bytes instead of decoding the line. None if the line has no such field.
+    """
+    i = line.find(_RESPONSE_FIELD)
+    if i < 0:
+        return None
+    start = i + len(_RESPONSE_FIELD)
+    while start < len(line) and line[start] in b" \t":
+        start += 1
+    if start >= len(line) or line[start] != 0x22:  # '"'
+        return None
+    start += 1
+    end = line.find(b'"', start)
+    while end > 0:
+        backslashes = 0
+        while line[end - 1 - backslashes] == 0x5C:  # '\\'
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return line[start:end]
+        end = line.find(b'"', end + 1)
+    return None
+
+
+def usage(final: dict) -> dict:
+    """Usage stats from Ollama's done frame."""
+    completion = final.get("eval_count") or 0
+    eval_ns = final.get("eval_duration") or 0
+    return {
+        "prompt_tokens": final.get("prompt_eval_count") or 0,
+        "completion_tokens": completion,
+        "total_ms": round((final.get("total_duration") or 0) / 1e6, 1),
+        "load_ms": round((final.get("load_duration") or 0) / 1e6, 1),
+        "prompt_eval_ms": round((final.get("prompt_eval_duration") or 0) / 1e6, 1),
+        "tokens_per_second": round(completion / (eval_ns / 1e9), 2) if eval_ns else None,
+    }
+
+
+class Framer:
+    """Builds the wire bytes for one output format. A `tag` adds an "id" to every NDJSON frame."""
+
+    def __init__(self, fmt: str, tag: Optional[str] = None):
+        self.fmt = fmt
+        self.tag = tag
+        self.head = b"{" if tag is None else b'{"id":' + json.dumps(tag).encode("utf-8") + b","
+
+    def tokens(self, escaped: List[bytes]) -> bytes:
+        body = b"".join(escaped)
+        if self.fmt == "text":
+            # Only decode when there is something escaped; plain ASCII/UTF-8 passes through
+            return json.loads(b'"' + body + b'"').encode("utf-8", "replace") if b"\\" in body else body
+        frame = self.head + b'"t":"' + body + b'"}'
+        return frame + b"\n" if self.fmt == "ndjson" else b"event: token\ndata: " + frame + b"\n\n"
+
+    def other(self, line: bytes) -> bytes:
+        """A line that isn't a token: queue status, in-band error, ..."""
+        if self.fmt == "text":
+            try:
+                error = json.loads(line).get("error")
+            except (ValueError, AttributeError):
+                error = None
+            return f"\n[error] {error}\n".encode("utf-8") if error else b""
+        if self.fmt == "ndjson":
+            return (line if self.tag is None else self.head + line[1:]) + b"\n"
+        event = b"error" if b'"error"' in line else b"status"
+        return b"event: " + event + b"\ndata: " + line + b"\n\n"
+
+    def done(self, final: dict) -> bytes:
+        if self.fmt == "text":
+            return b""
+        frame = {"done": True, "usage": usage(final)} if self.tag is None else {"id": self.tag, "done": True, "usage": usage(final)}
+        frame = json.dumps(frame, separators=(",", ":")).encode("utf-8")
+        return frame + b"\n" if self.fmt == "ndjson" else b"event: done\ndata: " + frame + b"\n\n"
+
+
+async def _frames(upstream: AsyncIterator[bytes], max_bytes: int, interval: float) -> AsyncIterator[List[bytes]]:
+    """
+    Group upstream chunks into batches, yielded once a batch holds `max_bytes`,
+    `interval` has passed since its first chunk, or the stream ended.
+    """
+    it = upstream.__aiter__()
+    batch: List[bytes] = []
+    size = 0
+    deadline = 0.0
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            try:
+                if not batch:
+                    # Nothing buffered: no timer needed, wait for the next chunk directly
+                    chunk = await (pending if pending is not None else it.__anext__())
+                    pending = None
+                    deadline = time.monotonic() + interval
+                else:
+                    if pending is None:
+                        pending = asyncio.ensure_future(it.__anext__())
+                    done, _ = await asyncio.wait({pending}, timeout=max(deadline - time.monotonic(), 0))
+                    if not done:
+                        yield batch
+                        batch, size = [], 0
+                        continue
+                    chunk = pending.result()
+                    pending = None
+            except StopAsyncIteration:
+                pending = None
+                break
+            batch.append(chunk)
+            size += len(chunk)
+            if size >= max_bytes:
+                yield batch
+                batch, size = [], 0
+        if batch:
+            yield batch
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        await upstream.aclose()
+
+
+def format_stream(
+    upstream: AsyncIterator[bytes],
+    fmt: str,
+    max_bytes: int = STREAM_FRAME_BYTES,
+    interval: float = STREAM_FRAME_INTERVAL,
+    tag: Optional[str] = None,
+) -> AsyncIterator[bytes]:
+    """Re-frame upstream NDJSON lines (one per chunk) into `fmt`, coalescing tokens into fewer writes."""
+    return ClosingIterator(_format(upstream, fmt, max_bytes, interval, tag), upstream)
+
+
+async def _format(
+    upstream: AsyncIterator[bytes], fmt: str, max_bytes: int, interval: float, tag: Optional[str],
+) -> AsyncIterator[bytes]:
+    if fmt == "ollama":
+        async for batch in _frames(upstream, max_bytes, interval):
+            yield b"".join(batch)
+        return
+
+    framer = Framer(fmt, tag)
+    async for batch in _frames(upstream, max_bytes, interval):
+        out: List[bytes] = []
+        tokens: List[bytes] = []
+        for chunk in batch:
+            line = chunk.rstrip(b"\n")
+            token = response_token(line)
+            if token is not None and (b'"done":false' in line or b'"done": false' in line):
+                tokens.append(token)
+                continue
+            # Done frame, status or error line: flush tokens so far and parse this one fully
+            if tokens:
+                out.append(framer.tokens(tokens))
+                tokens = []
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(obj, dict):
+                continue
+            if token is not None and obj.get("response"):
+                out.append(framer.tokens([token]))
+            if obj.get("done") is True and "error" not in obj:
+                out.append(framer.done(obj))
+            else:
+                out.append(framer.other(line))
+        if tokens:
+            out.append(framer.tokens(tokens))
+        if out:
+            yield b"".join(out)
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse that stops as soon as the client disconnects and always
+    closes its body, so the upstream generation is aborted and its scheduler slot
+    freed right away instead of whenever the generator is garbage collected.
+    """
+
+    async def __call__(self, scope, receive, send) -> None:
+        # Starlette only listens for http.disconnect below ASGI spec 2.4; on newer
+        # servers a gone client would go unnoticed until the next write fails.
+        if scope["type"] == "http":
+            scope = {**scope, "asgi": {**scope.get("asgi", {}), "spec_version": "2.3"}}
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
@@ -0,0 +1,81 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from batch import run_batch  # noqa: E402
+from exceptions import CapacityExceeded, ExternalServiceError  # noqa: E402
+
+ITEMS = [{"id": str(i), "prompt": f"p{i}", "options": {}} for i in range(4)]
+
+
+class Refunds:
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, unserved):
+        self.calls.append(unserved)
+
+
+async def _generate(item):
+    if item["id"] == "1":
+        raise ExternalServiceError("node down")
+    if item["id"] == "2":
+        raise CapacityExceeded("Timed out waiting for a generation slot")
+    await asyncio.sleep(0.01 * int(item["id"]))
+    return {"response": item["prompt"]}
+
+
+def test_failed_items_are_refunded_and_never_abort_the_rest():
+    async def main():
+        refunds = Refunds()
+        lines = [json.loads(line) async for line in run_batch(ITEMS, _generate, 2, refunds)]
+        return lines, refunds.calls
+
+    lines, refunds = asyncio.run(main())
+    by_id = {line["id"]: line for line in lines[:-1]}
+    assert by_id["0"] == {"id": "0", "response": "p0"} and by_id["3"] == {"id": "3", "response": "p3"}
+    assert by_id["1"]["error"] == "Upstream unavailable"
+    assert by_id["2"]["error"] == "Timed out waiting for a generation slot"
+    assert lines[-1] == {"done": True, "total": 4, "succeeded": 2, "failed": 2}
+    assert refunds == [2]
+
+
+def test_disconnect_cancels_the_rest_and_refunds_what_was_not_delivered():
+    async def main():
+        refunds = Refunds()
+        started = []
+
+        async def generate(item):
+            started.append(item["id"])
+            if item["id"] != "0":
+                await asyncio.Event().wait()
+            return {"response": "ok"}
+
+        body = run_batch(ITEMS, generate, 2, refunds)
+        first = json.loads(await body.__anext__())
+        await body.aclose()
+        return first, started, refunds.calls
+
+    first, started, refunds = asyncio.run(main())
+    assert first["id"] == "0"
+    # Concurrency 2: item 3 never started, items 1 and 2 were cancelled
+    assert sorted(started) == ["0", "1", "2"]
+    assert refunds == [3]
+
+
+def test_batch_dropped_before_the_first_line_refunds_every_item():
+    async def main():
+        refunds = Refunds()
+        started = []
+
+        async def generate(item):
+            started.append(item["id"])
+            return {"response": "ok"}
+
+        await run_batch(ITEMS, generate, 2, refunds).aclose()
+        return started, refunds.calls
+
+    assert asyncio.run(main()) == ([], [4])
@@ -0,0 +1,94 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from coalesce import Coalescer  # noqa: E402
+from exceptions import ExternalServiceError  # noqa: E402
+
+
+async def _body():
+    yield b"a"
+    yield b"b"
+
+
+def _opener(opened_by, name, blocked=None, error=None):
+    async def open_():
+        opened_by.append(name)
+        if blocked is not None:
+            await blocked.wait()
+        if error is not None:
+            raise error
+        return _body()
+    return open_
+
+
+async def _read(stream):
+    return [chunk async for chunk in stream]
+
+
+def test_cancelled_opener_hands_the_flight_to_a_joiner():
+    async def main():
+        coalescer = Coalescer(enabled=True)
+        opened_by = []
+        first = asyncio.create_task(coalescer.stream("k", _opener(opened_by, "first", blocked=asyncio.Event())))
+        await asyncio.sleep(0)
+        joiners = [asyncio.create_task(coalescer.stream("k", _opener(opened_by, name))) for name in ("j1", "j2")]
+        await asyncio.sleep(0)
+
+        first.cancel()
+        streams = await asyncio.gather(*joiners)
+        assert [await _read(s) for s in streams] == [[b"a", b"b"], [b"a", b"b"]]
+        assert opened_by == ["first", "j1"]
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+    asyncio.run(main())
+
+
+def test_open_error_reaches_every_waiter():
+    async def main():
+        coalescer = Coalescer(enabled=True)
+        gate = asyncio.Event()
+        opened_by = []
+        error = ExternalServiceError("all nodes down")
+        first = asyncio.create_task(coalescer.stream("k", _opener(opened_by, "first", blocked=gate, error=error)))
+        await asyncio.sleep(0)
+        joiner = asyncio.create_task(coalescer.stream("k", _opener(opened_by, "j1")))
+        await asyncio.sleep(0)
+
+        gate.set()
+        results = await asyncio.gather(first, joiner, return_exceptions=True)
+        assert results == [error, error]
+        assert opened_by == ["first"]
+
+    asyncio.run(main())
+
+
+def test_subscriber_dropped_unread_stops_the_flight():
+    async def main():
+        coalescer = Coalescer(enabled=True)
+        closed = asyncio.Event()
+
+        async def endless():
+            try:
+                while True:
+                    yield b"x"
+                    await asyncio.sleep(0)
+            finally:
+                closed.set()
+
+        async def open_():
+            return endless()
+
+        stream = await coalescer.stream("k", open_)
+        await asyncio.sleep(0.01)  # the flight runs ahead until it waits for readers
+        await stream.aclose()
+
+        await asyncio.wait_for(closed.wait(), 1)
+        assert not coalescer.has_flight("k")
+
+    asyncio.run(main())
@@ -0,0 +1,83 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from metering import Meter  # noqa: E402
+from ollama_pool import OllamaPool  # noqa: E402
+from scheduler import AdmissionScheduler  # noqa: E402
+from stream_format import ClosingStreamingResponse, format_stream  # noqa: E402
+
+
+class StubStream(httpx.AsyncByteStream):
+    def __init__(self):
+        self.closed = False
+
+    async def __aiter__(self):
+        for token in ("Hel", "lo"):
+            yield json.dumps({"response": token, "done": False}).encode() + b"\n"
+        yield b'{"done":true}\n'
+
+    async def aclose(self):
+        self.closed = True
+
+
+def test_disconnect_before_the_first_chunk_frees_the_slot_and_the_connection():
+    async def main():
+        upstream = StubStream()
+        pool = OllamaPool(
+            ["http://ollama:11434"],
+            lambda url: httpx.AsyncClient(
+                base_url=url, transport=httpx.MockTransport(lambda request: httpx.Response(200, stream=upstream)),
+            ),
+            health_interval=0,
+        )
+        scheduler = AdmissionScheduler(max_concurrency=1, weights={})
+        meter = Meter(None)
+        ticket = scheduler.submit("u1", "free")
+        body = await pool.open_stream("/api/generate", {"model": "llama3", "stream": True})
+        body = meter.track("u1", "llama3", scheduler.hold(ticket, body))
+        response = ClosingStreamingResponse(format_stream(body, "ndjson"), media_type="application/x-ndjson")
+        assert scheduler.active == 1 and pool.nodes[0].outstanding == 1
+
+        sent = []
+
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message["type"])
+            await asyncio.sleep(0.01)  # the disconnect is noticed before the first body chunk
+
+        await response({"type": "http", "asgi": {"spec_version": "2.4"}}, receive, send)
+
+        assert "http.response.body" not in sent
+        assert scheduler.active == 0 and ticket.released
+        assert pool.nodes[0].outstanding == 0 and upstream.closed
+        assert meter.aborted == 1
+        await pool.close()
+
+    asyncio.run(main())
+
+
+def test_queued_request_dropped_unread_gives_up_its_place():
+    async def main():
+        scheduler = AdmissionScheduler(max_concurrency=1, weights={})
+        first = scheduler.submit("u1", "free")
+        waiting = scheduler.submit("u2", "free")
+        body = scheduler.hold(first, format_stream(_never_read(), "ollama"))
+
+        await body.aclose()
+        assert first.released and waiting.admitted
+        assert scheduler.active == 1 and scheduler.queued == 0
+
+    asyncio.run(main())
+
+
+async def _never_read():
+    raise AssertionError("must not be read")
+    yield b""
@@ -0,0 +1,53 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from entitlements import PLAN_KEY, USERS_KEY, EntitlementCache  # noqa: E402
+
+fakeredis = pytest.importorskip("fakeredis")
+
+PRO = {"id": 2, "slug": "pro", "version": 1, "features": {"max_messages": 500}}
+PRO_CLAIM = {"v": 1, "pid": 2, "plan": "pro", "lim": {"max_messages": 500}, "flags": []}
+
+
+def _resolve(users, claim):
+    import main
+
+    async def run():
+        r = fakeredis.FakeAsyncRedis(decode_responses=True)
+        await r.set(PLAN_KEY.format(plan_id=2), json.dumps(PRO))
+        for user_id, plan_id in users.items():
+            await r.hset(USERS_KEY.format(shard=0), user_id, plan_id)
+        cache = EntitlementCache(r)
+        main.entitlement_cache, saved = cache, main.entitlement_cache
+        try:
+            return await main.resolve_limits("7", claim), await cache.lookup("7")
+        finally:
+            main.entitlement_cache = saved
+
+    return asyncio.run(run())
+
+
+def test_synced_plan_wins():
+    (plan, limits), known = _resolve({"7": "2"}, None)
+    assert plan["slug"] == "pro" and limits["day"] == 500
+    assert known == (True, PRO)
+
+
+def test_downgraded_user_gets_defaults_despite_a_paid_claim():
+    import main
+
+    (plan, limits), known = _resolve({"7": "0"}, PRO_CLAIM)
+    assert known == (True, None)
+    assert plan is None and limits == main.DEFAULT_QUOTA_LIMITS
+
+
+def test_claim_only_for_users_not_synced_yet():
+    (plan, limits), known = _resolve({}, PRO_CLAIM)
+    assert known == (False, None)
+    assert plan["slug"] == "pro" and limits["day"] == 500
@@ -0,0 +1,54 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import metrics  # noqa: E402
+
+
+def _registry(proc):
+    registry = metrics.Registry()
+    registry.proc = proc
+    requests = metrics.Counter("test_requests_total", "Requests", ("model",), registry=registry)
+    latency = metrics.Histogram("test_latency_seconds", "Latency", ("model",), buckets=(0.1, 1), registry=registry)
+    return registry, requests, latency
+
+
+def test_series_are_labelled_per_process():
+    registry, requests, latency = _registry("web:1")
+    requests.labels("llama3").inc(2)
+    latency.labels("llama3").observe(0.5)
+    other = {"test_requests_total": [[["llama3"], [3]]], "test_latency_seconds": [[["llama3"], [1, 0, 0, 0.05]]]}
+
+    text = registry.render({"web:1": registry.snapshot(), "web:2": other})
+
+    assert 'test_requests_total{model="llama3",proc="web:1"} 2' in text
+    assert 'test_requests_total{model="llama3",proc="web:2"} 3' in text
+    assert 'test_latency_seconds_bucket{model="llama3",proc="web:1",le="1"} 1' in text
+    assert 'test_latency_seconds_count{model="llama3",proc="web:2"} 1' in text
+
+
+def test_an_exiting_process_keeps_its_final_counts():
+    fakeredis = pytest.importorskip("fakeredis")
+
+    async def main():
+        r = fakeredis.FakeAsyncRedis(decode_responses=True)
+        leaving, leaving_requests, _ = _registry("worker:7")
+        staying, _, _ = _registry("web:1")
+        metrics.METRICS_ENABLED, enabled = True, metrics.METRICS_ENABLED
+        try:
+            leaving.start(r)
+            staying.r = r
+            while not await r.exists(metrics.PROCESS_KEY.format(proc="worker:7")):
+                await asyncio.sleep(0.01)
+            # Recorded after the last periodic publish, then the process shuts down
+            leaving_requests.labels("llama3").inc(5)
+            await leaving.close()
+        finally:
+            metrics.METRICS_ENABLED = enabled
+        return await staying.scrape()
+
+    assert 'test_requests_total{model="llama3",proc="worker:7"} 5' in asyncio.run(main())
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from exceptions import ExternalServiceError  # noqa: E402
+from ollama_pool import CircuitBreaker, OllamaPool  # noqa: E402
+
+MODEL = "llama3:latest"
+
+
+class StubOllama:
+    """An Ollama node behind httpx.MockTransport: /api/tags, /api/ps, /api/chat and /api/embeddings."""
+
+    def __init__(self, name, models=(MODEL,), loaded=(), status=200):
+        self.name = name
+        self.models = list(models)
+        self.loaded = list(loaded)
+        self.status = status  # 200, an error status, or "down" (connection refused)
+        self.calls = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.calls.append(request.url.path)
+        if self.status == "down":
+            raise httpx.ConnectError("connection refused", request=request)
+        if request.url.path == "/api/tags":
+            return httpx.Response(200, json={"models": [{"name": m} for m in self.models]})
+        if request.url.path == "/api/ps":
+            return httpx.Response(200, json={"models": [{"name": m} for m in self.loaded]})
+        if self.status != 200:
+            return httpx.Response(self.status, text=f"{self.name} failed")
+        if request.url.path == "/api/embeddings":
+            return httpx.Response(200, json={"embedding": [0.1, 0.2], "node": self.name})
+        lines = [{"message": {"content": self.name}, "done": False}, {"done": True}]
+        return httpx.Response(200, content="\n".join(json.dumps(line) for line in lines).encode())
+
+
+def _pool(*stubs, **kwargs):
+    by_url = {f"http://{s.name}:11434": s for s in stubs}
+    pool = OllamaPool(
+        list(by_url),
+        lambda url: httpx.AsyncClient(base_url=url, transport=httpx.MockTransport(by_url[url])),
+        health_interval=0,
+        **kwargs,
+    )
+    for node in pool.nodes:
+        node.breaker = CircuitBreaker(node.url, max_failures=2, latency_threshold=30, cooldown=60)
+    return pool
+
+
+async def _chat(pool):
+    lines = await pool.open_stream("/api/chat", {"model": "llama3", "stream": True})
+    return [json.loads(line) async for line in lines]
+
+
+def test_pick_prefers_nodes_with_the_model_loaded_then_the_least_busy():
+    async def main():
+        missing = StubOllama("missing", models=["mistral:latest"], loaded=["mistral:latest"])
+        cold = StubOllama("cold")
+        warm = StubOllama("warm", loaded=[MODEL])
+        pool = _pool(missing, cold, warm)
+        await pool.probe_all()
+        a, b, c = pool.nodes
+
+        assert pool.pick(MODEL, set()) is c
+        c.outstanding = 3  # busier than the cold penalty
+        assert pool.pick(MODEL, set()) is b
+        b.healthy = False
+        assert pool.pick(MODEL, set()) is c
+        assert (await _chat(pool))[0]["message"]["content"] == "warm"
+        await pool.close()
+
+    asyncio.run(main())
+
+
+def test_retries_on_another_node_before_any_output():
+    async def main():
+        broken = StubOllama("broken", loaded=[MODEL], status=500)
+        missing = StubOllama("missing", status=404)
+        good = StubOllama("good")
+        pool = _pool(broken, missing, good)
+        await pool.probe_all()
+        a, b, c = pool.nodes
+        b.loaded_models = {MODEL}
+        b.outstanding = 1  # tried second
+
+        assert (await _chat(pool))[0]["message"]["content"] == "good"
+        assert pool.retries == 2
+        assert (a.failures, a.breaker.failures) == (1, 1)
+        # A missing model is not the node's fault: no strike against its breaker
+        assert (b.failures, b.breaker.failures) == (1, 0)
+        assert MODEL not in b.available_models
+        assert c.outstanding == 0 and c.breaker.state == CircuitBreaker.CLOSED
+
+        resp = await pool.post("/api/embeddings", {"model": "llama3", "prompt": "hi"})
+        assert resp.json()["node"] == "good"
+        await pool.close()
+
+    asyncio.run(main())
+
+
+def test_breaker_opens_then_half_opens_for_one_trial():
+    async def main():
+        flaky = StubOllama("flaky", loaded=[MODEL], status="down")
+        spare = StubOllama("spare")
+        pool = _pool(flaky, spare, max_attempts=1)
+        a, b = pool.nodes
+        a.loaded_models = {MODEL}
+
+        for _ in range(2):
+            with pytest.raises(ExternalServiceError):
+                await _chat(pool)
+        assert a.breaker.state == CircuitBreaker.OPEN
+        # Open: traffic goes to the other node
+        assert (await _chat(pool))[0]["message"]["content"] == "spare"
+
+        # Cooldown over: one trial request; failing it re-opens at once
+        a.breaker.opened_at -= 60
+        assert pool.pick(MODEL, set()) is a
+        with pytest.raises(ExternalServiceError):
+            await _chat(pool)
+        assert a.breaker.state == CircuitBreaker.OPEN and a.breaker.trips == 2
+
+        # Next trial succeeds and closes it
+        a.breaker.opened_at -= 60
+        flaky.status = 200
+        a.breaker.begin()
+        assert a.breaker.state == CircuitBreaker.HALF_OPEN and not a.breaker.available()
+        a.breaker.abandon()
+        assert (await _chat(pool))[0]["message"]["content"] == "flaky"
+        assert a.breaker.state == CircuitBreaker.CLOSED
+        await pool.close()
+
+    asyncio.run(main())
+
+
+def test_all_nodes_down_still_tries_them_then_raises():
+    async def main():
+        stubs = [StubOllama("one", status="down"), StubOllama("two", status="down")]
+        pool = _pool(*stubs)
+        await pool.probe_all()
+        assert not any(n.healthy for n in pool.nodes)
+
+        with pytest.raises(ExternalServiceError, match="connection refused"):
+            await _chat(pool)
+        assert all(s.calls[-1] == "/api/chat" for s in stubs)
+
+        # Unhealthy and not yet recovered per the prober, but tried anyway and it answers
+        stubs[1].status = 200
+        assert (await _chat(pool))[0]["message"]["content"] == "two"
+        await pool.close()
+
+    asyncio.run(main())
@@ -0,0 +1,24 @@
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import profiler  # noqa: E402
+
+
+@pytest.mark.parametrize("seconds", ["0", "-1", "nan", "inf", "-inf"])
+def test_profile_seconds_must_be_a_positive_number(monkeypatch, seconds):
+    import main
+
+    monkeypatch.setattr(profiler, "PROFILING_ENABLED", True)
+    monkeypatch.setitem(main.app.dependency_overrides, main.require_staff, lambda: {"user_id": "1", "staff": True})
+    started = []
+    monkeypatch.setattr(profiler, "start_worker_profile", lambda *args: started.append(args))
+
+    resp = TestClient(main.app).post("/debug/profile", params={"seconds": seconds})
+    assert resp.status_code == 400
+    assert resp.json() == {"error": "seconds must be a positive number"}
+    assert started == []
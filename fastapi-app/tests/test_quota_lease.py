@@ -0,0 +1,28 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import rate_limit  # noqa: E402
+from quota_lease import Lease, LeasedQuota  # noqa: E402
+
+
+def test_release_all_refunds_the_other_leases_when_one_fails(monkeypatch, caplog):
+    refunded = []
+
+    async def refund(user_id, keys, tokens):
+        if user_id == "u2":
+            raise ConnectionError("redis went away")
+        refunded.append((user_id, tokens))
+
+    monkeypatch.setattr(rate_limit, "refund", refund)
+    quota = LeasedQuota()
+    for user_id, tokens in (("u1", 3), ("u2", 4), ("u3", 5)):
+        quota._leases[user_id] = Lease(tokens=tokens, expires_at=0, limits={}, keys=[f"k:{user_id}"])
+
+    asyncio.run(quota.release_all())
+
+    assert refunded == [("u1", 3), ("u3", 5)]
+    assert "Quota lease refund failed for u2" in caplog.text
+    assert not quota._leases
@@ -0,0 +1,103 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import rate_limit  # noqa: E402
+from exceptions import RateLimitExceeded  # noqa: E402
+
+fakeredis = pytest.importorskip("fakeredis")  # with lupa, for the Lua scripts
+
+NOW = 1_700_000_000  # 2023-11-14 22:13:20 UTC
+
+
+def _run(monkeypatch, scenario):
+    async def main():
+        r = fakeredis.FakeAsyncRedis(decode_responses=True)
+        monkeypatch.setattr(rate_limit, "_consume_script", r.register_script(rate_limit._CONSUME_LUA))
+        monkeypatch.setattr(rate_limit, "_refund_script", r.register_script(rate_limit._REFUND_LUA))
+        return await scenario(r)
+
+    return asyncio.run(main())
+
+
+def test_all_windows_or_nothing(monkeypatch):
+    async def scenario(r):
+        limits = {"minute": 5, "day": 2}
+        for _ in range(2):
+            await rate_limit.consume("7", limits, now=NOW)
+        with pytest.raises(RateLimitExceeded) as e:
+            await rate_limit.consume("7", limits, now=NOW)
+        assert e.value.headers["Retry-After"] == str(86400 - NOW % 86400)
+        # The refused request counted nowhere, not even in the window that had room
+        minute = rate_limit.bucket_key("minute", str(NOW // 60), "7")
+        return await r.hget(minute, "7")
+
+    assert _run(monkeypatch, scenario) == "2"
+
+
+def test_partial_grant_down_to_min_cost(monkeypatch):
+    async def scenario(r):
+        limits = {"hour": 10}
+        first = await rate_limit.consume("7", limits, cost=8, min_cost=1, now=NOW)
+        second = await rate_limit.consume("7", limits, cost=8, min_cost=1, now=NOW)
+        with pytest.raises(RateLimitExceeded):
+            await rate_limit.consume("7", limits, cost=8, min_cost=1, now=NOW)
+        return first, second
+
+    first, second = _run(monkeypatch, scenario)
+    assert (first.granted, second.granted) == (8, 2)
+    assert second.remaining == {"hour": 0}
+    assert second.headers()["X-RateLimit-Remaining-Hour"] == "0"
+
+
+def test_refund_gives_back_but_never_recreates_a_bucket(monkeypatch):
+    async def scenario(r):
+        limits = {"minute": 3, "day": 3}
+        result = await rate_limit.consume("7", limits, cost=3, now=NOW)
+        await rate_limit.refund("7", result.keys, 2)
+        after_refund = await rate_limit.consume("7", limits, cost=2, now=NOW)
+        minute, day = result.keys
+        await r.delete(minute)  # the minute bucket expired
+        await rate_limit.refund("7", result.keys, 1)
+        return after_refund, await r.exists(minute), await r.hget(day, "7")
+
+    after_refund, minute_exists, day = _run(monkeypatch, scenario)
+    assert after_refund.counts == {"minute": 3, "day": 3}
+    assert minute_exists == 0 and day == "2"
+
+
+def test_new_window_starts_from_zero_with_a_ttl(monkeypatch):
+    async def scenario(r):
+        limits = {"minute": 1}
+        first = await rate_limit.consume("7", limits, now=NOW)
+        with pytest.raises(RateLimitExceeded):
+            await rate_limit.consume("7", limits, now=NOW + 1)
+        later = await rate_limit.consume("7", limits, now=NOW + 60)
+        return first, later, await r.ttl(later.keys[0])
+
+    first, later, ttl = _run(monkeypatch, scenario)
+    assert first.keys != later.keys and later.counts == {"minute": 1}
+    assert 0 < ttl <= 60 + rate_limit.QUOTA_KEY_TTL_BUFFER
+
+
+def test_users_share_sharded_hashes_without_sharing_counts(monkeypatch):
+    async def scenario(r):
+        for user_id in ("101", "102"):
+            await rate_limit.consume(user_id, {"day": 1}, now=NOW)
+        key = rate_limit.bucket_key("day", "20231114", "101")
+        return key, rate_limit.bucket_key("day", "20231114", "199"), await r.hgetall(key)
+
+    key, same_shard, counts = _run(monkeypatch, scenario)
+    assert key == same_shard == "quota:day:20231114:1"
+    assert counts == {"101": "1", "102": "1"}
+
+
+def test_window_buckets_reset_on_utc_boundaries():
+    assert rate_limit.window_bucket("day", NOW) == ("20231114", 86400 - NOW % 86400)
+    # 30-day November: the month bucket resets at 2023-12-01 00:00 UTC
+    bucket, reset = rate_limit.window_bucket("month", NOW)
+    assert bucket == "202311" and NOW + reset == 1_701_388_800
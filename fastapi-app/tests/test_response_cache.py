@@ -0,0 +1,39 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from response_cache import ResponseCache  # noqa: E402
+
+fakeredis = pytest.importorskip("fakeredis")  # with lupa, for the Lua scripts
+
+LINES = [b'{"response":"hi","done":false}', b'{"done":true}']
+
+
+def test_stats_count_hits_and_misses():
+    async def main():
+        cache = ResponseCache(fakeredis.FakeAsyncRedis(), enabled=True)
+        key = cache.key("llama3", "Hello   there")
+        assert await cache.get(key) is None
+        await cache.put(key, LINES)
+        assert await cache.get(cache.key("llama3", "Hello there")) == LINES
+        return await cache.stats()
+
+    stats = asyncio.run(main())
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+    assert stats["hit_rate"] == 0.5 and stats["available"] is True
+
+
+def test_redis_down_is_a_miss_and_reported_as_unavailable():
+    async def main():
+        server = fakeredis.FakeServer()
+        server.connected = False
+        cache = ResponseCache(fakeredis.FakeAsyncRedis(server=server), enabled=True)
+        key = cache.key("llama3", "hi")
+        await cache.put(key, LINES)
+        return await cache.get(key), await cache.stats()
+
+    assert asyncio.run(main()) == (None, {"available": False})
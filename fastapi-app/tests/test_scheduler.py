@@ -0,0 +1,138 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from exceptions import CapacityExceeded  # noqa: E402
+from scheduler import AdmissionScheduler  # noqa: E402
+
+
+def _admit_all(scheduler, blocker, tickets):
+    """Release one slot at a time and return the tickets in the order they were admitted."""
+    order, current = [], blocker
+    while len(order) < len(tickets):
+        scheduler.release(current)
+        current = next(t for t in tickets if t.admitted and t not in order)
+        order.append(current)
+    return order
+
+
+def test_plans_are_admitted_in_proportion_to_their_weight():
+    async def main():
+        scheduler = AdmissionScheduler(max_concurrency=1, weights={"free": 1, "pro": 4})
+        blocker = scheduler.submit("0", "free")
+        free = [scheduler.submit(f"f{i}", "free") for i in range(4)]
+        pro = [scheduler.submit(f"p{i}", "pro") for i in range(8)]
+
+        order = _admit_all(scheduler, blocker, free + pro)
+        plans = "".join(t.plan[0] for t in order)
+        assert plans[:10] == "fppppfpppp"
+        assert scheduler.queued == 0
+
+    asyncio.run(main())
+
+
+def test_an_idle_plan_does_not_bank_credit():
+    async def main():
+        scheduler = AdmissionScheduler(max_concurrency=1, weights={"free": 1, "pro": 4})
+        blocker = scheduler.submit("0", "pro")
+        pro = [scheduler.submit(f"p{i}", "pro") for i in range(8)]
+        blocker = _admit_all(scheduler, blocker, pro[:4])[-1]
+        # free was idle while pro ran four turns: it re-enters at pro's virtual time,
+        # not at zero, so it does not get back-to-back turns to catch up
+        free = [scheduler.submit(f"f{i}", "free") for i in range(4)]
+
+        order = _admit_all(scheduler, blocker, pro[4:] + free)
+        assert "".join(t.plan[0] for t in order[:6]) == "pfpppf"
+
+    asyncio.run(main())
+
+
+def test_users_take_turns_within_a_plan():
+    async def main():
+        scheduler = AdmissionScheduler(max_concurrency=1, weights={})
+        blocker = scheduler.submit("0", "free")
+        heavy = [scheduler.submit("heavy", "free") for _ in range(3)]
+        light = scheduler.submit("light", "free")
+
+        assert [scheduler.position(t) for t in heavy + [light]] == [1, 3, 5, 2]
+        order = _admit_all(scheduler, blocker, heavy + [light])
+        assert order == [heavy[0], light, heavy[1], heavy[2]]
+
+    asyncio.run(main())
+
+
+def test_abandoned_wait_gives_up_its_place():
+    async def main():
+        scheduler = AdmissionScheduler(max_concurrency=1, weights={})
+        blocker = scheduler.submit("0", "free")
+        gone = scheduler.submit("u1", "free")
+        waiting = scheduler.submit("u2", "free")
+
+        async def wait(ticket):
+            async for _ in scheduler.wait_with_feedback(ticket, interval=0.01):
+                pass
+
+        task = asyncio.create_task(wait(gone))
+        await asyncio.sleep(0.02)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert scheduler.queued == 1
+
+        scheduler.release(blocker)
+        assert waiting.admitted and not gone.admitted
+        assert scheduler.active == 1 and scheduler.queued == 0
+
+    asyncio.run(main())
+
+
+def test_queue_timeout_withdraws_the_ticket():
+    async def main():
+        scheduler = AdmissionScheduler(max_concurrency=1, weights={}, queue_timeout=0.05)
+        scheduler.submit("0", "free")
+        ticket = scheduler.submit("u1", "free")
+
+        with pytest.raises(CapacityExceeded):
+            async for _ in scheduler.wait_with_feedback(ticket, interval=0.01):
+                pass
+        assert scheduler.queued == 0 and scheduler.timeouts == 1
+
+    asyncio.run(main())
+
+
+def test_stream_cancelled_mid_read_releases_the_slot():
+    async def main():
+        scheduler = AdmissionScheduler(max_concurrency=1, weights={})
+        ticket = scheduler.submit("u1", "free")
+        waiting = scheduler.submit("u2", "free")
+        upstream_closed = asyncio.Event()
+
+        async def upstream():
+            try:
+                while True:
+                    yield b"x"
+                    await asyncio.sleep(0.01)
+            finally:
+                upstream_closed.set()
+
+        body = scheduler.hold(ticket, upstream())
+
+        async def read():
+            async for _ in body:
+                pass
+
+        task = asyncio.create_task(read())
+        await asyncio.sleep(0.03)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await body.aclose()
+
+        assert ticket.released and waiting.admitted and upstream_closed.is_set()
+        assert scheduler.active == 1
+
+    asyncio.run(main())
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import semantic_cache  # noqa: E402
+from semantic_cache import SemanticCache  # noqa: E402
+
+
+def _vec(*values):
+    v = np.asarray(values, dtype=np.float32)
+    return v / np.linalg.norm(v)
+
+
+def _cache(directory, owner, max_entries=8):
+    cache = SemanticCache(enabled=True, threshold=0.99, max_entries=max_entries, directory=str(directory))
+    cache.owner = lambda: owner
+    return cache
+
+
+def _answer(text):
+    return [b'{"response":"%s","done":false}' % text.encode(), b'{"done":true}']
+
+
+def test_workers_save_their_own_files_and_load_merges_them(tmp_path):
+    one, two = _cache(tmp_path, "web-1"), _cache(tmp_path, "web-2")
+    one.add("llama3", _vec(1, 0, 0), _answer("one"))
+    two.add("llama3", _vec(0, 1, 0), _answer("two"))
+    two.add("llama3@abc", _vec(0, 0, 1), _answer("options"))
+    # Saved in any order, neither overwrites the other
+    asyncio.run(two.save())
+    asyncio.run(one.save())
+    assert sorted(os.listdir(tmp_path)) == ["llama3.web-1.npz", "llama3.web-2.npz", "llama3@abc.web-2.npz"]
+
+    restarted = _cache(tmp_path, "web-1")
+    restarted.load()
+    assert restarted.search("llama3", _vec(1, 0, 0)) == _answer("one")
+    assert restarted.search("llama3", _vec(0, 1, 0)) == _answer("two")
+    assert restarted.search("llama3@abc", _vec(0, 0, 1)) == _answer("options")
+    assert restarted.search("llama3", _vec(1, 1, 1)) is None
+    assert restarted.stats()["entries"] == 3
+
+    # What it merged from web-2 goes into its own files on the next save
+    asyncio.run(restarted.save())
+    assert "llama3@abc.web-1.npz" in os.listdir(tmp_path)
+
+
+def test_merge_keeps_the_most_recent_distinct_entries(tmp_path):
+    one, two = _cache(tmp_path, "web-1", max_entries=2), _cache(tmp_path, "web-2", max_entries=2)
+    one.add("m", _vec(1, 0), _answer("old"))
+    two.add("m", _vec(0, 1), _answer("newer"))
+    one.add("m", _vec(0, 1), _answer("newest"))  # the same prompt, answered again
+    one.partitions["m"].last_used[:2] = [1, 3]
+    two.partitions["m"].last_used[:1] = [2]
+    asyncio.run(one.save())
+    asyncio.run(two.save())
+
+    merged = _cache(tmp_path, "web-3", max_entries=2)
+    merged.load()
+    assert merged.partitions["m"].size == 2
+    assert merged.search("m", _vec(0, 1)) == _answer("newest")
+    assert merged.search("m", _vec(1, 0)) == _answer("old")
+
+
+def test_stale_files_of_other_processes_are_folded_in_and_removed(tmp_path):
+    gone = _cache(tmp_path, "web-9")
+    gone.add("m", _vec(1, 0), _answer("kept"))
+    asyncio.run(gone.save())
+    old = time.time() - semantic_cache.SEMANTIC_CACHE_FILE_TTL - 1
+    os.utime(tmp_path / "m.web-9.npz", (old, old))
+
+    cache = _cache(tmp_path, "web-1")
+    cache.load()
+    assert os.listdir(tmp_path) == ["m.web-1.npz"]
+
+    again = _cache(tmp_path, "web-2")
+    again.load()
+    assert again.search("m", _vec(1, 0)) == _answer("kept")
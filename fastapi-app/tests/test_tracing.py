@@ -0,0 +1,182 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import tracing  # noqa: E402
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+class Collected:
+    def __init__(self):
+        self.spans = []
+
+    def add(self, span):
+        self.spans.append(span)
+
+
+def _line(token):
+    return json.dumps({"response": token, "done": False}).encode() + b"\n"
+
+
+@pytest.mark.parametrize("value, expected", [
+    (f"00-{TRACE_ID}-{PARENT_ID}-01", (TRACE_ID, PARENT_ID, True)),
+    (f"00-{TRACE_ID.upper()}-{PARENT_ID}-00", (TRACE_ID, PARENT_ID, False)),
+    # A later version may add fields; the first four still parse
+    (f" 01-{TRACE_ID}-{PARENT_ID}-03-extra ", (TRACE_ID, PARENT_ID, True)),
+    (f"ff-{TRACE_ID}-{PARENT_ID}-01", None),
+    (f"00-{'0' * 32}-{PARENT_ID}-01", None),
+    (f"00-{TRACE_ID}-{'0' * 16}-01", None),
+    (f"00-{TRACE_ID[:-1]}-{PARENT_ID}-01", None),
+    (f"00-{TRACE_ID}-{PARENT_ID}-zz", None),
+    (f"00-{'g' * 32}-{PARENT_ID}-01", None),
+    ("", None),
+    (None, None),
+])
+def test_parse_traceparent(value, expected):
+    assert tracing.parse_traceparent(value) == expected
+
+
+def test_remote_context_is_continued():
+    span = tracing.start_span("chat", traceparent=f"00-{TRACE_ID}-{PARENT_ID}-00")
+    assert (span.trace_id, span.parent_id, span.sampled) == (TRACE_ID, PARENT_ID, False)
+    assert span.traceparent == f"00-{TRACE_ID}-{span.span_id}-00"
+
+
+def test_trace_stream_splits_time_to_first_token_from_the_rest(monkeypatch):
+    collected = Collected()
+    monkeypatch.setattr(tracing, "exporter", collected)
+
+    async def upstream():
+        yield b'{"status":"queued","position":1}\n'
+        for token in ("Hel", "lo", ""):
+            yield _line(token)
+
+    async def main():
+        parent = tracing.Span("chat", TRACE_ID, None, True)
+        chunks = [c async for c in tracing.trace_stream(upstream(), parent, started_ns=parent.start_ns)]
+        return parent, chunks
+
+    parent, chunks = asyncio.run(main())
+    assert len(chunks) == 4
+    first, body = collected.spans
+    assert (first.name, body.name) == ("chat.first_token", "chat.stream")
+    assert first.parent_id == body.parent_id == parent.span_id
+    assert first.start_ns == parent.start_ns and first.end_ns <= body.start_ns
+    assert body.attributes == {"tokens": 2} and body.error is None
+
+
+def test_trace_stream_records_how_a_stream_ended(monkeypatch):
+    collected = Collected()
+    monkeypatch.setattr(tracing, "exporter", collected)
+
+    async def failing():
+        yield _line("a")
+        raise RuntimeError("boom")
+
+    async def silent():
+        yield b'{"done":true}\n'
+
+    async def main():
+        parent = tracing.Span("chat", TRACE_ID, None, True)
+        with pytest.raises(RuntimeError):
+            async for _ in tracing.trace_stream(failing(), parent, parent.start_ns):
+                pass
+        async for _ in tracing.trace_stream(silent(), parent, parent.start_ns):
+            pass
+        # Dropped unread: no spans, but the upstream is still closed
+        closed = []
+
+        async def unread():
+            try:
+                yield _line("a")
+            finally:
+                closed.append(True)
+
+        stream = unread()
+        await stream.__anext__()
+        await tracing.trace_stream(stream, parent, parent.start_ns).aclose()
+        return closed
+
+    assert asyncio.run(main()) == [True]
+    errors = [(s.name, s.error) for s in collected.spans]
+    assert errors == [
+        ("chat.first_token", None), ("chat.stream", "RuntimeError: boom"),
+        ("chat.first_token", "no tokens"),
+    ]
+
+
+def test_nothing_is_kept_without_a_sink(monkeypatch):
+    monkeypatch.setattr(tracing, "TRACE_OTLP_ENDPOINT", "")
+    monkeypatch.setattr(tracing, "TRACE_FILE", "")
+
+    async def main():
+        exporter = tracing.SpanExporter()
+        exporter.start()
+        exporter.add(tracing.Span("chat", TRACE_ID, None, True))
+        return exporter
+
+    exporter = asyncio.run(main())
+    assert exporter._task is None
+    assert exporter.stats() == {"buffered": 0, "exported": 0, "dropped": 0, "errors": 0}
+
+
+def test_file_sink_writes_otlp_batches_and_rotates(monkeypatch, tmp_path):
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(tracing, "TRACE_OTLP_ENDPOINT", "")
+    monkeypatch.setattr(tracing, "TRACE_FILE", str(path))
+    monkeypatch.setattr(tracing, "TRACE_BATCH_SIZE", 2)
+
+    async def export(exporter, n):
+        for i in range(n):
+            span = tracing.Span(f"s{i}", TRACE_ID, PARENT_ID, True)
+            span.set("i", i)
+            span.end_ns = span.start_ns + 1
+            exporter.add(span)
+        await exporter.flush()
+
+    exporter = tracing.SpanExporter()
+    asyncio.run(export(exporter, 3))
+    batches = [json.loads(line) for line in path.read_text().splitlines()]
+    spans = [s for b in batches for s in b["resourceSpans"][0]["scopeSpans"][0]["spans"]]
+    assert [len(b["resourceSpans"][0]["scopeSpans"][0]["spans"]) for b in batches] == [2, 1]
+    assert spans[0]["parentSpanId"] == PARENT_ID
+    assert spans[0]["attributes"] == [{"key": "i", "value": {"intValue": "0"}}]
+    assert exporter.exported == 3
+
+    monkeypatch.setattr(tracing, "TRACE_FILE_MAX_BYTES", path.stat().st_size + 1)
+    asyncio.run(export(exporter, 1))
+    assert len((tmp_path / "traces.jsonl.1").read_text().splitlines()) == 2
+    assert len(path.read_text().splitlines()) == 1
+
+
+def test_collector_sink_and_a_dead_collector(monkeypatch):
+    posted = []
+    status = [200]
+
+    def collector(request):
+        posted.append(json.loads(request.content))
+        return httpx.Response(status[0])
+
+    monkeypatch.setattr(tracing, "TRACE_OTLP_ENDPOINT", "http://otel-collector:4318/v1/traces")
+
+    async def main():
+        exporter = tracing.SpanExporter()
+        exporter._client = httpx.AsyncClient(transport=httpx.MockTransport(collector))
+        exporter.add(tracing.Span("ok", TRACE_ID, None, True))
+        await exporter.flush()
+        status[0] = 503
+        exporter.add(tracing.Span("lost", TRACE_ID, None, True))
+        await exporter.flush()
+        await exporter.close()
+        return exporter.stats()
+
+    assert asyncio.run(main()) == {"buffered": 0, "exported": 1, "dropped": 1, "errors": 1}
+    assert [b["resourceSpans"][0]["scopeSpans"][0]["spans"][0]["name"] for b in posted] == ["ok", "lost"]
@@ -0,0 +1,72 @@
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import jobs  # noqa: E402
+import worker  # noqa: E402
+from exceptions import ExternalServiceError  # noqa: E402
+from metering import Meter  # noqa: E402
+
+JOB = {"id": "j1", "user_id": "7", "model": "llama3", "prompt": "hi"}
+
+
+def _upstream(monkeypatch, lines):
+    closed = []
+
+    async def relay():
+        for line in lines:
+            yield json.dumps(line).encode() + b"\n"
+
+    class Lines:
+        def __init__(self):
+            self.gen = relay()
+
+        def __aiter__(self):
+            return self.gen.__aiter__()
+
+        async def aclose(self):
+            closed.append(True)
+            await self.gen.aclose()
+
+    async def open_stream(path, payload):
+        return Lines()
+
+    monkeypatch.setattr(worker.ollama_client, "open_stream", open_stream)
+    meter = Meter(None)
+    monkeypatch.setattr(worker, "meter", meter)
+    return closed, meter
+
+
+@pytest.mark.parametrize("lines, tokens", [
+    ([{"response": "a", "done": False}, {"error": "model crashed"}], 1),
+    ([{"response": "a", "done": False}, {"response": "b", "done": False}], 2),  # no done frame
+])
+def test_failed_generation_closes_the_stream_and_is_metered(monkeypatch, lines, tokens):
+    closed, meter = _upstream(monkeypatch, lines)
+    with pytest.raises(ExternalServiceError):
+        asyncio.run(worker.generate(JOB))
+    assert closed == [True]
+    assert meter.aborted == 1 and meter.aborted_tokens == tokens
+
+
+def test_reaper_leaves_a_job_at_the_timeout_to_its_worker():
+    fakeredis = pytest.importorskip("fakeredis")
+
+    async def main():
+        store = jobs.JobStore(fakeredis.FakeAsyncRedis(decode_responses=True))
+        now = time.time()
+        for job_id, age in (("timing-out", jobs.JOB_TIMEOUT + 1), ("stale", jobs.JOB_TIMEOUT + jobs.JOB_REAP_GRACE + 1)):
+            await store.r.hset(jobs.job_key(job_id), mapping={"id": job_id, "status": "running", "started_at": now - age})
+            await store.r.lpush(jobs.PROCESSING_KEY, job_id)
+
+        assert await store.reap() == 1
+        assert await store.r.lrange(jobs.QUEUE_KEY, 0, -1) == ["stale"]
+        assert await store.r.lrange(jobs.PROCESSING_KEY, 0, -1) == ["timing-out"]
+
+    asyncio.run(main())
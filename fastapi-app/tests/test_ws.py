@@ -0,0 +1,142 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+from fastapi import WebSocketDisconnect
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import ws  # noqa: E402
+
+
+class FakeWebSocket:
+    """Client messages from a queue (None = disconnect); sends block while `gate` is clear."""
+
+    def __init__(self):
+        self.headers = {}
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.sent = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def receive_text(self):
+        msg = await self.incoming.get()
+        if msg is None:
+            raise WebSocketDisconnect(1000)
+        return json.dumps(msg)
+
+    async def send_text(self, text):
+        await self.gate.wait()
+        self.sent.append(json.loads(text))
+
+    def frames(self, stream_id):
+        return [f for f in self.sent if f.get("id") == stream_id]
+
+
+class Upstream:
+    """Ollama NDJSON lines, `total` tokens (None = endless), counting how many were pulled."""
+
+    def __init__(self, total=None):
+        self.total = total
+        self.pulled = 0
+        self.closed = asyncio.Event()
+
+    async def __call__(self, payload):
+        return {}, self._lines()
+
+    async def _lines(self):
+        try:
+            while self.total is None or self.pulled < self.total:
+                self.pulled += 1
+                yield json.dumps({"response": "x" * 100, "done": False}).encode() + b"\n"
+                await asyncio.sleep(0)
+            yield b'{"done":true,"eval_count":1}\n'
+        finally:
+            self.closed.set()
+
+
+async def _until(predicate, timeout=2):
+    async def poll():
+        while not predicate():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_slow_client_stops_the_pull_from_upstream(monkeypatch):
+    monkeypatch.setattr(ws, "WS_SEND_QUEUE", 2)
+
+    async def main():
+        socket = FakeWebSocket()
+        conn = ws.ChatConnection(socket)
+        upstream = Upstream(total=2000)
+        socket.gate.clear()  # the client stops reading
+        server = asyncio.create_task(conn.serve(upstream))
+        await socket.incoming.put({"type": "chat", "id": "a1", "prompt": "hi"})
+
+        await asyncio.sleep(0.3)
+        stalled_at = upstream.pulled
+        await asyncio.sleep(0.1)
+        assert upstream.pulled == stalled_at < 100
+        assert conn._outbox.full()
+
+        socket.gate.set()
+        await _until(lambda: any(f.get("done") for f in socket.frames("a1")))
+        await socket.incoming.put(None)
+        await server
+        return upstream, socket.frames("a1")
+
+    upstream, frames = asyncio.run(main())
+    assert upstream.pulled == 2000
+    assert sum(len(f.get("t", "")) for f in frames) == 2000 * 100
+    assert frames[-1]["done"] is True
+
+
+def test_cancel_closes_the_stream_and_is_acknowledged_after_its_frames():
+    async def main():
+        socket = FakeWebSocket()
+        conn = ws.ChatConnection(socket)
+        upstream = Upstream()
+        server = asyncio.create_task(conn.serve(upstream))
+        await socket.incoming.put({"type": "chat", "id": "a1", "prompt": "hi"})
+        await _until(lambda: socket.frames("a1"))
+
+        await socket.incoming.put({"type": "cancel", "id": "a1"})
+        await asyncio.wait_for(upstream.closed.wait(), 2)
+        await _until(lambda: socket.frames("a1")[-1].get("cancelled"))
+        assert "a1" not in conn.streams
+
+        # Cancelling a finished or unknown stream is a no-op
+        await socket.incoming.put({"type": "cancel", "id": "zz"})
+        await socket.incoming.put(None)
+        await server
+        return socket.frames("a1"), socket.frames("zz")
+
+    frames, unknown = asyncio.run(main())
+    assert frames[-1] == {"id": "a1", "cancelled": True, "done": True}
+    assert all("t" in f for f in frames[:-1])
+    assert unknown == []
+
+
+def test_disconnect_cancels_every_stream():
+    async def main():
+        socket = FakeWebSocket()
+        conn = ws.ChatConnection(socket)
+        upstreams = [Upstream(), Upstream()]
+        opened = iter(upstreams)
+
+        async def open_chat(payload):
+            return await next(opened)(payload)
+
+        server = asyncio.create_task(conn.serve(open_chat))
+        for stream_id in ("a1", "a2"):
+            await socket.incoming.put({"type": "chat", "id": stream_id, "prompt": "hi"})
+        await _until(lambda: socket.frames("a1") and socket.frames("a2"))
+
+        await socket.incoming.put(None)
+        await server
+        return upstreams, conn.streams
+
+    upstreams, streams = asyncio.run(main())
+    assert all(u.closed.is_set() for u in upstreams)
+    assert streams == {}
@@ -0,0 +1,319 @@
+"""
+Lightweight request tracing.
+
+Trace context travels in W3C `traceparent` headers: taken from the client (or
+started here), sent on to Ollama, stored with async jobs and returned to the
+client as `traceresponse`. Finished spans are buffered and exported in batches
+as OTLP/JSON, either POSTed to a collector (TRACE_OTLP_ENDPOINT, e.g.
+http://otel-collector:4318/v1/traces) or appended to TRACE_FILE, one batch per
+line, the layout the collector's otlpjsonfile receiver reads. With neither set,
+trace context is still propagated but no spans are kept.
+
+django-app/ai/tracing.py is the same for Django; keep the two in sync.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import AsyncIterator, Deque, Iterator, Optional
+
+import httpx
+
+from stream_format import ClosingIterator, response_token
+
+logger = logging.getLogger(__name__)
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "fastapi-app")
+# Share of new traces that are recorded; incoming traceparents keep their own decision
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+# TRACE_FILE is moved to TRACE_FILE.1 (replacing it) once it would grow past this; 0 = unbounded
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", str(100 * 1024 * 1024)))
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "2"))
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "512"))
+# Finished spans kept while the sink is slow or down; the oldest are dropped beyond this
+TRACE_MAX_BUFFER = int(os.getenv("TRACE_MAX_BUFFER", "20000"))
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "sampled", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool, kind: int = INTERNAL, start_ns: Optional[int] = None):
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.sampled = sampled
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = 0
+        self.attributes: dict = {}
+        self.error: Optional[str] = None
+
+    def set(self, key: str, value) -> None:
+        if self.sampled:
+            self.attributes[key] = value
+
+    def end(self, error: Optional[str] = None) -> None:
+        if self.end_ns:
+            return
+        self.end_ns = time.time_ns()
+        if error:
+            self.error = error
+        if self.sampled:
+            exporter.add(self)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[tuple]:
+    """(trace_id, parent span id, sampled) from a W3C traceparent, or None if invalid."""
+    parts = (value or "").strip().split("-")
+    if len(parts) < 4 or len(parts[0]) != 2 or parts[0] == "ff" or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        flags = int(parts[3][:2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1].lower(), parts[2].lower(), bool(flags & 1)
+
+
+def start_span(name: str, parent: Optional[Span] = None, traceparent: Optional[str] = None, kind: int = INTERNAL, start_ns: Optional[int] = None) -> Span:
+    """A span under `parent`, else under a remote `traceparent`, else the root of a new trace."""
+    if parent is not None:
+        return Span(name, parent.trace_id, parent.span_id, parent.sampled, kind, start_ns)
+    remote = parse_traceparent(traceparent)
+    if remote is not None:
+        return Span(name, remote[0], remote[1], remote[2] and TRACING_ENABLED, kind, start_ns)
+    sampled = TRACING_ENABLED and random.random() < TRACE_SAMPLE_RATE
+    return Span(name, "%032x" % random.getrandbits(128), None, sampled, kind, start_ns)
+
+
+def current() -> Optional[Span]:
+    return _current.get()
+
+
+def activate(span: Span) -> contextvars.Token:
+    return _current.set(span)
+
+
+@contextmanager
+def span(name: str, kind: int = INTERNAL, traceparent: Optional[str] = None, **attributes) -> Iterator[Span]:
+    """
+    Child of the current span (or of a remote `traceparent`) for the duration of
+    the block; exceptions mark it failed.
+    """
+    s = start_span(name, current() if traceparent is None else None, traceparent, kind=kind)
+    for k, v in attributes.items():
+        s.set(k, v)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.end(error=f"{e.__class__.__name__}: {e}" if not isinstance(e, asyncio.CancelledError) else "cancelled")
+        raise
+    finally:
+        _current.reset(token)
+        s.end()
+
+
+def inject(headers: Optional[dict] = None) -> dict:
+    """Headers carrying the current trace context to the next hop."""
+    headers = dict(headers or {})
+    s = current()
+    if s is not None:
+        headers["traceparent"] = s.traceparent
+    return headers
+
+
+async def finish_with(body: AsyncIterator[bytes], span: Span) -> AsyncIterator[bytes]:
+    """Relay a response body and end `span` once it has been sent."""
+    error = "cancelled"
+    try:
+        async for chunk in body:
+            yield chunk
+        error = None
+    finally:
+        span.end(error=error)
+
+
+def trace_stream(stream: AsyncIterator[bytes], parent: Optional[Span], started_ns: int) -> AsyncIterator[bytes]:
+    """
+    `chat.first_token` from the request start (queueing included) to the first
+    token handed on, then `chat.stream` until the stream ends, however it ends.
+    """
+    return ClosingIterator(_trace_stream(stream, parent, started_ns), stream)
+
+
+async def _trace_stream(stream: AsyncIterator[bytes], parent: Optional[Span], started_ns: int) -> AsyncIterator[bytes]:
+    if parent is None or not parent.sampled:
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+        return
+    first = start_span("chat.first_token", parent, start_ns=started_ns)
+    body: Optional[Span] = None
+    tokens = 0
+    error = "cancelled"
+    try:
+        async for chunk in stream:
+            if response_token(chunk):
+                tokens += 1
+                if body is None:
+                    first.end()
+                    body = start_span("chat.stream", parent)
+            yield chunk
+        error = None
+    except Exception as e:
+        error = f"{e.__class__.__name__}: {e}"
+        raise
+    finally:
+        if body is None:
+            first.end(error=error or "no tokens")
+        else:
+            body.set("tokens", tokens)
+            body.end(error=error)
+        await stream.aclose()
+
+
+def _value(v) -> dict:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+
+def _otlp(span: Span) -> dict:
+    out = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": span.kind,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": [{"key": k, "value": _value(v)} for k, v in span.attributes.items()],
+        "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+    }
+    if span.parent_id:
+        out["parentSpanId"] = span.parent_id
+    return out
+
+
+def encode(spans) -> str:
+    """One OTLP/JSON ExportTraceServiceRequest."""
+    return json.dumps({
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [_otlp(s) for s in spans]}],
+        }]
+    }, separators=(",", ":"))
+
+
+class SpanExporter:
+    """Finished spans, buffered in memory and shipped by a background task in batches."""
+
+    def __init__(self):
+        self._spans: Deque[Span] = deque(maxlen=TRACE_MAX_BUFFER)
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self.exported = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def add(self, span: Span) -> None:
+        if not exporting():
+            return
+        if len(self._spans) == self._spans.maxlen:
+            self.dropped += 1
+        self._spans.append(span)
+        if len(self._spans) >= TRACE_BATCH_SIZE:
+            self._wake.set()
+
+    async def flush(self) -> None:
+        while self._spans:
+            n = min(len(self._spans), TRACE_BATCH_SIZE)
+            batch = [self._spans.popleft() for _ in range(n)]
+            payload = encode(batch)
+            try:
+                if TRACE_OTLP_ENDPOINT:
+                    resp = await self._client.post(TRACE_OTLP_ENDPOINT, content=payload, headers={"Content-Type": "application/json"})
+                    resp.raise_for_status()
+                else:
+                    await asyncio.to_thread(_append, TRACE_FILE, payload, TRACE_FILE_MAX_BYTES)
+            except Exception as e:
+                # Spans are diagnostics: drop the batch rather than pile up behind a dead sink
+                self.errors += 1
+                self.dropped += n
+                logger.warning("Span export failed, %s spans dropped: %s", n, str(e))
+                return
+            self.exported += n
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), TRACE_EXPORT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def start(self) -> None:
+        if TRACING_ENABLED and exporting() and self._task is None:
+            if TRACE_OTLP_ENDPOINT:
+                self._client = httpx.AsyncClient(timeout=5)
+            self._task = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            await self.flush()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {"buffered": len(self._spans), "exported": self.exported, "dropped": self.dropped, "errors": self.errors}
+
+
+def exporting() -> bool:
+    """Whether finished spans have somewhere to go."""
+    return bool(TRACE_OTLP_ENDPOINT or TRACE_FILE)
+
+
+def _append(path: str, line: str, max_bytes: int = 0) -> None:
+    if max_bytes > 0:
+        try:
+            if os.path.getsize(path) + len(line) + 1 > max_bytes:
+                os.replace(path, path + ".1")
+        except FileNotFoundError:
+            pass
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+exporter = SpanExporter()
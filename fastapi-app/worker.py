@@ -0,0 +1,155 @@
+"""
+Job worker: `python worker.py` runs JOB_WORKER_PROCESSES processes, each working
+JOB_WORKER_CONCURRENCY jobs at a time from the Redis queue (see jobs.py).
+Scale bulk throughput here without touching the web workers.
+"""
+import os
+import json
+import signal
+import asyncio
+import logging
+import multiprocessing
+
+import ollama_client
+from jobs import job_store, JOB_TIMEOUT
+from metering import meter
+import metrics
+import tracing
+import log_pipeline
+from exceptions import ExternalServiceError
+from stream_format import usage
+
+logger = logging.getLogger("worker")
+
+JOB_WORKER_PROCESSES = int(os.getenv("JOB_WORKER_PROCESSES", "2"))
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "2"))
+JOB_REAP_INTERVAL = float(os.getenv("JOB_REAP_INTERVAL", "60"))
+CLAIM_TIMEOUT = 1  # seconds; how quickly an idle worker notices shutdown
+
+
+async def generate(job: dict) -> tuple[str, dict]:
+    # Streamed upstream even though the client polls: the read timeout then applies
+    # per chunk instead of to the whole (long) generation.
+    upstream = {"model": job["model"], "prompt": job["prompt"], "stream": True}
+    options = json.loads(job.get("options") or "{}")
+    if options:
+        upstream["options"] = options
+    lines = await ollama_client.open_stream("/api/generate", upstream)
+    pieces, final = [], None
+    try:
+        async for line in lines:
+            obj = json.loads(line)
+            if obj.get("error"):
+                raise ExternalServiceError(obj["error"])
+            pieces.append(obj.get("response") or "")
+            if obj.get("done") is True:
+                final = obj
+    finally:
+        # Also on timeout (wait_for cancels us): frees the node and the connection now
+        await lines.aclose()
+        if final is None:
+            # Ollama streams one token per line
+            meter.record(job["user_id"], job["model"], 0, sum(1 for p in pieces if p), aborted=True)
+    if final is None:
+        raise ExternalServiceError("Upstream stream ended early")
+    meter.record(job["user_id"], job["model"], final.get("prompt_eval_count") or 0, final.get("eval_count") or 0, aborted=False)
+    return "".join(pieces), usage(final)
+
+
+async def run_job(job: dict) -> None:
+    job_id = job["id"]
+    with tracing.span("job.run", tracing.SERVER, traceparent=job.get("traceparent"), job_id=job_id) as span:
+        try:
+            response, stats = await asyncio.wait_for(generate(job), JOB_TIMEOUT)
+        except asyncio.TimeoutError:
+            span.end(error="timeout")
+            await job_store.fail(job_id, "Job timed out")
+        except ExternalServiceError as e:
+            logger.error("Job %s upstream error: %s", job_id, str(e))
+            span.end(error=str(e))
+            metrics.upstream_errors.labels(job["model"], metrics.plan_label(None)).inc()
+            await job_store.fail(job_id, "Upstream unavailable")
+        except Exception as e:
+            logger.error("Job %s failed: %s", job_id, str(e), exc_info=True)
+            span.end(error=str(e))
+            await job_store.fail(job_id, "Internal server error")
+        else:
+            await job_store.succeed(job_id, response, stats)
+            span.set("completion_tokens", stats.get("completion_tokens") or 0)
+            logger.info("Job %s done (%s tokens)", job_id, stats.get("completion_tokens"))
+
+
+async def work_loop(stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        try:
+            job = await job_store.claim(CLAIM_TIMEOUT)
+        except Exception as e:
+            logger.warning("Job claim failed: %s", str(e))
+            await asyncio.sleep(1)
+            continue
+        if job is not None:
+            await run_job(job)
+
+
+async def reap_loop(stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        try:
+            requeued = await job_store.reap()
+            if requeued:
+                logger.warning("Requeued %s stale jobs", requeued)
+        except Exception as e:
+            logger.warning("Job reaper failed: %s", str(e))
+        try:
+            await asyncio.wait_for(stop.wait(), JOB_REAP_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run(concurrency: int) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        # Finish jobs in hand, stop claiming new ones
+        loop.add_signal_handler(sig, stop.set)
+    await ollama_client.startup()
+    meter.start()
+    # Ollama connect times and errors show up in the web workers' /metrics
+    metrics.REGISTRY.start(job_store.r)
+    tracing.exporter.start()
+    try:
+        await asyncio.gather(reap_loop(stop), *(work_loop(stop) for _ in range(concurrency)))
+    finally:
+        await ollama_client.shutdown()
+        await meter.close()
+        await metrics.REGISTRY.close()
+        await job_store.close()
+        await tracing.exporter.close()
+
+
+def process_main(concurrency: int) -> None:
+    log_pipeline.install("[%(asctime)s] [%(levelname)s] [%(name)s] [pid=%(process)d] %(message)s")
+    asyncio.run(run(concurrency))
+
+
+def main() -> None:
+    if JOB_WORKER_PROCESSES <= 1:
+        process_main(JOB_WORKER_CONCURRENCY)
+        return
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=process_main, args=(JOB_WORKER_CONCURRENCY,)) for _ in range(JOB_WORKER_PROCESSES)]
+    for p in procs:
+        p.start()
+
+    def forward(signum, _frame):
+        for p in procs:
+            if p.is_alive():
+                os.kill(p.pid, signum)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for p in procs:
+        p.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from exceptions import SubscriptionLimitExceeded, RateLimitExceeded, ExternalServiceError, CapacityExceeded
+from stream_format import format_stream
+import tracing
+
+logger = logging.getLogger(__name__)
+
+WS_AUTH_TIMEOUT = float(os.getenv("WS_AUTH_TIMEOUT", "10"))
+WS_MAX_STREAMS = int(os.getenv("WS_MAX_STREAMS", "4"))
+# Frames waiting for the socket, per connection. When full, streams stop reading from Ollama.
+WS_SEND_QUEUE = int(os.getenv("WS_SEND_QUEUE", "64"))
+
+# Private-range close code mirroring HTTP 401
+CLOSE_UNAUTHORIZED = 4401
+
+# Errors raised before the first frame, reported with the status /chat would have used
+ERROR_CODES = {ValueError: 400, SubscriptionLimitExceeded: 402, RateLimitExceeded: 429, CapacityExceeded: 503}
+
+OpenChat = Callable[[dict], Awaitable[Tuple[dict, AsyncIterator[bytes]]]]
+
+
+def _frame(obj: dict) -> str:
+    return json.dumps(obj, separators=(",", ":"))
+
+
+class ChatConnection:
+    """
+    One authenticated socket carrying any number of concurrent chat streams.
+
+    Client -> server, one JSON object per message:
+        {"type": "auth", "token": "<JWT>"}                     first message only
+        {"type": "chat", "id": "a1", "prompt": "...", ...}     same fields as POST /chat, plus an optional "traceparent"
+        {"type": "cancel", "id": "a1"}
+    Server -> client, the compact NDJSON frames of /chat with an "id" added:
+        {"id": "a1", "t": "..."}  {"id": "a1", "status": "queued", "position": 3}
+        {"id": "a1", "done": true, "usage": {...}}  {"id": "a1", "error": "...", "code": 429, "done": true}
+
+    All streams share one bounded send queue drained by a single writer. A slow
+    client fills the queue, stream tasks block on put() and stop pulling from
+    Ollama, so memory per connection is capped at WS_SEND_QUEUE frames.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.ws = websocket
+        self.user: Optional[dict] = None
+        self.streams: Dict[str, asyncio.Task] = {}
+        self._outbox: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE)
+
+    async def authenticate(self, verify: Callable[[str], Optional[dict]]) -> Optional[dict]:
+        """Bearer header if the client could set one, else an auth message within WS_AUTH_TIMEOUT."""
+        authorization = self.ws.headers.get("authorization") or ""
+        if authorization.lower().startswith("bearer "):
+            token = authorization.split(" ", 1)[1]
+        else:
+            try:
+                msg = json.loads(await asyncio.wait_for(self.ws.receive_text(), WS_AUTH_TIMEOUT))
+            except (asyncio.TimeoutError, ValueError, KeyError):
+                msg = None
+            token = msg.get("token") if isinstance(msg, dict) and msg.get("type") == "auth" else None
+        self.user = verify(token) if isinstance(token, str) and token else None
+        if self.user is None:
+            await self.ws.close(code=CLOSE_UNAUTHORIZED, reason="Invalid token")
+            return None
+        await self.ws.send_text(_frame({"type": "ready", "max_streams": WS_MAX_STREAMS}))
+        return self.user
+
+    def _expired(self) -> bool:
+        exp = self.user.get("exp") if self.user else None
+        return isinstance(exp, (int, float)) and exp <= time.time()
+
+    async def send(self, obj: dict) -> None:
+        await self._outbox.put(_frame(obj))
+
+    async def _writer(self) -> None:
+        while True:
+            text = await self._outbox.get()
+            # Returns once the server has handed the frame to the transport
+            await self.ws.send_text(text)
+
+    async def serve(self, open_chat: OpenChat) -> None:
+        """Read control messages until the client goes away; every stream dies with the socket."""
+        writer = asyncio.create_task(self._writer())
+        reader: Optional[asyncio.Future] = None
+        try:
+            while True:
+                reader = asyncio.ensure_future(self.ws.receive_text())
+                done, _ = await asyncio.wait({reader, writer}, return_when=asyncio.FIRST_COMPLETED)
+                if writer in done:
+                    writer.result()  # socket write failed: the client is gone
+                    return
+                raw = reader.result()
+                if self._expired():
+                    await self.ws.close(code=CLOSE_UNAUTHORIZED, reason="Token expired")
+                    return
+                await self._dispatch(raw, open_chat)
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            logger.info("WebSocket closed: %s", str(e))
+        finally:
+            tasks = [*self.streams.values(), writer] + ([reader] if reader is not None else [])
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.streams.clear()
+
+    async def _dispatch(self, raw: str, open_chat: OpenChat) -> None:
+        try:
+            msg = json.loads(raw)
+        except ValueError:
+            msg = None
+        if not isinstance(msg, dict):
+            await self.send({"error": "Messages must be JSON objects"})
+            return
+        kind, stream_id = msg.get("type"), msg.get("id")
+        if kind not in ("chat", "cancel"):
+            await self.send({"error": "type must be chat or cancel"})
+            return
+        if not isinstance(stream_id, str) or not stream_id or len(stream_id) > 64:
+            await self.send({"error": "id must be a string of 1-64 characters"})
+            return
+
+        if kind == "cancel":
+            task = self.streams.pop(stream_id, None)
+            if task is not None and not task.done():
+                task.cancel()
+                # Queued behind any frames the stream already produced
+                await self.send({"id": stream_id, "cancelled": True, "done": True})
+            return
+        if stream_id in self.streams:
+            await self.send({"id": stream_id, "error": "Stream id already in use", "code": 409, "done": True})
+            return
+        if len(self.streams) >= WS_MAX_STREAMS:
+            await self.send({"id": stream_id, "error": f"At most {WS_MAX_STREAMS} concurrent streams", "code": 429, "done": True})
+            return
+        task = asyncio.create_task(self._run(stream_id, msg, open_chat))
+        self.streams[stream_id] = task
+        task.add_done_callback(lambda t: self._forget(stream_id, t))
+
+    def _forget(self, stream_id: str, task: asyncio.Task) -> None:
+        # The id may already belong to a newer stream if this one was cancelled
+        if self.streams.get(stream_id) is task:
+            del self.streams[stream_id]
+
+    async def _run(self, stream_id: str, payload: dict, open_chat: OpenChat) -> None:
+        # One trace per stream (this task's context), continuing the client's if it sent one
+        root = tracing.start_span("WS chat", traceparent=payload.get("traceparent"), kind=tracing.SERVER)
+        root.set("stream_id", stream_id)
+        tracing.activate(root)
+        try:
+            await self._relay(stream_id, payload, open_chat)
+        except BaseException as e:
+            root.end(error="cancelled" if isinstance(e, asyncio.CancelledError) else str(e))
+            raise
+        finally:
+            root.end()
+
+    async def _relay(self, stream_id: str, payload: dict, open_chat: OpenChat) -> None:
+        try:
+            _, body = await open_chat(payload)
+        except ExternalServiceError as e:
+            logger.error("Upstream error: %s", str(e))
+            await self.send({"id": stream_id, "error": "Upstream unavailable", "code": 502, "done": True})
+            return
+        except tuple(ERROR_CODES) as e:
+            code = next(code for exc, code in ERROR_CODES.items() if isinstance(e, exc))
+            await self.send({"id": stream_id, "error": str(e), "code": code, "done": True})
+            return
+        except Exception as e:
+            logger.error("WebSocket stream %s failed: %s", stream_id, str(e), exc_info=True)
+            await self.send({"id": stream_id, "error": "Internal server error", "code": 500, "done": True})
+            return
+        frames = format_stream(body, "ndjson", tag=stream_id)
+        try:
+            async for chunk in frames:
+                for line in chunk.splitlines():
+                    # Blocks while the outbox is full, which stops the pull from upstream
+                    await self._outbox.put(line.decode("utf-8"))
+        except Exception as e:
+            logger.error("WebSocket stream %s failed: %s", stream_id, str(e), exc_info=True)
+            await self.send({"id": stream_id, "error": "Internal server error", "code": 500, "done": True})
+        finally:
+            # Also on cancel: closes the upstream stream and frees the scheduler slot
+            await frames.aclose()